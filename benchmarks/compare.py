@@ -0,0 +1,84 @@
+"""Compares two benchmark results from run_benchmarks.py
+
+Prints the ratio new/old of the setup time, the tick latencies and the
+mean iterations of each case present in both files. Exits with 1 if
+the tick p50 of a case is more than --threshold times the old one.
+
+Usage:
+    python benchmarks/compare.py old.json new.json
+"""
+import sys
+import json
+import argparse
+
+
+def get_key(case):
+    return (case["scenario"], case["controller"], case.get("jit", True))
+
+
+def get_ratio(new, old):
+    if new is None or old is None or old == 0:
+        return None
+    return new/old
+
+
+def format_ratio(ratio):
+    if ratio is None:
+        return "      -"
+    return "%7.2f" % ratio
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("old", help="JSON results to compare against")
+    parser.add_argument("new", help="JSON results to compare")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="tick p50 ratio counted as a regression")
+    args = parser.parse_args(argv)
+    with open(args.old) as old_file:
+        old = json.load(old_file)
+    with open(args.new) as new_file:
+        new = json.load(new_file)
+    old_cases = dict((get_key(case), case) for case in old["cases"])
+    sys.stdout.write("old: "+str(old["environment"].get("git_commit"))
+                     + " casadi "+old["environment"]["casadi"]+"\n")
+    sys.stdout.write("new: "+str(new["environment"].get("git_commit"))
+                     + " casadi "+new["environment"]["casadi"]+"\n")
+    sys.stdout.write("%-40s %7s %7s %7s %7s %7s\n"
+                     % ("case", "setup", "p50", "p99", "max", "iters"))
+    n_regressions = 0
+    for case in new["cases"]:
+        key = get_key(case)
+        name = case["scenario"]+"/"+case["controller"]
+        if not case.get("jit", True):
+            name += "/nojit"
+        if key not in old_cases:
+            continue
+        old_case = old_cases[key]
+        if "error" in case or "error" in old_case:
+            sys.stdout.write("%-40s failed\n" % name)
+            continue
+        ratios = [get_ratio(case["setup_time"], old_case["setup_time"])]
+        for stat in ["p50", "p99", "max"]:
+            ratios += [get_ratio(case["tick"][stat],
+                                 old_case["tick"][stat])]
+        if "iter_count" in case and "iter_count" in old_case:
+            ratios += [get_ratio(case["iter_count"]["mean"],
+                                 old_case["iter_count"]["mean"])]
+        else:
+            ratios += [None]
+        flag = ""
+        if ratios[1] is not None and ratios[1] > args.threshold:
+            flag = " <-"
+            n_regressions += 1
+        sys.stdout.write("%-40s " % name
+                         + " ".join([format_ratio(ratio) for ratio in ratios])
+                         + flag + "\n")
+    if n_regressions > 0:
+        sys.stdout.write(str(n_regressions)+" regressions\n")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
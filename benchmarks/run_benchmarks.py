@@ -0,0 +1,254 @@
+"""Benchmarks of the controllers on the example scenarios
+
+Runs each combination of scenario and controller in its own process,
+so that setup times and memory are not shared between them, and
+writes the results as JSON. For each case it records:
+    setup_time: construction and setup of the controller in seconds
+    tick: per tick latency in seconds of solve in a closed loop
+        simulation, "n", "mean", "p50", "p99" and "max"
+    iter_count: solver iterations per tick, "mean" and "max"
+    return_status: count of each return status of the solver
+    max_rss_setup: peak resident memory after setup in kB
+    max_rss: peak resident memory after the simulation in kB
+
+Usage:
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/compare.py old.json new.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+
+CONTROLLERS = ["reactive_qp", "reactive_nlp", "pseudo_inverse",
+               "model_predictive"]
+SCENARIOS = ["cart_on_track", "double_pendulum", "ur5", "iiwa"]
+
+
+def get_max_rss():
+    """Returns the peak resident memory of the process in kB."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        max_rss = max_rss//1024  # Bytes on macOS
+    return max_rss
+
+
+def get_options(controller, jit):
+    """Returns the options of the controller with jit on or off."""
+    if controller == "pseudo_inverse":
+        return {"function_opts": {"jit": jit}}
+    return {"function_opts": {"jit": jit},
+            "solver_opts": {"jit": jit}}
+
+
+def make_controller(controller, scenario, jit, horizon_length):
+    import casclik as cc
+    options = get_options(controller, jit)
+    if controller == "reactive_qp":
+        return cc.ReactiveQPController(skill_spec=scenario["skill"],
+                                       options=options)
+    elif controller == "reactive_nlp":
+        return cc.ReactiveNLPController(skill_spec=scenario["skill"],
+                                        cost_expr=scenario["cost_expr"],
+                                        options=options)
+    elif controller == "pseudo_inverse":
+        return cc.PseudoInverseController(skill_spec=scenario["skill_pinv"],
+                                          options=options)
+    elif controller == "model_predictive":
+        skill = scenario.get("skill_mpc", scenario["skill"])
+        return cc.ModelPredictiveController(skill_spec=skill,
+                                            cost_expr=scenario["cost_expr"],
+                                            horizon_length=horizon_length,
+                                            timestep=scenario["timestep"],
+                                            options=options)
+    raise ValueError("Unknown controller: "+str(controller))
+
+
+def run_case(scenario_name, controller_name, n_ticks, jit, horizon_length):
+    """Sets up the controller on the scenario, simulates n_ticks and
+    returns the results of the case as a dict."""
+    import casadi as cs
+    from scenarios import SCENARIOS as scenario_funcs
+    scenario = scenario_funcs[scenario_name]()
+    t_setup = time.time()
+    cntrllr = make_controller(controller_name, scenario, jit,
+                              horizon_length)
+    cntrllr.setup_problem_functions()
+    cntrllr.setup_solver()
+    setup_time = time.time() - t_setup
+    max_rss_setup = get_max_rss()
+    instr = cntrllr.enable_instrumentation(n_ticks)
+    skill = cntrllr.skill_spec
+    dt = scenario["timestep"]
+    max_speed = scenario["max_speed"]
+    robot_var = cs.np.array(scenario["robot_var0"], dtype=float)
+    virtual_var = None
+    if skill.virtual_var is not None:
+        virtual_var = cs.np.zeros(skill.n_virtual_var)
+    ticks = cs.np.zeros(n_ticks)
+    for i in range(n_ticks):
+        t_tick = instr.clock()
+        res = cntrllr.solve(i*dt, robot_var, virtual_var)
+        ticks[i] = instr.clock() - t_tick
+        robot_vel = cs.np.array(res[0], dtype=float).reshape(-1)
+        if controller_name == "pseudo_inverse":
+            robot_vel = cs.np.clip(robot_vel, -max_speed, max_speed)
+        robot_var = robot_var + dt*robot_vel
+        if virtual_var is not None and res[1] is not None:
+            virtual_var = virtual_var + dt*cs.np.array(
+                res[1], dtype=float).reshape(-1)
+    summary = instr.summary()
+    counts = summary.pop("counts")
+    result = {"scenario": scenario_name,
+              "controller": controller_name,
+              "jit": jit,
+              "n_ticks": n_ticks,
+              "setup_time": setup_time,
+              "tick": {"n": n_ticks,
+                       "mean": float(cs.np.mean(ticks)),
+                       "p50": float(cs.np.percentile(ticks, 50)),
+                       "p99": float(cs.np.percentile(ticks, 99)),
+                       "max": float(cs.np.max(ticks))},
+              "stages": {},
+              "return_status": counts.get("return_status", {}),
+              "max_rss_setup": max_rss_setup,
+              "max_rss": get_max_rss()}
+    if controller_name == "model_predictive":
+        result["horizon_length"] = horizon_length
+    for name, info in summary.items():
+        if name == "iter_count":
+            values = instr.buffers[name].values()
+            result["iter_count"] = {"mean": float(cs.np.mean(values)),
+                                    "max": float(cs.np.max(values))}
+        else:
+            result["stages"][name] = dict((key, float(val))
+                                          for key, val in info.items())
+    if "mode" in counts:
+        result["mode"] = dict((str(key), val)
+                              for key, val in counts["mode"].items())
+    return result
+
+
+def run_case_subprocess(scenario_name, controller_name, n_ticks, jit,
+                        horizon_length, timeout=None):
+    """Runs the case in a new process and returns its results. The
+    solvers print to stdout, so the results are passed in a file."""
+    fd, path = tempfile.mkstemp(prefix="casclik_bench_", suffix=".json")
+    os.close(fd)
+    cmd = [sys.executable, os.path.abspath(__file__),
+           "--case", scenario_name, controller_name,
+           "--n-ticks", str(n_ticks),
+           "--horizon-length", str(horizon_length),
+           "--output", path]
+    if not jit:
+        cmd += ["--no-jit"]
+    try:
+        with open(os.devnull, "w") as devnull:
+            proc = subprocess.Popen(cmd, stdout=devnull,
+                                    stderr=subprocess.PIPE)
+            out, err = proc.communicate()
+        if proc.returncode != 0:
+            err = err.decode("utf-8", "replace").strip().split("\n")
+            return {"scenario": scenario_name,
+                    "controller": controller_name,
+                    "jit": jit,
+                    "error": err[-1]}
+        with open(path) as result_file:
+            return json.load(result_file)
+    finally:
+        os.remove(path)
+
+
+def get_git_commit():
+    """Returns the current commit of the repository, or None."""
+    try:
+        proc = subprocess.Popen(["git", "rev-parse", "HEAD"],
+                                cwd=BENCH_DIR,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+    except OSError:
+        return None
+    if proc.returncode != 0:
+        return None
+    return out.decode("utf-8").strip()
+
+
+def get_environment():
+    """Returns the versions and the machine the results are from."""
+    import casadi as cs
+    return {"casadi": cs.CasadiMeta.version(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "git_commit": get_git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS,
+                        choices=SCENARIOS)
+    parser.add_argument("--controllers", nargs="+", default=CONTROLLERS,
+                        choices=CONTROLLERS)
+    parser.add_argument("--n-ticks", type=int, default=1000,
+                        help="simulated ticks per case")
+    parser.add_argument("--horizon-length", type=int, default=10,
+                        help="horizon length of the MPC")
+    parser.add_argument("--no-jit", action="store_true",
+                        help="run with jit off in functions and solvers")
+    parser.add_argument("--output", default=None,
+                        help="JSON file for the results, default stdout")
+    parser.add_argument("--case", nargs=2, default=None,
+                        metavar=("SCENARIO", "CONTROLLER"),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    jit = not args.no_jit
+    if args.case is not None:
+        result = run_case(args.case[0], args.case[1], args.n_ticks, jit,
+                          args.horizon_length)
+        with open(args.output, "w") as result_file:
+            json.dump(result, result_file)
+        return 0
+    results = {"environment": get_environment(),
+               "cases": []}
+    for scenario_name in args.scenarios:
+        for controller_name in args.controllers:
+            sys.stderr.write(scenario_name+" "+controller_name+"... ")
+            sys.stderr.flush()
+            result = run_case_subprocess(scenario_name, controller_name,
+                                         args.n_ticks, jit,
+                                         args.horizon_length)
+            if "error" in result:
+                sys.stderr.write("failed: "+result["error"]+"\n")
+            else:
+                sys.stderr.write("setup %.2f s, p50 %.1f us\n"
+                                 % (result["setup_time"],
+                                    1e6*result["tick"]["p50"]))
+            results["cases"] += [result]
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
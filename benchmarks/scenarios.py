@@ -0,0 +1,233 @@
+"""Benchmark scenarios
+
+This module rebuilds the scenarios of the example notebooks as
+functions returning what the benchmarks need. Each scenario function
+returns a dict with:
+    skill: SkillSpecification for the optimization based controllers
+    skill_pinv: SkillSpecification for the PseudoInverseController
+    robot_var0: initial robot_var
+    max_speed: speed limit used to saturate the PseudoInverseController
+    timestep: timestep of the simulation and the MPC
+    cost_expr: cost expression for the ReactiveNLPController and MPC
+
+The UR5 and iiwa scenarios need urdf2casadi, and raise ImportError
+without it.
+"""
+import os
+import casadi as cs
+import casclik as cc
+
+URDF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "..", "examples", "notebooks", "urdf")
+
+
+def cart_on_track():
+    """Cart moving to a point on a track, from the cart on track
+    notebook."""
+    t = cs.MX.sym("t")
+    p = cs.MX.sym("p")
+    dp = cs.MX.sym("dp")
+    p_des = 0.75
+    max_speed = 0.275
+    min_dist_cnstr = cc.EqualityConstraint(
+        label="min_dist_cnstr",
+        expression=p_des - p,
+        gain=1.0,
+        constraint_type="soft",
+        priority=2)
+    cart_limit_cnstr = cc.SetConstraint(
+        label="cart_limit_cnstr",
+        expression=p,
+        gain=1.0,
+        set_min=0.0,
+        set_max=1.0,
+        priority=1)
+    speed_limit_cnstr = cc.VelocitySetConstraint(
+        label="speed_limit_cnstr",
+        expression=p,
+        gain=10.0,
+        set_min=-max_speed,
+        set_max=max_speed)
+    skill = cc.SkillSpecification(
+        label="move_to_point_skill",
+        time_var=t,
+        robot_var=p,
+        robot_vel_var=dp,
+        constraints=[min_dist_cnstr, cart_limit_cnstr, speed_limit_cnstr])
+    skill_pinv = cc.SkillSpecification(
+        label="move_to_point_skill_pinv",
+        time_var=t,
+        robot_var=p,
+        robot_vel_var=dp,
+        constraints=[min_dist_cnstr, cart_limit_cnstr])
+    return {"skill": skill,
+            "skill_pinv": skill_pinv,
+            "robot_var0": [0.0],
+            "max_speed": max_speed,
+            "timestep": 0.01,
+            "cost_expr": 10.0*dp*dp}
+
+
+def double_pendulum():
+    """Two-link manipulator moving to a point above a table, from the
+    double pendulum notebook."""
+    l_1 = 1.0
+    l_2 = 0.75
+    t = cs.MX.sym("t")
+    q = cs.MX.sym("q", 2)
+    dq = cs.MX.sym("dq", 2)
+    p_mid = cs.vertcat(l_1*cs.cos(q[0]),
+                       l_1*cs.sin(q[0]))
+    p = cs.vertcat(l_1*cs.cos(q[0]) + l_2*cs.cos(q[0]+q[1]),
+                   l_1*cs.sin(q[0]) + l_2*cs.sin(q[0]+q[1]))
+    p_des = cs.vertcat(0.75, 0.5)
+    max_speed = 0.5
+    table_height = -0.05
+    min_dist_cnstr = cc.EqualityConstraint(
+        label="min_dist_cnstr",
+        expression=p_des - p,
+        gain=1.0,
+        constraint_type="soft",
+        priority=2)
+    speed_limit_cnstr = cc.VelocitySetConstraint(
+        label="speed_limit_cnstr",
+        expression=q,
+        set_min=-cs.vertcat(max_speed, max_speed),
+        set_max=cs.vertcat(max_speed, max_speed))
+    table_midpoint_cnstr = cc.SetConstraint(
+        label="table_midpoint_cnstr",
+        expression=p_mid[1] - table_height,
+        set_min=0.0,
+        set_max=cs.inf,
+        priority=1)
+    table_endpoint_cnstr = cc.SetConstraint(
+        label="table_endpoint_cnstr",
+        expression=p[1] - table_height,
+        set_min=0.0,
+        set_max=cs.inf,
+        priority=1)
+    skill = cc.SkillSpecification(
+        label="move_to_point_skill",
+        time_var=t,
+        robot_var=q,
+        robot_vel_var=dq,
+        constraints=[min_dist_cnstr,
+                     speed_limit_cnstr,
+                     table_midpoint_cnstr,
+                     table_endpoint_cnstr])
+    skill_pinv = cc.SkillSpecification(
+        label="move_to_point_skill_pinv",
+        time_var=t,
+        robot_var=q,
+        robot_vel_var=dq,
+        constraints=[min_dist_cnstr,
+                     table_midpoint_cnstr,
+                     table_endpoint_cnstr])
+    return {"skill": skill,
+            "skill_pinv": skill_pinv,
+            "robot_var0": [cs.np.pi/2 - 1e-5, 0.0],
+            "max_speed": max_speed,
+            "timestep": 0.01,
+            "cost_expr": cs.dot(dq, dq)}
+
+
+def get_box_skills(label, t, q, p_fk, path_des, box, gain):
+    """Returns the skills of a robot tracking path_des while keeping the
+    end-effector inside box, as in the moe2016 example 2 notebook."""
+    n_joints = q.size()[0]
+    constraints = []
+    for idx, axis in enumerate(["x", "y", "z"]):
+        constraints += [cc.SetConstraint(
+            label="colav_"+axis,
+            expression=p_fk[idx],
+            set_min=box[idx][0],
+            set_max=box[idx][1],
+            priority=n_joints + idx + 1,
+            constraint_type="hard",
+            gain=gain)]
+    constraints += [cc.EqualityConstraint(
+        label="move_point",
+        expression=p_fk - path_des,
+        priority=n_joints + 4,
+        constraint_type="soft",
+        gain=0.15)]
+    return cc.SkillSpecification(label=label,
+                                 time_var=t,
+                                 robot_var=q,
+                                 constraints=constraints)
+
+
+def ur5():
+    """UR5 tracking a trajectory inside a box, from the moe2016 example 2
+    notebook."""
+    from urdf2casadi import converter
+    fk_dict = converter.from_file(root="base_link", tip="tool0",
+                                  filename=os.path.join(URDF_DIR,
+                                                        "ur5.urdf"))
+    fk_dict = converter.from_denavit_hartenberg(
+        joint_angles=["s" for i in range(6)],
+        link_lengths=[0., -0.425, -0.392, 0., 0., 0.],
+        link_offsets=[0.089, 0., 0., 0.109, 0.095, 0.082],
+        link_twists=[cs.np.pi/2, 0., 0., cs.np.pi/2, -cs.np.pi/2, 0.],
+        joint_names=fk_dict["joint_names"],
+        upper_limits=fk_dict["upper"],
+        lower_limits=fk_dict["lower"]
+    )
+    t = cs.MX.sym("t")
+    q = cs.MX.sym("q", len(fk_dict["joint_names"]))
+    p_fk = fk_dict["T_fk"](q)[:3, 3]
+    omega = 0.1
+    path_des = cs.vertcat(
+        0.5*cs.sin(omega*t)*cs.sin(omega*t) + 0.2,
+        0.5*cs.cos(omega*t) + 0.25*cs.sin(omega*t),
+        0.5*cs.sin(omega*t)*cs.cos(omega*t) + 0.1)
+    box = [(0.1, 0.6), (-0.5, 0.4), (-0.3, 0.25)]
+    skill = get_box_skills("box_move", t, q, p_fk, path_des, box, 5e2)
+    skill_mpc = get_box_skills("box_move_mpc", t, q, p_fk, path_des, box,
+                               1.)
+    return {"skill": skill,
+            "skill_pinv": skill,
+            "skill_mpc": skill_mpc,
+            "robot_var0": [-(50.0/180.0)*cs.np.pi,
+                           -(160.0/180.0)*cs.np.pi,
+                           -(110.0/180.0)*cs.np.pi,
+                           -(90.0/180.0)*cs.np.pi,
+                           -(90.0/180.0)*cs.np.pi,
+                           0.0],
+            "max_speed": cs.np.pi/5,
+            "timestep": 0.008,
+            "cost_expr": None}
+
+
+def iiwa():
+    """KUKA LBR iiwa 14 R820 tracking a trajectory inside a box, the UR5
+    scenario moved in front of the iiwa."""
+    from urdf2casadi import converter
+    fk_dict = converter.from_file(root="base_link", tip="tool0",
+                                  filename=os.path.join(
+                                      URDF_DIR, "lbr_iiwa_14_r820.urdf"))
+    t = cs.MX.sym("t")
+    q = cs.MX.sym("q", len(fk_dict["joint_names"]))
+    p_fk = fk_dict["T_fk"](q)[:3, 3]
+    omega = 0.1
+    path_des = cs.vertcat(
+        0.5 + 0.1*cs.sin(omega*t),
+        0.3*cs.cos(omega*t),
+        0.6 + 0.1*cs.sin(omega*t)*cs.cos(omega*t))
+    box = [(0.3, 0.8), (-0.5, 0.5), (0.3, 1.0)]
+    skill = get_box_skills("box_move", t, q, p_fk, path_des, box, 5e2)
+    skill_mpc = get_box_skills("box_move_mpc", t, q, p_fk, path_des, box,
+                               1.)
+    return {"skill": skill,
+            "skill_pinv": skill,
+            "skill_mpc": skill_mpc,
+            "robot_var0": [0.0, 0.6, 0.0, -1.2, 0.0, 0.8, 0.0],
+            "max_speed": cs.np.pi/5,
+            "timestep": 0.008,
+            "cost_expr": None}
+
+
+SCENARIOS = {"cart_on_track": cart_on_track,
+             "double_pendulum": double_pendulum,
+             "ur5": ur5,
+             "iiwa": iiwa}
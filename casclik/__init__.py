@@ -1,3 +1,4 @@
 from casclik.constraints import *
 from casclik.skill_specification import SkillSpecification
 from casclik.controllers import *
+from casclik.compile_cache import CompileCache
@@ -0,0 +1,147 @@
+"""Background JIT
+
+This module contains tools for starting a controller with interpreted
+casadi functions while the jit compiled versions are built in a
+background thread. The HotSwapFunction is what the controllers store
+instead of the casadi function, it forwards calls to the function it
+currently holds. The BackgroundJit worker builds the compiled functions
+one job at a time, and swaps them into their HotSwapFunction when
+ready.
+
+The C code of the problem functions is generated in the calling
+thread, so that the background thread only runs the compiler and loads
+the result with cs.external. Solvers with jit are rebuilt through the
+cache in the background thread, see CompileCache.load_nlpsol, from a
+serialized problem function made in the calling thread, so that no
+casadi objects are shared between the threads. A job that fails to
+build leaves the function interpreted, warns and is kept in errors.
+"""
+import threading
+import warnings
+import tempfile
+from casclik.compile_cache import CompileCache
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+
+class HotSwapFunction(object):
+    """Forwards calls and attributes to the casadi function it holds.
+
+    Args:
+        function (cs.Function): function to use until swapped
+        name (str): name used in callbacks, default function.name()
+    """
+
+    def __init__(self, function, name=None):
+        self.function = function
+        if name is None:
+            name = function.name()
+        self.label = name
+        self.is_swapped = False
+
+    def __repr__(self):
+        return "HotSwapFunction<"+self.label+">"
+
+    def __call__(self, *args, **kwargs):
+        return self.function(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.function, name)
+
+    def swap(self, function):
+        """Replaces the held function. Assignment is atomic, so calls
+        in other threads use either the old or the new function."""
+        self.function = function
+        self.is_swapped = True
+
+
+class BackgroundJit(object):
+    """Worker thread building jit compiled functions.
+
+    Args:
+        cache (CompileCache): cache to compile into, default is a
+            temporary directory
+        callback (callable): called as callback(hot_swap_function) from
+            the worker thread after each swap
+
+    Attributes:
+        errors (list): (hot_swap_function, exception) of the failed jobs
+    """
+
+    def __init__(self, cache=None, callback=None):
+        if cache is None:
+            cache = CompileCache(tempfile.mkdtemp(prefix="casclik_jit_"))
+        self.cache = cache
+        self.callback = callback
+        self.errors = []
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._n_pending = 0
+        self._done = threading.Event()
+        self._done.set()
+        self._thread = None
+
+    @property
+    def is_ready(self):
+        """True when there are no jobs waiting or being compiled, and
+        none of them failed."""
+        return self._done.is_set() and len(self.errors) == 0
+
+    def wait(self, timeout=None):
+        """Blocks until all jobs are done. Returns is_ready."""
+        self._done.wait(timeout)
+        return self.is_ready
+
+    def add_function(self, function, jit_options=None):
+        """Returns a HotSwapFunction holding function (which should not be
+        jit compiled), and queues the compilation of it."""
+        hot_swap = HotSwapFunction(function)
+        job = self.cache.prepare(function, jit_options)
+        self._put(hot_swap, lambda: self.cache.build(job))
+        return hot_swap
+
+    def add_solver(self, solver, builder):
+        """Returns a HotSwapFunction holding solver, and queues builder,
+        which should return the jit compiled solver."""
+        hot_swap = HotSwapFunction(solver)
+        self._put(hot_swap, builder)
+        return hot_swap
+
+    def _put(self, hot_swap, builder):
+        with self._lock:
+            self._n_pending += 1
+            self._done.clear()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name="casclik_jit")
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put((hot_swap, builder))
+
+    def _run(self):
+        while True:
+            try:
+                hot_swap, builder = self._queue.get(timeout=1.0)
+            except queue.Empty:
+                with self._lock:
+                    if self._n_pending == 0:
+                        self._thread = None
+                        return
+                continue
+            try:
+                hot_swap.swap(builder())
+                if self.callback is not None:
+                    self.callback(hot_swap)
+            except Exception as err:
+                # Keep running interpreted, but keep track of it
+                self.errors += [(hot_swap, err)]
+                warnings.warn("Background jit of " + hot_swap.label
+                              + " failed, it stays interpreted: "
+                              + str(err), RuntimeWarning)
+            with self._lock:
+                self._n_pending -= 1
+                if self._n_pending == 0:
+                    self._done.set()
@@ -0,0 +1,87 @@
+"""Buffered function
+
+This module contains the BufferedFunction class, which evaluates a
+casadi function from and into preallocated numpy arrays. It is used by
+the solve_into methods of the controllers. With casadi versions that
+have Function.buffer, the arrays are handed to casadi once and each
+evaluation writes directly into them. Older versions fall back to a
+regular call followed by a copy into the arrays.
+"""
+import casadi as cs
+
+
+class BufferedFunction(object):
+    """Evaluates a casadi function from and into numpy arrays.
+
+    The arrays in args and res hold the nonzeros of the inputs and
+    outputs of the function. They are owned by the BufferedFunction,
+    other arrays can be used for the outputs with set_res.
+
+    Args:
+        func (cs.Function): function to evaluate
+        args (list): arrays to use for the inputs, for sharing them
+            between functions, default new arrays
+    """
+
+    def __init__(self, func, args=None):
+        self.func = func
+        if args is None:
+            args = [cs.np.zeros(func.nnz_in(i)) for i in range(func.n_in())]
+        self.args = args
+        self.res = [cs.np.zeros(func.nnz_out(i))
+                    for i in range(func.n_out())]
+        if hasattr(func, "buffer"):
+            self._buffer, self._trigger = func.buffer()
+            for i, arg in enumerate(self.args):
+                self._buffer.set_arg(i, memoryview(arg))
+            for i, res in enumerate(self.res):
+                self._buffer.set_res(i, memoryview(res))
+        else:
+            self._buffer = None
+
+    def __repr__(self):
+        return "BufferedFunction<"+self.func.name()+">"
+
+    def index_in(self, name):
+        """Returns the index of the input called name, or None."""
+        if name in self.func.name_in():
+            return self.func.index_in(name)
+        return None
+
+    def index_out(self, name):
+        """Returns the index of the output called name, or None."""
+        if name in self.func.name_out():
+            return self.func.index_out(name)
+        return None
+
+    def set_res(self, i, res):
+        """Makes output i write into res, a contiguous float64 array with
+        the same number of elements as the output."""
+        if res is self.res[i]:
+            return
+        if not isinstance(res, cs.np.ndarray) or res.dtype != cs.np.float64:
+            raise TypeError("Output "+self.func.name_out(i)+" must be a"
+                            + " float64 numpy array.")
+        if not res.flags["C_CONTIGUOUS"]:
+            raise ValueError("Output "+self.func.name_out(i)+" must be"
+                             + " contiguous.")
+        if res.size != self.func.nnz_out(i):
+            raise ValueError("Output "+self.func.name_out(i)+" must have "
+                             + str(self.func.nnz_out(i))+" elements, got "
+                             + str(res.size)+".")
+        if self._buffer is not None:
+            self._buffer.set_res(i, memoryview(res.reshape(-1)))
+        self.res[i] = res
+
+    def __call__(self):
+        """Evaluates the function with args, writing into res."""
+        if self._buffer is None:
+            vals = self.func.call([cs.DM(self.func.sparsity_in(i), arg)
+                                   for i, arg in enumerate(self.args)])
+            for res, val in zip(self.res, vals):
+                res.reshape(-1)[:] = val.nonzeros()
+            return
+        self._trigger()
+        if self._buffer.ret() != 0:
+            raise RuntimeError("Evaluation of "+self.func.name()
+                               + " failed.")
@@ -0,0 +1,380 @@
+"""Compile cache
+
+This module contains the CompileCache class, a persistent on-disk
+cache of compiled casadi functions. Setting jit=True in the
+function_opts of a controller means that every function is compiled
+by the C compiler every time the controller is set up. With a
+CompileCache in the "compile_cache" option of the controllers, the
+C code of each function is generated and hashed together with the
+compiler and its flags. The shared library is stored in the cache
+directory under that hash, and loaded with cs.external on subsequent
+setups. The functions an nlpsol jit compiles are cached the same way,
+see load_nlpsol. Compilation writes to a temporary file that is
+atomically renamed into place, and a library is loaded before the
+cache is evicted, so processes sharing a cache directory can run
+concurrently.
+"""
+import os
+import sys
+import hashlib
+import tempfile
+import subprocess
+import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import casadi as cs
+
+
+class CompileCache(object):
+    """Persistent on-disk cache of compiled casadi functions.
+
+    Args:
+        cache_dir (str): cache directory, default ~/.cache/casclik
+        compiler (str): C compiler executable, default gcc
+        max_size (int): max size of the cache in bytes, None for no limit
+        max_age (float): max age of entries in seconds, None for no limit
+    """
+    library_suffix = ".so"
+
+    def __init__(self, cache_dir=None,
+                 compiler="gcc",
+                 max_size=None,
+                 max_age=None):
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.expanduser("~"),
+                                     ".cache", "casclik")
+        self.cache_dir = cache_dir
+        self.compiler = compiler
+        self.max_size = max_size
+        self.max_age = max_age
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def __repr__(self):
+        return "CompileCache<"+self.cache_dir+">"
+
+    @staticmethod
+    def get_flags(jit_options):
+        """Returns the compiler flags of the jit_options as a list."""
+        if jit_options is None:
+            return ["-O2"]
+        flags = jit_options.get("flags", [])
+        if isinstance(flags, str):
+            flags = flags.split()
+        return list(flags)
+
+    def generate(self, func, name=None):
+        """Returns the C code of the casadi function."""
+        if name is None:
+            name = func.name()
+        cg = cs.CodeGenerator(name+".c")
+        cg.add(func)
+        return cg.dump()
+
+    def get_key(self, source, flags):
+        """Returns the hash of the C code, the compiler and its flags."""
+        key = hashlib.sha256()
+        key.update(cs.CasadiMeta.version().encode("utf-8"))
+        key.update(self.compiler.encode("utf-8"))
+        key.update(" ".join(flags).encode("utf-8"))
+        key.update(source.encode("utf-8"))
+        return key.hexdigest()
+
+    def get_path(self, key):
+        """Returns the path of the shared library of key."""
+        return os.path.join(self.cache_dir, key+self.library_suffix)
+
+    def compile(self, source, flags, path):
+        """Compiles the C code into a shared library at path. The
+        library is compiled to a temporary file in the cache directory
+        and renamed into place."""
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        # Temporary files are hidden from entries and eviction
+        fd, src_path = tempfile.mkstemp(prefix=".tmp", suffix=".c",
+                                        dir=self.cache_dir)
+        with os.fdopen(fd, "w") as src_file:
+            src_file.write(source)
+        lib_fd, lib_path = tempfile.mkstemp(prefix=".tmp",
+                                            suffix=self.library_suffix,
+                                            dir=self.cache_dir)
+        os.close(lib_fd)
+        cmd = [self.compiler, "-shared", "-fPIC"] + flags
+        cmd += [src_path, "-o", lib_path, "-lm"]
+        try:
+            self.run_compiler(cmd)
+            os.chmod(lib_path, 0o755)
+            os.rename(lib_path, path)
+        finally:
+            os.remove(src_path)
+            if os.path.exists(lib_path):
+                os.remove(lib_path)
+
+    def run_compiler(self, cmd):
+        """Runs the compiler command, raising RuntimeError on failure."""
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError("Compilation failed: " + " ".join(cmd)
+                               + "\n" + err.decode("utf-8", "replace"))
+
+    def compile_many(self, sources, flags, path, n_jobs=None):
+        """Compiles the C codes to object files with n_jobs compiler
+        processes at a time, default the number of cores, and links them
+        into one shared library at path."""
+        if n_jobs is None:
+            n_jobs = multiprocessing.cpu_count()
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        tmp_paths = []
+        try:
+            objects = []
+            cmds = []
+            for source in sources:
+                fd, src_path = tempfile.mkstemp(prefix=".tmp", suffix=".c",
+                                                dir=self.cache_dir)
+                tmp_paths += [src_path]
+                with os.fdopen(fd, "w") as src_file:
+                    src_file.write(source)
+                obj_path = src_path[:-2] + ".o"
+                tmp_paths += [obj_path]
+                objects += [obj_path]
+                cmds += [[self.compiler, "-c", "-fPIC"] + flags
+                         + [src_path, "-o", obj_path]]
+            pool = ThreadPool(max(1, min(n_jobs, len(cmds))))
+            try:
+                pool.map(self.run_compiler, cmds)
+            finally:
+                pool.close()
+                pool.join()
+            lib_fd, lib_path = tempfile.mkstemp(prefix=".tmp",
+                                                suffix=self.library_suffix,
+                                                dir=self.cache_dir)
+            os.close(lib_fd)
+            tmp_paths += [lib_path]
+            self.run_compiler([self.compiler, "-shared"] + flags + objects
+                              + ["-o", lib_path, "-lm"])
+            os.chmod(lib_path, 0o755)
+            os.rename(lib_path, path)
+        finally:
+            for tmp_path in tmp_paths:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def load_many(self, funcs, name, jit_options=None, n_jobs=None):
+        """Returns the functions as external functions from one shared
+        library. The library is compiled by compile_many if it is not in
+        the cache. The functions are split in one C file per job, and
+        their names must be unique.
+
+        Args:
+            funcs (list): functions to compile, jit should be off
+            name (str): name of the library, prefix of its C files
+            jit_options (dict): jit_options with compiler "flags"
+            n_jobs (int): number of compiler processes, default the
+                number of cores
+        Return:
+            list: external functions in the order of funcs
+        """
+        if n_jobs is None:
+            n_jobs = multiprocessing.cpu_count()
+        flags = self.get_flags(jit_options)
+        n_files = max(1, min(n_jobs, len(funcs)))
+        sources = []
+        for file_idx in range(n_files):
+            cg = cs.CodeGenerator(name+"_"+str(file_idx)+".c")
+            for func in funcs[file_idx::n_files]:
+                cg.add(func)
+            sources += [cg.dump()]
+        path = self.get_path(self.get_key("\n".join(sources), flags))
+        return self.load_library(
+            path,
+            lambda: self.compile_many(sources, flags, path, n_jobs),
+            lambda: [cs.external(func.name(), path) for func in funcs])
+
+    def prepare(self, func, jit_options=None):
+        """Generates the C code of func and finds its place in the cache.
+        This is the part of load that needs casadi, see build.
+
+        Args:
+            func (cs.Function): function to compile, jit should be off
+            jit_options (dict): jit_options with compiler "flags"
+        Return:
+            dict: job for build with "name", "source", "flags" and "path"
+        """
+        flags = self.get_flags(jit_options)
+        source = self.generate(func)
+        return {"name": func.name(),
+                "source": source,
+                "flags": flags,
+                "path": self.get_path(self.get_key(source, flags))}
+
+    def build(self, job):
+        """Compiles the job from prepare if it is not in the cache, and
+        returns it as an external function."""
+        path = job["path"]
+        return self.load_library(
+            path,
+            lambda: self.compile(job["source"], job["flags"], path),
+            lambda: cs.external(job["name"], path))
+
+    def load_library(self, path, compile_library, loader):
+        """Returns loader() of the library at path, after compile_library
+        has compiled it into place if it is not in the cache. If it can
+        not be loaded, as when another process evicted it after it was
+        found, it is compiled again. The cache is evicted after the
+        library is loaded, sparing it."""
+        if os.path.exists(path):
+            try:
+                # Mark as recently used for the eviction
+                os.utime(path, None)
+                loaded = loader()
+                self.n_hits += 1
+                return loaded
+            except (OSError, RuntimeError):
+                pass  # Removed by someone else, compile it again
+        self.n_misses += 1
+        compile_library()
+        loaded = loader()
+        self.evict(exclude=[path])
+        return loaded
+
+    def load(self, func, jit_options=None):
+        """Returns func as an external function loaded from the cache. If
+        it is not in the cache, it is compiled first.
+
+        Args:
+            func (cs.Function): function to compile, jit should be off
+            jit_options (dict): jit_options with compiler "flags"
+        Return:
+            cs.Function: external function with the same signature
+        """
+        return self.build(self.prepare(func, jit_options))
+
+    def load_nlpsol(self, name, solver_name, nlp, solver_opts):
+        """Returns cs.nlpsol(name, solver_name, nlp, solver_opts) with the
+        functions that jit would compile inside the solver loaded from
+        the cache. The problem function and its derivatives are
+        generated as in solver.generate_dependencies, and the solver is
+        created again from the library with cs.Importer.
+
+        Args:
+            name (str): name of the solver
+            solver_name (str): nlpsol plugin, such as "ipopt"
+            nlp (dict, cs.Function): problem as given to cs.nlpsol
+            solver_opts (dict): options of the solver, with jit_options
+                giving the compiler "flags"
+        Return:
+            cs.Function: the nlpsol
+        """
+        if isinstance(nlp, cs.Function):
+            # The Importer looks for the problem under the name "nlp"
+            x, p = nlp.mx_in()
+            f, g = nlp(x, p)
+            nlp = {"x": x, "p": p, "f": f, "g": g}
+        opts = dict(solver_opts)
+        opts["jit"] = False
+        jit_options = opts.pop("jit_options", None)
+        opts.pop("compiler", None)
+        solver = cs.nlpsol(name, solver_name, nlp, opts)
+        cg = cs.CodeGenerator(name+"_nlp.c")
+        cg.add(solver.oracle())
+        for func_name in solver.get_function():
+            cg.add(solver.get_function(func_name))
+        source = cg.dump()
+        flags = self.get_flags(jit_options)
+        path = self.get_path(self.get_key(source, flags))
+        return self.load_library(
+            path,
+            lambda: self.compile(source, flags, path),
+            lambda: cs.nlpsol(name, solver_name, cs.Importer(path, "dll"),
+                              opts))
+
+    def entries(self):
+        """Returns a list of (mtime, size, path) of the libraries in the
+        cache, oldest first."""
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if fname.startswith("."):
+                continue  # Being compiled
+            if not fname.endswith(self.library_suffix):
+                continue
+            path = os.path.join(self.cache_dir, fname)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # Removed by someone else
+            entries += [(stat.st_mtime, stat.st_size, path)]
+        return sorted(entries)
+
+    def evict(self, max_size=None, max_age=None, exclude=None):
+        """Removes libraries older than max_age seconds, and then the
+        least recently used libraries until the cache is smaller than
+        max_size bytes. Defaults to the limits of the cache. The paths
+        in exclude are not removed.
+
+        Return:
+            int: number of removed libraries
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if max_age is None:
+            max_age = self.max_age
+        if exclude is None:
+            exclude = []
+        keep = []
+        n_removed = 0
+        now = time.time()
+        for mtime, size, path in self.entries():
+            if (max_age is not None and now - mtime > max_age
+                    and path not in exclude):
+                n_removed += self._remove(path)
+            else:
+                keep += [(mtime, size, path)]
+        if max_size is not None:
+            # Excluded libraries count towards the size
+            total_size = sum([size for mtime, size, path in keep])
+            for mtime, size, path in keep:
+                if total_size <= max_size:
+                    break
+                if path in exclude:
+                    continue
+                n_removed += self._remove(path)
+                total_size -= size
+        return n_removed
+
+    def clear(self):
+        """Removes all libraries in the cache."""
+        n_removed = 0
+        for mtime, size, path in self.entries():
+            n_removed += self._remove(path)
+        return n_removed
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            return 0  # Removed by someone else
+        return 1
+
+    def print_stats(self):
+        """Prints information about the cache."""
+        entries = self.entries()
+        sys.stdout.write(repr(self)+"\n")
+        sys.stdout.write("N entries: "+str(len(entries))+"\n")
+        sys.stdout.write("Size: "
+                         + str(sum([entry[1] for entry in entries]))+"\n")
+        sys.stdout.write("Hits: "+str(self.n_hits)+"\n")
+        sys.stdout.write("Misses: "+str(self.n_misses)+"\n")
+        sys.stdout.flush()
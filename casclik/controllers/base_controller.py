@@ -1,6 +1,340 @@
+import sys
+import casadi as cs
+from casclik.compile_cache import CompileCache
+from casclik.background_jit import BackgroundJit
+from casclik.buffered_function import BufferedFunction
+from casclik.instrumentation import Instrumentation
+
+
 class BaseController(object):
+    instrumentation = None  # See enable_instrumentation
+
     def __init__(self, skill_spec):
         pass
 
     def __repr__(self):
         return self.controller_type+"<"+self.skill_spec.label+">"
+
+    def enable_instrumentation(self, size=1000):
+        """Starts recording the time spent in the stages of solve, and
+        the solver statistics, in ring buffers of size ticks. Returns
+        the Instrumentation, see its summary and print_summary."""
+        self.instrumentation = Instrumentation(size)
+        return self.instrumentation
+
+    def disable_instrumentation(self):
+        """Stops recording, solve is then without any instrumentation."""
+        self.instrumentation = None
+
+    def record_tick(self, instr, t_start, eval_time, solver_time=None):
+        """Records the stages of a solve that started at t_start, and the
+        statistics of the solver if solver_time is given. The iteration
+        count and return status are only recorded when the solver
+        reports them."""
+        total_time = instr.clock() - t_start
+        instr.record("eval", eval_time)
+        instr.record("total", total_time)
+        pack_time = total_time - eval_time
+        if solver_time is not None:
+            instr.record("solver", solver_time)
+            pack_time -= solver_time
+            stats = self.solver.stats()
+            if "iter_count" in stats:
+                instr.record("iter_count", stats["iter_count"])
+            if "return_status" in stats:
+                instr.count("return_status", stats["return_status"])
+        instr.record("pack", pack_time)
+
+    def create_function(self, name, list_vars, exprs, list_names,
+                        expr_names, func_opts):
+        """Creates a casadi function. If jit is on in func_opts and the
+        compile_cache option is set, the compiled function is loaded from
+        the CompileCache instead of compiled from scratch."""
+        cache = self.options.get("compile_cache", None)
+        background = self.options.get("background_jit", False)
+        if not func_opts.get("jit", False) or (cache is None
+                                               and not background):
+            return cs.Function(name, list_vars, exprs,
+                               list_names, expr_names, func_opts)
+        opts = dict(func_opts)
+        opts["jit"] = False
+        jit_options = opts.pop("jit_options", None)
+        opts.pop("compiler", None)
+        func = cs.Function(name, list_vars, exprs,
+                           list_names, expr_names, opts)
+        if background:
+            return self.get_background_jit().add_function(func, jit_options)
+        return cache.load(func, jit_options)
+
+    def create_nlpsol(self, name, solver_name, nlp_dict, solver_opts):
+        """Creates a casadi nlpsol. If jit is on in solver_opts and the
+        compile_cache option is set, the functions compiled by the jit
+        are loaded from the CompileCache, see CompileCache.load_nlpsol.
+        With the background_jit option, an nlpsol without jit is
+        returned and the jit compiled nlpsol is swapped in when it is
+        ready."""
+        cache = self.options.get("compile_cache", None)
+        background = self.options.get("background_jit", False)
+        if not solver_opts.get("jit", False) or (cache is None
+                                                 and not background):
+            return cs.nlpsol(name, solver_name, nlp_dict, solver_opts)
+        if not background:
+            return cache.load_nlpsol(name, solver_name, nlp_dict,
+                                     solver_opts)
+        opts = dict(solver_opts)
+        opts["jit"] = False
+        par = nlp_dict.get("p", cs.MX.sym("p", 0))
+        nlp_func = cs.Function(name+"_nlp", [nlp_dict["x"], par],
+                               [nlp_dict["f"], nlp_dict["g"]],
+                               ["x", "p"], ["f", "g"])
+        solver = cs.nlpsol(name, solver_name, nlp_func, opts)
+        # The worker rebuilds its own copy of the problem function, as
+        # casadi objects are not safe to share between threads
+        serialized = nlp_func.serialize()
+        worker = self.get_background_jit()
+
+        def build_solver():
+            return worker.cache.load_nlpsol(
+                name, solver_name, cs.Function.deserialize(serialized),
+                solver_opts)
+        return worker.add_solver(solver, build_solver)
+
+    def get_background_jit(self):
+        """Returns the BackgroundJit worker of the controller."""
+        if getattr(self, "_background_jit", None) is None:
+            callback = self.options.get("jit_callback", None)
+            if callback is not None:
+                def on_swap(hot_swap):
+                    callback(self, hot_swap.label)
+            else:
+                on_swap = None
+            self._background_jit = BackgroundJit(
+                self.options.get("compile_cache", None),
+                on_swap
+            )
+        return self._background_jit
+
+    @property
+    def jit_ready(self):
+        """True when all functions compiled by the background_jit option
+        have been swapped in. A function that failed to compile stays
+        interpreted and keeps this False, see the errors of
+        get_background_jit."""
+        worker = getattr(self, "_background_jit", None)
+        return worker is None or worker.is_ready
+
+    def wait_for_jit(self, timeout=None):
+        """Blocks until all functions compiled by the background_jit
+        option have been swapped in, or timeout seconds have passed.
+        Returns jit_ready."""
+        worker = getattr(self, "_background_jit", None)
+        if worker is None:
+            return True
+        return worker.wait(timeout)
+
+    @staticmethod
+    def get_compile_cache(cache):
+        """Returns a CompileCache from the compile_cache option, which
+        can be None, a cache directory or a CompileCache."""
+        if cache is None or isinstance(cache, CompileCache):
+            return cache
+        return CompileCache(cache)
+
+    def hoist_constant_structure(self, name, list_vars, list_names,
+                                 exprs, expr_names, func_opts):
+        """Finds the nonzeros of the expressions that do not depend on
+        list_vars. These are evaluated once here. Expressions that are
+        entirely constant are left out of the per tick function, the
+        others get their constant nonzeros as literals so that nothing
+        upstream of them is evaluated per tick. See
+        eval_constant_structure.
+
+        Args:
+            name (str): name of the per tick function
+            list_vars (list): symbols the function depends on
+            list_names (list): names of the symbols
+            exprs (list): expressions to split
+            expr_names (list): names of the expressions
+            func_opts (dict): options of the function
+        Return:
+            dict: with "func" (cs.Function or None), "full_func"
+            (cs.Function with all the exprs as outputs), "outputs" and
+            "report"
+        """
+        all_vars = cs.vertcat(*list_vars)
+        exprs = [cs.MX(expr) for expr in exprs]
+        # Evaluate everything once, any input will do for the constants
+        full_func = cs.Function(name+"_setup", list_vars, exprs)
+        vals = full_func.call([cs.DM.zeros(var.sparsity())
+                               for var in list_vars])
+        outputs = []
+        varying_exprs = []
+        varying_names = []
+        report = {}
+        for expr, expr_name, val in zip(exprs, expr_names, vals):
+            if expr.nnz() > 0:
+                depends = cs.which_depends(expr.nz[:], all_vars, 1, True)
+            else:
+                depends = []
+            var_idx = [i for i, dep in enumerate(depends) if dep]
+            report[expr_name] = {"nnz": expr.nnz(),
+                                 "n_constant": expr.nnz() - len(var_idx)}
+            if len(var_idx) == 0:
+                outputs += [(True, val)]
+                continue
+            if len(var_idx) < expr.nnz():
+                # Constant nonzeros as literals
+                nz = cs.MX(val.nz[:])
+                nz[var_idx] = expr.nz[var_idx]
+                expr = cs.MX(expr.sparsity(), nz)
+            outputs += [(False, len(varying_exprs))]
+            varying_exprs += [expr]
+            varying_names += [expr_name]
+        if len(varying_exprs) > 0:
+            func = self.create_function(name, list_vars, varying_exprs,
+                                        list_names, varying_names, func_opts)
+        else:
+            func = None
+        hoisted = {"func": func,
+                   "outputs": outputs,
+                   "report": report}
+        # Function with all the outputs, for those who want them
+        full_exprs = [cs.MX(val) if is_const else varying_exprs[val]
+                      for is_const, val in outputs]
+        hoisted["full_func"] = self.create_function(name+"_full", list_vars,
+                                                    full_exprs, list_names,
+                                                    expr_names, func_opts)
+        return hoisted
+
+    def eval_constant_structure(self, hoisted, currvals):
+        """Evaluates expressions split by hoist_constant_structure. Only
+        the expressions with varying nonzeros are evaluated."""
+        func = hoisted["func"]
+        if func is None:
+            return [val for is_const, val in hoisted["outputs"]]
+        varying = func(*currvals)
+        if func.n_out() == 1:
+            varying = [varying]
+        return [val if is_const else varying[val]
+                for is_const, val in hoisted["outputs"]]
+
+    def print_constant_structure(self):
+        """Prints how many nonzeros of the problem functions were found to
+        be constant and are evaluated once during setup."""
+        sys.stdout.write(repr(self)+" constant structure:\n")
+        for hoisted in self.constant_structure.values():
+            for expr_name, info in hoisted["report"].items():
+                sys.stdout.write("\t"+expr_name+": "
+                                 + str(info["n_constant"])+"/"
+                                 + str(info["nnz"])+" constant\n")
+        sys.stdout.flush()
+
+    def get_fast_function(self):
+        """Returns the function used by solve_into and a list of its
+        (input, output) pairs that are fed back between calls. The
+        inputs are named like the skill variables, and the outputs are
+        robot_vel_var, virtual_vel_var and slack_var."""
+        raise NotImplementedError(self.controller_type+" does not have a"
+                                  + " fast path.")
+
+    def setup_fast_path(self):
+        """Sets up the buffers used by solve_into. This is done on the
+        first call to solve_into, and again when the functions compiled
+        by the background_jit option are ready."""
+        func, feedback = self.get_fast_function()
+        buffered = BufferedFunction(func)
+        self._fast_path = self.get_fast_path_indices(buffered)
+        self._fast_path["funcs"] = [buffered]
+        self._fast_path["feedback"] = [(buffered.index_in(name_in),
+                                        buffered.index_out(name_out))
+                                       for name_in, name_out in feedback]
+        return self._fast_path
+
+    def get_fast_path_indices(self, buffered):
+        """Returns a dict with the indices of the skill variables in the
+        inputs and outputs of the BufferedFunction."""
+        return {
+            "jit_ready": self.jit_ready,
+            "time_var": buffered.index_in("time_var"),
+            "robot_var": buffered.index_in("robot_var"),
+            "virtual_var": buffered.index_in("virtual_var"),
+            "input_var": buffered.index_in("input_var"),
+            "robot_vel_var": buffered.index_out("robot_vel_var"),
+            "virtual_vel_var": buffered.index_out("virtual_vel_var"),
+            "slack_var": buffered.index_out("slack_var")
+        }
+
+    def get_fast_path(self):
+        """Returns the fast path, setting it up if needed."""
+        fast_path = getattr(self, "_fast_path", None)
+        if fast_path is None or (not fast_path["jit_ready"]
+                                 and self.jit_ready):
+            fast_path = self.setup_fast_path()
+        return fast_path
+
+    def eval_fast_path(self, fast_path):
+        """Evaluates the fast path after the inputs are copied in. Returns
+        the number of modes checked for controllers with modes."""
+        func = fast_path["funcs"][0]
+        func()
+        for idx_in, idx_out in fast_path["feedback"]:
+            cs.np.copyto(func.args[idx_in], func.res[idx_out])
+
+    def solve_into(self, time_var,
+                   robot_var,
+                   virtual_var=None,
+                   input_var=None,
+                   robot_vel_out=None,
+                   virtual_vel_out=None,
+                   slack_out=None):
+        """Solve the skill specification from and into numpy arrays.
+
+        This is a fast path of solve for high rate control loops. The
+        inputs are copied into preallocated buffers, best given as
+        float64 arrays of shape (n,), and the results are written into
+        the *_out arrays, which must be contiguous float64 arrays. When
+        an *_out array is not given, an internal buffer is used, which
+        is overwritten by the next call. Once the arrays are in place,
+        calls do not allocate any casadi or numpy objects. Explicit
+        warmstarts are not supported.
+
+        Return:
+            tuple: (robot_vel, virtual_vel, slack) as numpy arrays,
+            virtual_vel and slack can be None.
+        """
+        instr = self.instrumentation
+        if instr is not None:
+            t_start = instr.clock()
+        fast_path = self.get_fast_path()
+        funcs = fast_path["funcs"]
+        args = funcs[0].args
+        args[fast_path["time_var"]][0] = time_var
+        cs.np.copyto(args[fast_path["robot_var"]], robot_var)
+        if virtual_var is not None and fast_path["virtual_var"] is not None:
+            cs.np.copyto(args[fast_path["virtual_var"]], virtual_var)
+        if input_var is not None and fast_path["input_var"] is not None:
+            cs.np.copyto(args[fast_path["input_var"]], input_var)
+        outs = []
+        for name, out in [("robot_vel_var", robot_vel_out),
+                          ("virtual_vel_var", virtual_vel_out),
+                          ("slack_var", slack_out)]:
+            idx = fast_path[name]
+            if idx is None or funcs[0].func.nnz_out(idx) == 0:
+                outs += [None]
+                continue
+            if out is not None:
+                for func in funcs:
+                    func.set_res(idx, out)
+            outs += [funcs[0].res[idx]]
+        if instr is None:
+            self.eval_fast_path(fast_path)
+            return outs[0], outs[1], outs[2]
+        # The solver is inside the fast path, so it is all eval
+        t_eval = instr.clock()
+        n_modes_checked = self.eval_fast_path(fast_path)
+        eval_time = instr.clock() - t_eval
+        if n_modes_checked is not None:
+            instr.record("n_modes_checked", n_modes_checked)
+            instr.count("mode", self.current_mode)
+        self.record_tick(instr, t_start, eval_time)
+        return outs[0], outs[1], outs[2]
@@ -1,10 +1,12 @@
 """Model predictive controller, see class doc.
 """
 
+import numpy as np
 import casadi as cs
 from casclik.constraints import EqualityConstraint, SetConstraint
 from casclik.constraints import VelocityEqualityConstraint, VelocitySetConstraint
 from casclik.controllers.base_controller import BaseController
+from casclik.buffered_function import BufferedFunction
 
 
 class ModelPredictiveController(BaseController):
@@ -28,8 +30,55 @@ class ModelPredictiveController(BaseController):
     options_info = """TODO
     solver_opt (dict): solver options, see casadi.
     cost_integration_method (str): rectangle, trapezoidal, or simpson. default=trapezoidal.
+    compile_cache (CompileCache, str): cache of the jit compiled
+        functions, or its directory, default None.
+    background_jit (bool): start with functions without jit, and swap
+        in the jit compiled functions and solver when they are compiled
+        in a background thread, default False. See jit_ready.
+    jit_callback (callable): called as jit_callback(controller, name)
+        when a jit compiled function is swapped in, default None.
+    shifted_warmstart (bool): start each solve from the previous
+        solution and multipliers shifted one step along the horizon,
+        with the last step extrapolated, default False. Turns on the
+        warm start options of ipopt. See get_shifted_warmstart.
+    horizon_parallelization (str): build the horizon from one stage
+        function mapped over it, with parallelization "serial",
+        "unroll", "thread" or "openmp", default None for unrolling it
+        in python. See get_mapped_horizon.
+    rti (bool): real-time iterations, solve one QP linearised around
+        the shifted previous solution per tick instead of the NLP,
+        default False. See prepare and feedback.
+    rti_qpsol (str): conic solver of the real-time iterations, default
+        "qpoases".
+    rti_qpsol_opts (dict): options of the rti_qpsol, see casadi.
+    linear_quadratic (bool): solve the MPC problem as a QP with the
+        lq_qpsol instead of the solver_name nlpsol, see
+        get_linear_quadratic_problem, default False. Raises a
+        ValueError when the problem is not linear-quadratic, or when
+        combined with rti or shifted_warmstart, as they only apply to
+        the NLP.
+    lq_condensed (bool): eliminate the states from the QP of the
+        linear_quadratic option, which gives a small dense QP suited
+        for short horizons, default False.
+    lq_qpsol (str): conic solver of the linear_quadratic option, default
+        the sparse "qrqp", or "qpoases" with lq_condensed. The stage
+        structure is passed to "hpipm", which solve_into calls between
+        two functions, see setup_staged_fast_path.
+    lq_qpsol_opts (dict): options of the lq_qpsol, see casadi.
+    move_blocking (list): lengths of the blocks of steps over which the
+        robot_vel_var and virtual_vel_var are held constant, summing to
+        the horizon_length, or an int for blocks of that length,
+        default None. See get_opt_var_indices.
+    variable_horizon (bool): build the MPC problem with horizon_length
+        as the maximum horizon, with the active horizon length and the
+        timestep of each step as parameters that can be changed
+        without rebuilding it, default False. See set_horizon.
     """
     weight_shifter = 0.001
+    linear_quadratic = False  # See setup_solver
+    _warmstart = None  # See get_shifted_warmstart
+    _rti = None  # See prepare
+    _horizon_pars = None  # See set_horizon
 
     def __init__(self, skill_spec,
                  cost_expr=None,
@@ -106,7 +155,7 @@ class ModelPredictiveController(BaseController):
             weights_list = []
             for cnstr in self.skill_spec.constraints:
                 if cnstr.constraint_type == "soft":
-                    ones = cs.np.ones(cnstr.expression.size()[0])
+                    ones = np.ones(cnstr.expression.size()[0])
                     weights_list += [cs.mtimes(cnstr.slack_weight, ones)]
             weights = cs.vertcat(*weights_list)
         elif isinstance(weights, cs.GenericCommonMatrix):
@@ -115,7 +164,7 @@ class ModelPredictiveController(BaseController):
             elif weights.size1 != self.skill_spec.n_slack_var:
                 raise ValueError("slack_var_weights and slack_var dimensions"
                                  + " do not match.")
-        elif isinstance(weights, (list, cs.np.ndarray)):
+        elif isinstance(weights, (list, np.ndarray)):
             if len(weights) != self.skill_spec.n_slack_var:
                 raise ValueError("slack_var_weights and slack_var dimensions"
                                  + " do not match")
@@ -164,6 +213,14 @@ class ModelPredictiveController(BaseController):
             opt["solver_opts"] = {}
         if "cost_integration_method" not in opt:
             opt["cost_integration_method"] = "rectangle"
+        if "shifted_warmstart" not in opt:
+            opt["shifted_warmstart"] = False
+        if "horizon_parallelization" not in opt:
+            opt["horizon_parallelization"] = None
+        if opt["horizon_parallelization"] not in [None, "serial", "unroll",
+                                                  "thread", "openmp"]:
+            raise ValueError("Unknown horizon_parallelization: "
+                             + str(opt["horizon_parallelization"]))
         solver_opts = opt["solver_opts"]
         if "print_time" not in solver_opts:
             solver_opts["print_time"] = False
@@ -191,6 +248,18 @@ class ModelPredictiveController(BaseController):
                 solver_opts["jit"] = True
             if "jit_options" not in solver_opts:
                 solver_opts["jit_options"] = {"flags": "-Ofast"}
+            if opt["shifted_warmstart"]:
+                ipopt_opts = solver_opts["ipopt"]
+                if "warm_start_init_point" not in ipopt_opts:
+                    ipopt_opts["warm_start_init_point"] = "yes"
+                # Keep the shifted point instead of pushing it inwards
+                for name in ["warm_start_bound_push",
+                             "warm_start_bound_frac",
+                             "warm_start_slack_bound_push",
+                             "warm_start_slack_bound_frac",
+                             "warm_start_mult_bound_push"]:
+                    if name not in ipopt_opts:
+                        ipopt_opts[name] = 1e-9
 
         if opt["solver_name"] == "scpgen":
             if "print_header" not in solver_opts:
@@ -216,19 +285,68 @@ class ModelPredictiveController(BaseController):
             function_opts["print_time"] = False
         if "jit_options" not in function_opts:
             function_opts["jit_options"] = {"flags": "-O2"}
+        if "rti" not in opt:
+            opt["rti"] = False
+        if "rti_qpsol" not in opt:
+            opt["rti_qpsol"] = "qpoases"
+        if "rti_qpsol_opts" not in opt:
+            opt["rti_qpsol_opts"] = {}
+        rti_qpsol_opts = opt["rti_qpsol_opts"]
+        if "print_time" not in rti_qpsol_opts:
+            rti_qpsol_opts["print_time"] = False
+        if opt["rti_qpsol"] == "qpoases":
+            if "printLevel" not in rti_qpsol_opts:
+                rti_qpsol_opts["printLevel"] = "none"
+        if "linear_quadratic" not in opt:
+            opt["linear_quadratic"] = False
+        if opt["linear_quadratic"] and (opt["rti"]
+                                        or opt["shifted_warmstart"]):
+            raise ValueError("The linear_quadratic option can not be"
+                             + " combined with the rti or"
+                             + " shifted_warmstart options.")
+        if "lq_condensed" not in opt:
+            opt["lq_condensed"] = False
+        if "lq_qpsol" not in opt:
+            if opt["lq_condensed"]:
+                opt["lq_qpsol"] = "qpoases"
+            else:
+                opt["lq_qpsol"] = "qrqp"
+        if "lq_qpsol_opts" not in opt:
+            opt["lq_qpsol_opts"] = {}
+        lq_qpsol_opts = opt["lq_qpsol_opts"]
+        if "print_time" not in lq_qpsol_opts:
+            lq_qpsol_opts["print_time"] = False
+        if opt["lq_qpsol"] == "qpoases":
+            if "printLevel" not in lq_qpsol_opts:
+                lq_qpsol_opts["printLevel"] = "none"
+        elif opt["lq_qpsol"] == "qrqp":
+            for name in ["print_header", "print_iter", "print_info"]:
+                if name not in lq_qpsol_opts:
+                    lq_qpsol_opts[name] = False
+        if "move_blocking" not in opt:
+            opt["move_blocking"] = None
+        if "variable_horizon" not in opt:
+            opt["variable_horizon"] = False
+        opt["compile_cache"] = self.get_compile_cache(
+            opt.get("compile_cache", None))
+        if "background_jit" not in opt:
+            opt["background_jit"] = False
+        if "jit_callback" not in opt:
+            opt["jit_callback"] = None
         self._options = opt
 
     def get_cost_integrand_function(self):
         """Returns a casadi function for the discretized integrand of
         the cost expression integrated one timestep. For the rectangle
-        method, this just amounts to timing by the timestep.
+        method, this just amounts to timing by the timestep, which is
+        the last input so that it can vary along the horizon.
 
         As with the other controllers, the cost is affected by the
         weight shifter, giving a regularised cost with the slack
         variables.
         """
         # Setup new symbols needed
-        dt = self.timestep
+        dt = cs.MX.sym("timestep")
         # Setup skill_spec symbols
         time_var = self.skill_spec.time_var
         robot_var = self.skill_spec.robot_var
@@ -251,6 +369,8 @@ class ModelPredictiveController(BaseController):
         # Full symbol list same way as in other controllers
         list_vars += cntrl_vars
         list_names += cntrl_names
+        list_vars += [dt]
+        list_names += ["timestep"]
 
         # Expression for the cost with regularisation:
         if slack_var is not None:
@@ -316,17 +436,18 @@ class ModelPredictiveController(BaseController):
         list_vars += cntrl_vars
         list_names += cntrl_names
         # Loop over the constraints
+        spec = self.skill_spec  # Caches the derivatives
         for cnstr in self.skill_spec.constraints:
             expr_size = cnstr.expression.size()
             # What's the partials?
-            cnstr_expr = cnstr.jtimes(robot_var,
-                                      robot_vel_var)
+            cnstr_expr = spec.jtimes(cnstr.expression,
+                                     robot_var, robot_vel_var)
             if virtual_var is not None:
-                cnstr_expr += cnstr.jtimes(virtual_var,
-                                           virtual_vel_var)
+                cnstr_expr += spec.jtimes(cnstr.expression,
+                                          virtual_var, virtual_vel_var)
             # Everyone wants a feedforward in numerics
-            lb_cnstr_expr = -cnstr.jacobian(time_var)
-            ub_cnstr_expr = -cnstr.jacobian(time_var)
+            lb_cnstr_expr = -spec.jacobian(cnstr.expression, time_var)
+            ub_cnstr_expr = -spec.jacobian(cnstr.expression, time_var)
             # Setup bounds based on type
             if isinstance(cnstr, EqualityConstraint):
                 lb_cnstr_expr += -cs.mtimes(cnstr.gain, cnstr.expression)
@@ -399,15 +520,16 @@ class ModelPredictiveController(BaseController):
         list_vars += cntrl_vars
         list_names += cntrl_names
         # Loop over the constraints
+        spec = self.skill_spec  # Caches the derivatives
         for cnstr in self.skill_spec.constraints:
             expr_size = cnstr.expression.size()
             # Here we construct the whole time derivative
-            cnstr_expr = cnstr.jacobian(time_var)
-            cnstr_expr += cnstr.jtimes(robot_var,
-                                       robot_vel_var)
+            cnstr_expr = spec.jacobian(cnstr.expression, time_var)
+            cnstr_expr += spec.jtimes(cnstr.expression,
+                                      robot_var, robot_vel_var)
             if virtual_var is not None:
-                cnstr_expr += cnstr.jtimes(virtual_var,
-                                           virtual_vel_var)
+                cnstr_expr += spec.jtimes(cnstr.expression,
+                                          virtual_var, virtual_vel_var)
             cnstr_expr2 = None  # We will need this in the sets
             # Then we evaluate the type of constraint
             if isinstance(cnstr, EqualityConstraint):
@@ -423,7 +545,7 @@ class ModelPredictiveController(BaseController):
                 # cnstr_expr is lower, cnstr_expr2 is upper
 
                 # Avoid infs in evaluated constraint expressions
-                if isinstance(cnstr.set_min, (list, cs.np.ndarray)):
+                if isinstance(cnstr.set_min, (list, np.ndarray)):
                     set_min = cnstr.set_min
                     for idx, item in enumerate(cnstr.set_min):
                         set_min[idx] = max(cnstr.set_min[idx], -1e20)
@@ -431,7 +553,7 @@ class ModelPredictiveController(BaseController):
                     set_min = max(cnstr.set_min, -1e20)
                 else:  # Pass it along and hope for the best
                     set_min = cnstr.set_min
-                if isinstance(cnstr.set_max, (list, cs.np.ndarray)):
+                if isinstance(cnstr.set_max, (list, np.ndarray)):
                     set_max = cnstr.set_max
                     for idx, item in enumerate(cnstr.set_max):
                         set_max[idx] = min(cnstr.set_max[idx], 1e20)
@@ -485,6 +607,197 @@ class ModelPredictiveController(BaseController):
                                     [], ["cnstr_ub"])
         return cnstr_func, lb_cnstr_func, ub_cnstr_func
 
+    def get_move_blocks(self):
+        """Returns the lengths of the blocks of the move_blocking option,
+        or a block for each step without it."""
+        n_steps = self.horizon_length
+        blocks = self.options["move_blocking"]
+        if blocks is None:
+            return [1]*n_steps
+        if isinstance(blocks, int):
+            if blocks < 1:
+                raise ValueError("move_blocking must be positive, it is "
+                                 + str(blocks) + ".")
+            blocks = [blocks]*(n_steps//blocks) + [n_steps % blocks]
+            blocks = [length for length in blocks if length > 0]
+        if len(blocks) == 0 or min(blocks) < 1 or sum(blocks) != n_steps:
+            raise ValueError("move_blocking must be positive block lengths"
+                             + " summing to the horizon_length "
+                             + str(n_steps) + ", it is "
+                             + str(self.options["move_blocking"]) + ".")
+        return blocks
+
+    def get_opt_var_indices(self):
+        """Returns the indices of the variables of each step in the MPC
+        opt_var, which is [time_var0, state0, (slack, vel, state) for each
+        step], with the robot_var and virtual_var as the state and their
+        velocities as vel. With the move_blocking option, vel is only in
+        the first step of each block, and the other steps of the block
+        share its indices.
+
+        Return:
+            dict: lists "slack", "vel" and "state" with the indices of
+            each step, where "state" starts with state0, and
+            "block_start" telling which steps have their own vel.
+        """
+        nrob = self.skill_spec.n_robot_var
+        nvirt = self.skill_spec.n_virtual_var
+        nslack = self.skill_spec.n_slack_var
+        n_state = nrob + nvirt
+        block_start = []
+        for length in self.get_move_blocks():
+            block_start += [True] + [False]*(length - 1)
+        indices = {"slack": [],
+                   "vel": [],
+                   "state": [list(range(1, 1 + n_state))],
+                   "block_start": block_start}
+        idx = 1 + n_state
+        for k in range(self.horizon_length):
+            indices["slack"] += [list(range(idx, idx + nslack))]
+            idx += nslack
+            if block_start[k]:
+                vel = list(range(idx, idx + n_state))
+                idx += n_state
+            indices["vel"] += [vel]
+            indices["state"] += [list(range(idx, idx + n_state))]
+            idx += n_state
+        return indices
+
+    def get_stage_function(self, fcost_integrand, fcnstr):
+        """Returns a function of one step of the horizon, with the time,
+        the timestep, the state, i.e. the robot_var and virtual_var, and
+        the stage variables as inputs. The stage variables are the
+        slack_var, the robot_vel_var, the virtual_vel_var and the state
+        of the next step. The outputs are the cost integrand and the
+        constraints, followed by the shooting gap."""
+        nrob = self.skill_spec.n_robot_var
+        nvirt = self.skill_spec.n_virtual_var
+        nslack = self.skill_spec.n_slack_var
+        n_state = nrob + nvirt
+        time_var = cs.MX.sym("time_var")
+        dt = cs.MX.sym("timestep")
+        state_var = cs.MX.sym("state_var", n_state)
+        stage_var = cs.MX.sym("stage_var", nslack + 2*n_state)
+        vel_var = stage_var[nslack:nslack+n_state]
+        next_state_var = stage_var[nslack+n_state:]
+        list_vars = [time_var, state_var[:nrob]]
+        if nvirt > 0:
+            list_vars += [state_var[nrob:]]
+        if nslack > 0:
+            list_vars += [stage_var[:nslack]]
+        list_vars += [vel_var[:nrob]]
+        if nvirt > 0:
+            list_vars += [vel_var[nrob:]]
+        cost = fcost_integrand(*(list_vars + [dt]))
+        cnstr = cs.vertcat(fcnstr(*list_vars),
+                           state_var + vel_var*dt - next_state_var)
+        return cs.Function("stage", [time_var, dt, state_var, stage_var],
+                           [cost, cnstr],
+                           ["time_var", "timestep", "state_var",
+                            "stage_var"],
+                           ["cost", "cnstr"])
+
+    def get_mapped_horizon(self, time_vars, timesteps, state_var0,
+                           list_pars, fcost_integrand, reactive_funcs,
+                           predictive_funcs, parallelization):
+        """Returns the horizon of the MPC problem built with the stage
+        function, see get_stage_function, instead of unrolling it. The
+        first step has the reactive constraints, the remaining steps
+        are one predictive stage function mapped over the horizon with
+        parallelization "serial", "unroll", "thread" or "openmp". The
+        opt_var and constraints are ordered as in the unrolled horizon.
+
+        Return:
+            dict: "x", "costs" of each step, "g", "lbg" and "ubg" of
+            the horizon
+        """
+        nrob = self.skill_spec.n_robot_var
+        nvirt = self.skill_spec.n_virtual_var
+        nslack = self.skill_spec.n_slack_var
+        n_state = nrob + nvirt
+        n_steps = self.horizon_length
+        block_start = self.get_opt_var_indices()["block_start"]
+        # One column of stage variables per step
+        opt_vars = []
+        stage_cols = []
+        for k in range(n_steps):
+            stage_col = []
+            if nslack > 0:
+                slack_var = cs.MX.sym("slack_var"+str(k), nslack)
+                opt_vars += [slack_var]
+                stage_col += [slack_var]
+            if block_start[k]:
+                vel_var = cs.MX.sym("vel_var"+str(k), n_state)
+                opt_vars += [vel_var]
+            state_var = cs.MX.sym("state_var"+str(k+1), n_state)
+            opt_vars += [state_var]
+            stage_cols += [cs.vertcat(*(stage_col + [vel_var, state_var]))]
+        stage_vars = cs.horzcat(*stage_cols)
+        gap_zeros = cs.DM.zeros(n_state)
+        fstage = self.get_stage_function(fcost_integrand, reactive_funcs[0])
+        cost, cnstr = fstage(time_vars[0], timesteps[0], state_var0,
+                             stage_vars[:, 0])
+        costs = [cost]
+        cnstrs = [cnstr]
+        lbg = [reactive_funcs[1](*list_pars), gap_zeros]
+        ubg = [reactive_funcs[2](*list_pars), gap_zeros]
+        if n_steps > 1:
+            fstage = self.get_stage_function(fcost_integrand,
+                                             predictive_funcs[0])
+            fstage_map = fstage.map(n_steps - 1, parallelization)
+            state_vars = stage_vars[nslack+n_state:, :n_steps-1]
+            costs_map, cnstrs_map = fstage_map(
+                cs.horzcat(*time_vars[1:n_steps]),
+                cs.horzcat(*timesteps[1:n_steps]),
+                state_vars, stage_vars[:, 1:])
+            costs += [costs_map]
+            cnstrs += [cs.vec(cnstrs_map)]
+            lb_pred = cs.vertcat(predictive_funcs[1]()["cnstr_lb"],
+                                 gap_zeros)
+            ub_pred = cs.vertcat(predictive_funcs[2]()["cnstr_ub"],
+                                 gap_zeros)
+            lbg += [cs.repmat(lb_pred, n_steps - 1, 1)]
+            ubg += [cs.repmat(ub_pred, n_steps - 1, 1)]
+        return {"x": cs.vertcat(*opt_vars),
+                "costs": cs.horzcat(*costs),
+                "g": cs.vertcat(*cnstrs),
+                "lbg": cs.vertcat(*lbg),
+                "ubg": cs.vertcat(*ubg)}
+
+    def get_horizon_masks(self, horizon_pars, opt_var, costs, n_cnstr):
+        """Returns the cost and the mask of the constraints of the
+        variable_horizon option. The first element of horizon_pars is
+        the active horizon length, and the steps after it only minimise
+        their own slacks and velocities with the weight_shifter. The
+        constraints of those steps, except the shooting gaps, are to be
+        masked out of the bounds. n_cnstr has the number of "reactive"
+        and "predictive" constraints, as in mpc_problem.
+
+        Return:
+            tuple: (cost, cnstr_mask) with the masked sum of the costs
+            of each step and a mask over the MPC constraints
+        """
+        n_state = self.skill_spec.n_robot_var + self.skill_spec.n_virtual_var
+        n_reactive = n_cnstr["reactive"]
+        n_predictive = n_cnstr["predictive"]
+        indices = self.get_opt_var_indices()
+        own_vars = []
+        for k in range(self.horizon_length):
+            own = indices["slack"][k]
+            if indices["block_start"][k]:
+                own = own + indices["vel"][k]
+            own_vars += [cs.sumsqr(opt_var[own])]
+        # The first step is always active
+        masks = cs.vertcat(1., *[horizon_pars[0] > k
+                                 for k in range(1, self.horizon_length)])
+        cost = cs.dot(masks, costs.T)
+        cost += self.weight_shifter*cs.dot(1 - masks, cs.vertcat(*own_vars))
+        cnstr_mask = [cs.DM.ones(1 + 2*n_state + n_reactive)]
+        for k in range(1, self.horizon_length):
+            cnstr_mask += [cs.repmat(masks[k], n_predictive, 1),
+                           cs.DM.ones(n_state)]
+        return cost, cs.vertcat(*cnstr_mask)
+
     def setup_problem_functions(self):
         """Sets up the relevant casadi functions and expressions for the
         MPC NLP problem.
@@ -506,14 +819,16 @@ class ModelPredictiveController(BaseController):
         nrob = self.skill_spec.n_robot_var
         nvirt = self.skill_spec.n_virtual_var
         nslack = self.skill_spec.n_slack_var
+        n_steps = self.horizon_length
         dt = self.timestep
+        block_start = self.get_opt_var_indices()["block_start"]
 
         # Where the MPC problem formulation is stored:
         mpc_opt_vars = []
         mpc_cnstrs = []
         mpc_cnstr_lb = []
         mpc_cnstr_ub = []
-        mpc_cost = 0.0
+        mpc_costs = []
 
         # Initial step
         time_var0 = cs.MX.sym("time_var0")
@@ -546,64 +861,117 @@ class ModelPredictiveController(BaseController):
             mpc_cnstr_ub += [measured_virtual_var0]
             list_pars += [measured_virtual_var0]
             list_par_names += ["virtual_var0"]
-        # Loop over the horizon
-        for k in range(self.horizon_length):
-            # Control input this step
-            cntrl_vars_k = []
-            if nslack > 0:
-                slack_var_k = cs.MX.sym("slack_var"+str(k), nslack)
-                cntrl_vars_k += [slack_var_k]
-            robot_vel_var_k = cs.MX.sym("robot_vel_var"+str(k), nrob)
-            cntrl_vars_k += [robot_vel_var_k]
-            if nvirt > 0:
-                virtual_vel_var_k = cs.MX.sym("virtual_vel_var"+str(k), nvirt)
-                cntrl_vars_k += [virtual_vel_var_k]
-            mpc_opt_vars += cntrl_vars_k
-            # Cost for step
-            mpc_cost += fcost_integrand(*(list_vars_k+cntrl_vars_k))
-            # Task constraints
-            if k == 0:
-                mpc_cnstrs += [fcnstr_reactive(*(list_vars_k+cntrl_vars_k))]
-                mpc_cnstr_lb += [flb_cnstr_reactive(*(list_pars))]
-                mpc_cnstr_ub += [fub_cnstr_reactive(*(list_pars))]
-            else:
-                mpc_cnstrs += [fcnstr_predictive(*(list_vars_k+cntrl_vars_k))]
-                mpc_cnstr_lb += [flb_cnstr_predictive()["cnstr_lb"]]
-                mpc_cnstr_ub += [fub_cnstr_predictive()["cnstr_ub"]]
-            # Prediction step
-            robot_var_p = robot_var_k + robot_vel_var_k*dt
-            if nvirt > 0:
-                virtual_var_p = virtual_var_k + virtual_vel_var_k*dt
-            # Symbols for states in next step
-            robot_var_k = cs.MX.sym("robot_var"+str(k+1), nrob)
-            list_vars_k = [time_var0+dt*(k+1), robot_var_k]
-            mpc_opt_vars += [robot_var_k]
-            if nvirt > 0:
-                virtual_var_k = cs.MX.sym("virtual_var"+str(k+1), nvirt)
-                list_vars_k += [virtual_var_k]
-                mpc_opt_vars += [virtual_var_k]
-            # Shooting gap constraint
-            mpc_cnstrs += [robot_var_p - robot_var_k]
-            mpc_cnstr_lb += [0.]*nrob
-            mpc_cnstr_ub += [0.]*nrob
-            if nvirt > 0:
-                mpc_cnstrs += [virtual_var_p - virtual_var_k]
-                mpc_cnstr_lb += [0.]*nvirt
-                mpc_cnstr_ub += [0.]*nvirt
+        # Time and timestep of each step, with the variable_horizon
+        # option the timesteps and active horizon length are parameters
+        if self.options["variable_horizon"]:
+            horizon_pars = cs.MX.sym("horizon_pars", 1 + n_steps)
+            timesteps = [horizon_pars[1+k] for k in range(n_steps)]
+            time_vars = [time_var0]
+            for k in range(n_steps):
+                time_vars += [time_vars[k] + timesteps[k]]
+        else:
+            horizon_pars = None
+            timesteps = [dt]*n_steps
+            time_vars = [time_var0] + [time_var0+dt*(k+1)
+                                       for k in range(n_steps)]
+        parallelization = self.options["horizon_parallelization"]
+        if parallelization is not None:
+            horizon = self.get_mapped_horizon(
+                time_vars, timesteps, cs.vertcat(*list_vars_k[1:]),
+                list_pars, fcost_integrand, all_cnstr_funcs_reactive,
+                all_cnstr_funcs_predictive, parallelization)
+            mpc_opt_vars += [horizon["x"]]
+            mpc_costs += [horizon["costs"]]
+            mpc_cnstrs += [horizon["g"]]
+            mpc_cnstr_lb += [horizon["lbg"]]
+            mpc_cnstr_ub += [horizon["ubg"]]
+        else:
+            # Loop over the horizon
+            for k in range(n_steps):
+                # Control input this step, the velocities are held over
+                # the block with the move_blocking option
+                cntrl_vars_k = []
+                if nslack > 0:
+                    slack_var_k = cs.MX.sym("slack_var"+str(k), nslack)
+                    cntrl_vars_k += [slack_var_k]
+                    mpc_opt_vars += [slack_var_k]
+                if block_start[k]:
+                    robot_vel_var_k = cs.MX.sym("robot_vel_var"+str(k),
+                                                nrob)
+                    mpc_opt_vars += [robot_vel_var_k]
+                    if nvirt > 0:
+                        virtual_vel_var_k = cs.MX.sym(
+                            "virtual_vel_var"+str(k), nvirt)
+                        mpc_opt_vars += [virtual_vel_var_k]
+                cntrl_vars_k += [robot_vel_var_k]
+                if nvirt > 0:
+                    cntrl_vars_k += [virtual_vel_var_k]
+                # Cost for step
+                mpc_costs += [fcost_integrand(*(list_vars_k + cntrl_vars_k
+                                                + [timesteps[k]]))]
+                # Task constraints
+                if k == 0:
+                    mpc_cnstrs += [fcnstr_reactive(*(list_vars_k
+                                                     + cntrl_vars_k))]
+                    mpc_cnstr_lb += [flb_cnstr_reactive(*(list_pars))]
+                    mpc_cnstr_ub += [fub_cnstr_reactive(*(list_pars))]
+                else:
+                    mpc_cnstrs += [fcnstr_predictive(*(list_vars_k
+                                                       + cntrl_vars_k))]
+                    mpc_cnstr_lb += [flb_cnstr_predictive()["cnstr_lb"]]
+                    mpc_cnstr_ub += [fub_cnstr_predictive()["cnstr_ub"]]
+                # Prediction step
+                robot_var_p = robot_var_k + robot_vel_var_k*timesteps[k]
+                if nvirt > 0:
+                    virtual_var_p = (virtual_var_k
+                                     + virtual_vel_var_k*timesteps[k])
+                # Symbols for states in next step
+                robot_var_k = cs.MX.sym("robot_var"+str(k+1), nrob)
+                list_vars_k = [time_vars[k+1], robot_var_k]
+                mpc_opt_vars += [robot_var_k]
+                if nvirt > 0:
+                    virtual_var_k = cs.MX.sym("virtual_var"+str(k+1), nvirt)
+                    list_vars_k += [virtual_var_k]
+                    mpc_opt_vars += [virtual_var_k]
+                # Shooting gap constraint
+                mpc_cnstrs += [robot_var_p - robot_var_k]
+                mpc_cnstr_lb += [0.]*nrob
+                mpc_cnstr_ub += [0.]*nrob
+                if nvirt > 0:
+                    mpc_cnstrs += [virtual_var_p - virtual_var_k]
+                    mpc_cnstr_lb += [0.]*nvirt
+                    mpc_cnstr_ub += [0.]*nvirt
         # And thus we have peered across the horizon and seen it all
         mpc_cnstrs_expr = cs.vertcat(*mpc_cnstrs)
         mpc_cnstr_lb_expr = cs.vertcat(*mpc_cnstr_lb)
         mpc_cnstr_ub_expr = cs.vertcat(*mpc_cnstr_ub)
         mpc_opt_vars_expr = cs.vertcat(*mpc_opt_vars)
+        n_cnstr = {"reactive": fcnstr_reactive.size1_out(0),
+                   "predictive": fcnstr_predictive.size1_out(0)}
+        if horizon_pars is None:
+            mpc_cost = cs.sum2(cs.horzcat(*mpc_costs))
+        else:
+            # Mask out the steps after the active horizon length
+            mpc_cost, cnstr_mask = self.get_horizon_masks(
+                horizon_pars, mpc_opt_vars_expr, cs.horzcat(*mpc_costs),
+                n_cnstr)
+            inf = cs.inf*cs.DM.ones(cnstr_mask.shape)
+            mpc_cnstr_lb_expr = cs.if_else(cnstr_mask, mpc_cnstr_lb_expr,
+                                           -inf)
+            mpc_cnstr_ub_expr = cs.if_else(cnstr_mask, mpc_cnstr_ub_expr,
+                                           inf)
+            list_pars += [horizon_pars]
+            list_par_names += ["horizon_pars"]
         # Let's make functions for lb and ub
-        mpc_cnstr_lb_func = cs.Function("lb_cnstr", list_pars,
-                                        [mpc_cnstr_lb_expr],
-                                        list_par_names, ["lb_cnstr"],
-                                        self.options["function_opts"])
-        mpc_cnstr_ub_func = cs.Function("ub_cnstr", list_pars,
-                                        [mpc_cnstr_ub_expr],
-                                        list_par_names, ["ub_cnstr"],
-                                        self.options["function_opts"])
+        func_opts = self.options["function_opts"]
+        mpc_cnstr_lb_func = self.create_function("lb_cnstr", list_pars,
+                                                 [mpc_cnstr_lb_expr],
+                                                 list_par_names, ["lb_cnstr"],
+                                                 func_opts)
+        mpc_cnstr_ub_func = self.create_function("ub_cnstr", list_pars,
+                                                 [mpc_cnstr_ub_expr],
+                                                 list_par_names, ["ub_cnstr"],
+                                                 func_opts)
         self.mpc_problem = {
             "nlp": {
                 "x": mpc_opt_vars_expr,
@@ -613,16 +981,322 @@ class ModelPredictiveController(BaseController):
             "num": {
                 "lb": mpc_cnstr_lb_func,
                 "ub": mpc_cnstr_ub_func
-            }
+            },
+            "n_cnstr": n_cnstr
         }
+        self._warmstart = None
+        self._rti = None
+        self._horizon_pars = None
+        if horizon_pars is not None:
+            self.mpc_problem["nlp"]["p"] = horizon_pars
+            self._horizon_pars = cs.vertcat(n_steps,
+                                            cs.DM.ones(n_steps)*dt)
 
     def setup_solver(self):
         # Setup relevant functions and expressions
         self.setup_problem_functions()
-        self.solver = cs.nlpsol("solver",
-                                self.options["solver_name"],
-                                self.mpc_problem["nlp"],
-                                self.options["solver_opts"])
+        self._fast_path = None  # Set up again by solve_into
+        self.linear_quadratic = False
+        if self.options["linear_quadratic"]:
+            lq_problem = self.get_linear_quadratic_problem(
+                self.options["lq_condensed"])
+            if lq_problem is not None:
+                self.setup_lq_solver(lq_problem)
+                return
+            raise ValueError("The MPC problem of "+self.skill_spec.label
+                             + " is not linear-quadratic, the cost must"
+                             + " be quadratic and the constraints linear"
+                             + " in robot_var, virtual_var and their"
+                             + " velocities.")
+        if self.options["rti"]:
+            self.setup_rti_solver()
+            return
+        self.solver = self.create_nlpsol("solver",
+                                         self.options["solver_name"],
+                                         self.mpc_problem["nlp"],
+                                         self.options["solver_opts"])
+
+    def get_linear_quadratic_problem(self, condensed=False):
+        """Returns the MPC problem as a QP in opt_var without the lifted
+        time_var0, or None if the cost is not quadratic or the
+        constraints not linear in them. They can depend nonlinearly on
+        time_var0, which is fixed by the measurement, and on the
+        horizon_pars of the variable_horizon option.
+
+        The QP variables are ordered [x0 u0 x1 u1 ... xN], with the
+        robot_var and virtual_var of each step as the state x and the
+        slack_var, robot_vel_var and virtual_vel_var as the control u.
+        The constraints are reordered as [gap0 cnstr0 gap1 cnstr1 ...],
+        the banded structure expected by hpipm. With condensed, the
+        states after x0 are eliminated with the shooting gaps, which
+        gives a dense QP in x0 and the controls. With the move_blocking
+        option, the velocities are only in the control of the first
+        step of each block, which hpipm does not support.
+
+        Return:
+            dict: "matrices", a function of time_var0, and horizon_pars
+            with the variable_horizon option, giving H and A,
+            "vectors" giving the cost gradient g, the constraints g0
+            and the cost f0 at zero, "opt_var" giving the opt_var of
+            the MPC problem from time_var0 and the QP variables, "rows"
+            of the MPC constraints in the QP, "structure" for hpipm,
+            and whether the matrices are "constant".
+        """
+        nlp = self.mpc_problem["nlp"]
+        n_opt_var = nlp["x"].shape[0]
+        nrob = self.skill_spec.n_robot_var
+        nvirt = self.skill_spec.n_virtual_var
+        nslack = self.skill_spec.n_slack_var
+        n_state = nrob + nvirt
+        n_control = nslack + n_state
+        n_steps = self.horizon_length
+        dt = self.timestep
+        n_reactive = self.mpc_problem["n_cnstr"]["reactive"]
+        n_predictive = self.mpc_problem["n_cnstr"]["predictive"]
+        block_start = self.get_opt_var_indices()["block_start"]
+        # g is [t0, state0, (cnstr, shooting gap) for each step]
+        cnstr_rows = [list(range(1, 1 + n_state + n_reactive))]
+        gap_rows = [list(range(1 + n_state + n_reactive,
+                               1 + 2*n_state + n_reactive))]
+        for k in range(1, n_steps):
+            offset = 1 + 2*n_state + n_reactive
+            offset += (k - 1)*(n_predictive + n_state)
+            cnstr_rows += [list(range(offset, offset + n_predictive))]
+            gap_rows += [list(range(offset + n_predictive,
+                                    offset + n_predictive + n_state))]
+        # The structure of MX through function calls is conservative
+        nlp_vars = [nlp["x"]]
+        list_pars = [cs.SX.sym("time_var0")]
+        list_par_names = ["time_var0"]
+        timesteps = [dt]*n_steps
+        if "p" in nlp:
+            nlp_vars += [nlp["p"]]
+            horizon_pars = cs.SX.sym("horizon_pars", nlp["p"].shape[0])
+            list_pars += [horizon_pars]
+            list_par_names += ["horizon_pars"]
+            timesteps = [horizon_pars[1+k] for k in range(n_steps)]
+        nlp_func = cs.Function("nlp", nlp_vars, [nlp["f"], nlp["g"]])
+        try:
+            nlp_func = nlp_func.expand()
+        except RuntimeError:
+            return None
+        if condensed:
+            n_vel = n_state*sum(block_start)
+            qp_var = cs.SX.sym("qp_var", n_state + n_steps*nslack + n_vel)
+            state = qp_var[:n_state]
+            opt_var = [list_pars[0], state]
+            idx = n_state
+            for k in range(n_steps):
+                opt_var += [qp_var[idx:idx+nslack]]
+                idx += nslack
+                if block_start[k]:
+                    vel = qp_var[idx:idx+n_state]
+                    opt_var += [vel]
+                    idx += n_state
+                state = state + timesteps[k]*vel
+                opt_var += [state]
+            rows = sum(cnstr_rows, [])
+            structure = None
+        else:
+            qp_var = cs.SX.sym("qp_var", n_opt_var - 1)
+            opt_var = [list_pars[0], qp_var]
+            rows = []
+            for k in range(n_steps):
+                rows += gap_rows[k] + cnstr_rows[k]
+            structure = None
+            if all(block_start):
+                structure = {"N": n_steps,
+                             "nx": [n_state]*(n_steps + 1),
+                             "nu": [n_control]*n_steps + [0],
+                             "ng": ([len(k_rows) for k_rows in cnstr_rows]
+                                    + [0])}
+        opt_var = cs.vertcat(*opt_var)
+        f, g = nlp_func(opt_var, *list_pars[1:])
+        g = g[rows]
+        H, grad_f = cs.hessian(f, qp_var)
+        A = cs.jacobian(g, qp_var)
+        if cs.depends_on(H, qp_var) or cs.depends_on(A, qp_var):
+            return None
+        zeros = cs.SX.zeros(qp_var.shape)
+        grad_f0, g0, f0 = cs.substitute([grad_f, g, f], [qp_var], [zeros])
+        func_opts = self.options["function_opts"]
+        pars = cs.vertcat(*list_pars)
+        return {
+            "matrices": self.create_function("lq_matrices", list_pars,
+                                             [H, A], list_par_names,
+                                             ["H", "A"], func_opts),
+            "vectors": self.create_function("lq_vectors", list_pars,
+                                            [grad_f0, g0, f0],
+                                            list_par_names,
+                                            ["g", "g0", "f0"], func_opts),
+            "opt_var": cs.Function("lq_opt_var", list_pars + [qp_var],
+                                   [opt_var], list_par_names + ["qp_var"],
+                                   ["opt_var"]),
+            "rows": rows,
+            "structure": structure,
+            "constant": not (cs.depends_on(H, pars)
+                             or cs.depends_on(A, pars))
+        }
+
+    def setup_lq_solver(self, lq_problem):
+        """Sets up the conic solver of the linear_quadratic option. When
+        the QP matrices do not depend on time_var0, they are evaluated
+        here once instead of every solve."""
+        self.linear_quadratic = True
+        self.lq_problem = lq_problem
+        matrices = lq_problem["matrices"]
+        if lq_problem["constant"]:
+            lq_problem["H"], lq_problem["A"] = matrices(
+                *[cs.DM.zeros(matrices.sparsity_in(i))
+                  for i in range(matrices.n_in())])
+        solver_opts = dict(self.options["lq_qpsol_opts"])
+        if (self.options["lq_qpsol"] == "hpipm"
+                and lq_problem["structure"] is not None):
+            for name, value in lq_problem["structure"].items():
+                if name not in solver_opts:
+                    solver_opts[name] = value
+        self.solver = cs.conic("solver",
+                               self.options["lq_qpsol"],
+                               {"h": matrices.sparsity_out("H"),
+                                "a": matrices.sparsity_out("A")},
+                               solver_opts)
+
+    def get_lq_solution(self, time_var, lb_num, ub_num, horizon_pars=None):
+        """Returns the opt_var and the cost of the MPC problem solved as
+        a QP, see get_linear_quadratic_problem. Works on both numeric
+        and symbolic values. horizon_pars are those of the
+        variable_horizon option."""
+        lq_problem = self.lq_problem
+        list_pars = [time_var]
+        if horizon_pars is not None:
+            list_pars += [horizon_pars]
+        if lq_problem["constant"]:
+            H, A = lq_problem["H"], lq_problem["A"]
+        else:
+            H, A = lq_problem["matrices"](*list_pars)
+        grad_f0, g0, f0 = lq_problem["vectors"](*list_pars)
+        rows = lq_problem["rows"]
+        res = self.solver(h=H, g=grad_f0, a=A,
+                          lba=lb_num[rows] - g0,
+                          uba=ub_num[rows] - g0)
+        opt_var = lq_problem["opt_var"](*(list_pars + [res["x"]]))
+        return opt_var, f0 + res["cost"]
+
+    def setup_rti_solver(self):
+        """Sets up the real-time iterations. Instead of solving the NLP
+        to convergence, each tick solves one QP of the MPC problem
+        linearised around the previous solution shifted one step, see
+        get_shifted_warmstart. The QP has the Hessian of the cost, with
+        its diagonal raised to the Gershgorin bound where needed so that
+        it is positive semidefinite also for nonconvex costs, and the
+        jacobian of the constraints. The curvature of the constraints is
+        left out. A converged iteration solves the MPC problem whatever
+        the Hessian, as the gradient is exact. The QP data only depend
+        on the linearisation point, so they are evaluated in the
+        preparation phase, see prepare, and the feedback phase only
+        evaluates the bounds and solves the QP, see feedback. With the
+        variable_horizon option, the QP data also depend on the
+        horizon_pars."""
+        nlp = self.mpc_problem["nlp"]
+        H, grad_f = cs.hessian(nlp["f"], nlp["x"])
+        # Diagonally dominant with a nonnegative diagonal
+        H_diag = cs.diag(H)
+        H_off = cs.sum2(cs.fabs(H)) - cs.fabs(H_diag)
+        H = H + cs.diag(cs.fmax(H_off - H_diag, 0.0))
+        A = cs.jacobian(nlp["g"], nlp["x"])
+        list_vars = [nlp["x"]]
+        list_names = ["x"]
+        if "p" in nlp:
+            list_vars += [nlp["p"]]
+            list_names += ["horizon_pars"]
+        self.rti_problem = {
+            "qp_data": self.create_function("rti_qp_data",
+                                            list_vars,
+                                            [H, grad_f, A, nlp["g"]],
+                                            list_names,
+                                            ["H", "grad_f", "A", "g"],
+                                            self.options["function_opts"])
+        }
+        self.solver = cs.conic("solver",
+                               self.options["rti_qpsol"],
+                               {"h": H.sparsity(), "a": A.sparsity()},
+                               self.options["rti_qpsol_opts"])
+
+    def prepare(self, opt_var0=None):
+        """Preparation phase of the real-time iterations, to be called
+        between ticks. Evaluates the QP linearised around opt_var0, or
+        the shifted solution of the last feedback, or zeros. feedback
+        calls it if it has not been called since the last feedback."""
+        n_opt_var = self.mpc_problem["nlp"]["x"].shape[0]
+        n_cnstr = self.mpc_problem["nlp"]["g"].shape[0]
+        if opt_var0 is not None:
+            x_lin = cs.DM(opt_var0)
+            if x_lin.numel() != n_opt_var:
+                raise ValueError("opt_var0 must have "+str(n_opt_var)
+                                 + " elements, see mpc_problem.")
+            x_lin = cs.reshape(x_lin, n_opt_var, 1)
+            lam_x0 = cs.DM.zeros(n_opt_var)
+            lam_a0 = cs.DM.zeros(n_cnstr)
+        elif self._warmstart is not None:
+            x_lin, lam_x0, lam_a0 = self.get_shifted_warmstart(
+                *self._warmstart, horizon_pars=self._horizon_pars)
+        else:
+            x_lin = cs.DM.zeros(n_opt_var)
+            lam_x0 = cs.DM.zeros(n_opt_var)
+            lam_a0 = cs.DM.zeros(n_cnstr)
+        list_vars = [x_lin]
+        if self._horizon_pars is not None:
+            list_vars += [self._horizon_pars]
+        H, grad_f, A, g_lin = self.rti_problem["qp_data"](*list_vars)
+        self._rti = {"x_lin": x_lin,
+                     "g_lin": g_lin,
+                     "qp_args": {"h": H, "g": grad_f, "a": A,
+                                 "lam_x0": lam_x0, "lam_a0": lam_a0}}
+
+    def feedback(self, time_var, robot_var, virtual_var=None):
+        """Feedback phase of the real-time iterations. Evaluates the
+        bounds of the measured state and solves the QP set up by
+        prepare, see setup_rti_solver. The solution is stored in res,
+        and shifted for the next prepare.
+
+        Return:
+            tuple: (robot_vel, virtual_vel, slack) as in solve
+        """
+        if self._rti is None:
+            self.prepare()
+        instr = self.instrumentation
+        if instr is not None:
+            t_start = instr.clock()
+        currvals = [time_var, robot_var]
+        if virtual_var is not None:
+            currvals += [virtual_var]
+        if self._horizon_pars is not None:
+            currvals += [self._horizon_pars]
+        if instr is not None:
+            t_eval = instr.clock()
+        lb_num = self.mpc_problem["num"]["lb"](*currvals)
+        ub_num = self.mpc_problem["num"]["ub"](*currvals)
+        if instr is not None:
+            eval_time = instr.clock() - t_eval
+        rti = self._rti
+        if instr is not None:
+            t_solver = instr.clock()
+        res = self.solver(lba=lb_num - rti["g_lin"],
+                          uba=ub_num - rti["g_lin"],
+                          **rti["qp_args"])
+        if instr is not None:
+            solver_time = instr.clock() - t_solver
+        self.res = {"x": rti["x_lin"] + res["x"],
+                    "f": res["cost"],
+                    "lam_x": res["lam_x"],
+                    "lam_g": res["lam_a"]}
+        self._warmstart = (self.res["x"], self.res["lam_x"],
+                           self.res["lam_g"])
+        self._rti = None
+        sol = self.get_solution_vars(self.res["x"])
+        if instr is not None:
+            self.record_tick(instr, t_start, eval_time, solver_time)
+        return sol
 
     def setup_initial_problem_solver(self):
         """Setup the initial problem solver. This does nothing at the
@@ -644,7 +1318,8 @@ class ModelPredictiveController(BaseController):
 
     def get_horizons(self):
         """Returns a tuple of the desired inputs and the predicted states.
-        Can only be called after solve
+        Can only be called after solve. With the move_blocking option,
+        the inputs are repeated over each block.
         """
         # The resulting decision variables of the NLP:
         nlp_opt = self.res["x"]
@@ -652,32 +1327,17 @@ class ModelPredictiveController(BaseController):
         nrob = self.skill_spec.n_robot_var
         nvirt = self.skill_spec.n_virtual_var
         nslack = self.skill_spec.n_slack_var
-        res_rob = []
-        res_rob_vel = []
+        indices = self.get_opt_var_indices()
+        res_rob = [nlp_opt[idx[:nrob]] for idx in indices["state"]]
+        res_rob_vel = [nlp_opt[idx[:nrob]] for idx in indices["vel"]]
         res_virt = []
         res_virt_vel = []
         res_slack = []
-        # The index starts after t0
-        idx = 1
-        res_rob += [nlp_opt[idx:idx+nrob]]
-        idx += nrob
         if nvirt > 0:
-            res_virt += [nlp_opt[idx:idx+nvirt]]
-            idx += nvirt
-        for i in range(self.horizon_length):
-            if nslack > 0:
-                res_slack += [nlp_opt[idx:idx+nslack]]
-                idx += nslack
-            res_rob_vel += [nlp_opt[idx:idx+nrob]]
-            idx += nrob
-            if nvirt > 0:
-                res_virt_vel += [nlp_opt[idx:idx+nvirt]]
-                idx += nvirt
-            res_rob += [nlp_opt[idx:idx+nrob]]
-            idx += nrob
-            if nvirt > 0:
-                res_virt += [nlp_opt[idx:idx+nvirt]]
-                idx += nvirt
+            res_virt = [nlp_opt[idx[nrob:]] for idx in indices["state"]]
+            res_virt_vel = [nlp_opt[idx[nrob:]] for idx in indices["vel"]]
+        if nslack > 0:
+            res_slack = [nlp_opt[idx] for idx in indices["slack"]]
         res = [res_rob,
                res_rob_vel,
                res_virt,
@@ -685,6 +1345,120 @@ class ModelPredictiveController(BaseController):
                res_slack]
         return res
 
+    def get_shifted_warmstart(self, x, lam_x, lam_g, horizon_pars=None):
+        """Returns the solution x and the multipliers lam_x and lam_g of
+        the MPC problem shifted one step along the horizon, as x0,
+        lam_x0 and lam_g0 for the next solve. Works on both numeric and
+        symbolic values.
+
+        The lifted initial state becomes the predicted state after the
+        first step, and the time is advanced by the timestep of the
+        first step. The last step repeats the last slacks and
+        velocities, and its state is extrapolated with them over the
+        timestep of the last step. The timesteps are those of the
+        horizon_pars of the variable_horizon option, see set_horizon,
+        when they are given. The multipliers of the last step are
+        repeated, and the first step keeps the multipliers of its
+        reactive constraints, which have no predictive counterpart.
+        With the move_blocking option, each block starts from the
+        velocities of the step after its first step.
+        """
+        nrob = self.skill_spec.n_robot_var
+        nvirt = self.skill_spec.n_virtual_var
+        n_state = nrob + nvirt
+        n_steps = self.horizon_length
+        if horizon_pars is None:
+            dt_first = self.timestep
+            dt_last = self.timestep
+        else:
+            dt_first = horizon_pars[1]
+            dt_last = horizon_pars[n_steps]
+        indices = self.get_opt_var_indices()
+        n_init = 1 + n_state
+        # Indices in x of the shifted x, with the last state repeated
+        shifted = [0] + indices["state"][1]
+        for k in range(n_steps):
+            k_next = min(k + 1, n_steps - 1)
+            shifted += indices["slack"][k_next]
+            if indices["block_start"][k]:
+                shifted += indices["vel"][k_next]
+            shifted += indices["state"][min(k + 2, n_steps)]
+        x0 = [x[:1] + dt_first,
+              x[shifted[1:-n_state]],
+              x[shifted[-n_state:]] + dt_last*x[indices["vel"][-1]]]
+        lam_x0 = [lam_x[:n_init], lam_x[shifted[n_init:]]]
+        # g is [t0, state0, (cnstr, shooting gap) for each step], with
+        # the reactive cnstr on the first step
+        if n_steps > 1:
+            n_reactive = self.mpc_problem["n_cnstr"]["reactive"]
+            n_predictive = self.mpc_problem["n_cnstr"]["predictive"]
+            gap0 = n_init + n_reactive
+            step1 = gap0 + n_state
+            gap1 = step1 + n_predictive
+            last_g = step1 + (n_steps - 2)*(n_predictive + n_state)
+            lam_g0 = cs.vertcat(lam_g[:gap0],
+                                lam_g[gap1:gap1+n_state],
+                                lam_g[gap1+n_state:],
+                                lam_g[last_g:])
+        else:
+            lam_g0 = lam_g
+        return cs.vertcat(*x0), cs.vertcat(*lam_x0), lam_g0
+
+    def reset_warmstart(self):
+        """Forget the solution stored by the shifted_warmstart and rti
+        options. Call this when switching skills or when the robot has
+        moved far since the last solve."""
+        self._warmstart = None
+        self._rti = None
+        fast_path = getattr(self, "_fast_path", None)
+        if fast_path is not None:
+            for idx_in, idx_out in fast_path["feedback"]:
+                fast_path["funcs"][0].args[idx_in].fill(0.)
+
+    def set_horizon(self, horizon_length=None, timesteps=None):
+        """Sets the active horizon length and the timestep of each step of
+        the variable_horizon option for the following solves, without
+        rebuilding the MPC problem. The steps after the active horizon
+        length are masked out, see get_horizon_masks. Call after
+        setup_solver, which resets them to the horizon_length and the
+        timestep.
+
+        Args:
+            horizon_length (int): active horizon length, at most the
+                horizon_length of the controller, default all of it
+            timesteps (float, list): timestep of each step of the
+                horizon_length of the controller, or one for all,
+                default the timestep
+        """
+        if not self.options["variable_horizon"]:
+            raise ValueError("set_horizon needs the variable_horizon"
+                             + " option.")
+        n_steps = self.horizon_length
+        if horizon_length is None:
+            horizon_length = n_steps
+        if not isinstance(horizon_length, int):
+            raise TypeError("Horizon length must be int, currently it is"
+                            + " " + str(type(horizon_length)) + ".")
+        if horizon_length < 1 or horizon_length > n_steps:
+            raise ValueError("horizon_length must be between 1 and "
+                             + str(n_steps) + ", it is "
+                             + str(horizon_length) + ".")
+        if timesteps is None:
+            timesteps = self.timestep
+        timesteps = cs.vec(cs.DM(timesteps))
+        if timesteps.numel() == 1:
+            timesteps = cs.repmat(timesteps, n_steps, 1)
+        elif timesteps.numel() != n_steps:
+            raise ValueError("timesteps must have one or "+str(n_steps)
+                             + " elements, it has "
+                             + str(timesteps.numel()) + ".")
+        self._horizon_pars = cs.vertcat(horizon_length, timesteps)
+        # The prepared QP of the rti option depends on them
+        self._rti = None
+        fast_path = getattr(self, "_fast_path", None)
+        if fast_path is not None:
+            self.set_fast_path_horizon(fast_path)
+
     def solve(self, time_var, robot_var,
               virtual_var=None,
               input_var=None,
@@ -692,17 +1466,100 @@ class ModelPredictiveController(BaseController):
               warmstart_robot_vel_var=None,
               warmstart_virtual_vel_var=None,
               warmstart_slack_var=None):
+        """Solve the MPC problem.
+
+        The solver starts from opt_var0 if given, with the layout of
+        mpc_problem["nlp"]["x"], otherwise from zeros. With the
+        shifted_warmstart option, the previous solution shifted one
+        step is used instead of zeros, together with its multipliers,
+        see get_shifted_warmstart. With the rti option, opt_var0 is the
+        linearisation point, see prepare and feedback. With the
+        linear_quadratic option the QP is solved instead, and opt_var0
+        is not used.
+        """
+        if self.linear_quadratic:
+            return self.solve_lq(time_var, robot_var, virtual_var)
+        if self.options["rti"]:
+            if opt_var0 is not None:
+                self.prepare(opt_var0)
+            return self.feedback(time_var, robot_var, virtual_var)
+        instr = self.instrumentation
+        if instr is not None:
+            t_start = instr.clock()
         currvals = [time_var, robot_var]
         if virtual_var is not None:
             currvals += [virtual_var]
+        if self._horizon_pars is not None:
+            currvals += [self._horizon_pars]
+        if instr is not None:
+            t_eval = instr.clock()
         lb_num = self.mpc_problem["num"]["lb"](*currvals)
         ub_num = self.mpc_problem["num"]["ub"](*currvals)
-        if opt_var0 is None:
-            opt_var0 = [0.]*self.mpc_problem["nlp"]["x"].shape[0]
-        else:
-            raise NotImplementedError("Warm start of opt_var to be done.")
-        self.res = self.solver(x0=opt_var0, ubg=ub_num,
-                               lbg=lb_num)
+        if instr is not None:
+            eval_time = instr.clock() - t_eval
+        solver_args = {"lbg": lb_num, "ubg": ub_num}
+        if self._horizon_pars is not None:
+            solver_args["p"] = self._horizon_pars
+        if self._warmstart is not None:
+            x0, lam_x0, lam_g0 = self.get_shifted_warmstart(
+                *self._warmstart, horizon_pars=self._horizon_pars)
+            solver_args["x0"] = x0
+            solver_args["lam_x0"] = lam_x0
+            solver_args["lam_g0"] = lam_g0
+        if opt_var0 is not None:
+            n_opt_var = self.mpc_problem["nlp"]["x"].shape[0]
+            if cs.DM(opt_var0).numel() != n_opt_var:
+                raise ValueError("opt_var0 must have "+str(n_opt_var)
+                                 + " elements, see mpc_problem.")
+            solver_args["x0"] = opt_var0
+        if instr is not None:
+            t_solver = instr.clock()
+        self.res = self.solver(**solver_args)
+        if instr is not None:
+            solver_time = instr.clock() - t_solver
+        if self.options["shifted_warmstart"]:
+            self._warmstart = (self.res["x"], self.res["lam_x"],
+                               self.res["lam_g"])
+        sol = self.get_solution_vars(self.res["x"])
+        if instr is not None:
+            self.record_tick(instr, t_start, eval_time, solver_time)
+        return sol
+
+    def solve_lq(self, time_var, robot_var, virtual_var=None):
+        """Solves the MPC problem as a QP, see
+        get_linear_quadratic_problem.
+
+        Return:
+            tuple: (robot_vel, virtual_vel, slack) as in solve
+        """
+        instr = self.instrumentation
+        if instr is not None:
+            t_start = instr.clock()
+        currvals = [time_var, robot_var]
+        if virtual_var is not None:
+            currvals += [virtual_var]
+        if self._horizon_pars is not None:
+            currvals += [self._horizon_pars]
+        if instr is not None:
+            t_eval = instr.clock()
+        lb_num = self.mpc_problem["num"]["lb"](*currvals)
+        ub_num = self.mpc_problem["num"]["ub"](*currvals)
+        if instr is not None:
+            eval_time = instr.clock() - t_eval
+            t_solver = instr.clock()
+        opt_var, cost = self.get_lq_solution(time_var, lb_num, ub_num,
+                                             self._horizon_pars)
+        if instr is not None:
+            solver_time = instr.clock() - t_solver
+        self.res = {"x": opt_var, "f": cost}
+        sol = self.get_solution_vars(opt_var)
+        if instr is not None:
+            self.record_tick(instr, t_start, eval_time, solver_time)
+        return sol
+
+    def get_solution_vars(self, opt_var):
+        """Returns the robot_vel_var, virtual_vel_var and slack_var of the
+        first step in the solution opt_var of the MPC problem."""
         # Sizes:
         nrob = self.skill_spec.n_robot_var
         if self.skill_spec._has_virtual:
@@ -715,13 +1572,180 @@ class ModelPredictiveController(BaseController):
         # Index after the lifted initial conditions:
         des_ind = 1 + nrob + nvirt + nslack
         # Get results:
-        res_robot_vel = self.res["x"][des_ind:des_ind+nrob]
+        res_robot_vel = opt_var[des_ind:des_ind+nrob]
         des_ind += nrob
         if nvirt > 0 and self.skill_spec._has_virtual:
-            res_virtual_vel = self.res["x"][des_ind:des_ind+nvirt]
+            res_virtual_vel = opt_var[des_ind:des_ind+nvirt]
             des_ind += nvirt
         else:
             res_virtual_vel = None
         if nslack > 0:
-            res_slack = self.res["x"][des_ind:des_ind+nslack]
+            # The slack comes before the velocities
+            slack_ind = 1 + nrob + nvirt
+            res_slack = opt_var[slack_ind:slack_ind+nslack]
+        else:
+            res_slack = None
         return res_robot_vel, res_virtual_vel, res_slack
+
+    def get_fast_inputs(self):
+        """Returns the symbols and names of the inputs of the fast path,
+        which are those of the bound functions, and the horizon_pars
+        symbol of the variable_horizon option or None."""
+        lb_func = self.mpc_problem["num"]["lb"]
+        sym_in = [cs.MX.sym(lb_func.name_in(i), lb_func.sparsity_in(i))
+                  for i in range(lb_func.n_in())]
+        list_names = ["time_var", "robot_var", "virtual_var"]
+        list_names = list_names[:len(sym_in)]
+        horizon_pars = None
+        if self._horizon_pars is not None:
+            # The last input, see set_horizon
+            horizon_pars = sym_in[-1]
+            list_names = list_names[:len(sym_in)-1] + ["horizon_pars"]
+        return sym_in, list_names, horizon_pars
+
+    def get_fast_function(self):
+        """Returns the bound functions and the solver combined into one
+        function for solve_into. With the shifted_warmstart option, the
+        shifted solution and multipliers are fed back between calls. With
+        the rti option, they are the linearisation point of the next
+        call, which does both the preparation and the feedback phase."""
+        nrob = self.skill_spec.n_robot_var
+        nvirt = self.skill_spec.n_virtual_var
+        nslack = self.skill_spec.n_slack_var
+        sym_in, list_names, horizon_pars = self.get_fast_inputs()
+        lbg = self.mpc_problem["num"]["lb"](*sym_in)
+        ubg = self.mpc_problem["num"]["ub"](*sym_in)
+        feedback = []
+        if self.linear_quadratic:
+            res_x = self.get_lq_solution(sym_in[0], lbg, ubg,
+                                         horizon_pars)[0]
+        elif self.options["rti"]:
+            warm = [cs.MX.sym(name, self.solver.sparsity_in(name))
+                    for name in ["x0", "lam_x0", "lam_a0"]]
+            sym_in += warm
+            list_names += ["x0", "lam_x0", "lam_a0"]
+            feedback = [("x0", "x"), ("lam_x0", "lam_x"), ("lam_a0", "lam_a")]
+            qp_args = [warm[0]]
+            if horizon_pars is not None:
+                qp_args += [horizon_pars]
+            H, grad_f, A, g_lin = self.rti_problem["qp_data"](*qp_args)
+            res = self.solver(h=H, g=grad_f, a=A,
+                              lba=lbg - g_lin, uba=ubg - g_lin,
+                              lam_x0=warm[1], lam_a0=warm[2])
+            res_x = warm[0] + res["x"]
+            shifted = self.get_shifted_warmstart(res_x, res["lam_x"],
+                                                 res["lam_a"], horizon_pars)
+        else:
+            solver_args = {"lbg": lbg, "ubg": ubg}
+            if horizon_pars is not None:
+                solver_args["p"] = horizon_pars
+            if self.options["shifted_warmstart"]:
+                for name in ["x", "lam_x", "lam_g"]:
+                    warm = cs.MX.sym(name+"0",
+                                     self.solver.sparsity_in(name+"0"))
+                    solver_args[name+"0"] = warm
+                    sym_in += [warm]
+                    list_names += [name+"0"]
+                    feedback += [(name+"0", name)]
+            res = self.solver(**solver_args)
+            res_x = res["x"]
+            shifted = self.get_shifted_warmstart(res_x, res["lam_x"],
+                                                 res["lam_g"], horizon_pars)
+        # Index after the lifted initial conditions
+        des_ind = 1 + nrob + nvirt
+        res_slack = res_x[des_ind:des_ind+nslack]
+        des_ind += nslack
+        res_robot_vel = res_x[des_ind:des_ind+nrob]
+        des_ind += nrob
+        if self.skill_spec._has_virtual:
+            res_virtual_vel = res_x[des_ind:des_ind+nvirt]
+        else:
+            res_virtual_vel = cs.MX(0, 1)
+        exprs = [res_robot_vel, res_virtual_vel, res_slack]
+        expr_names = ["robot_vel_var", "virtual_vel_var", "slack_var"]
+        if feedback:
+            exprs += list(shifted)
+            expr_names += [name_out for name_in, name_out in feedback]
+        func = cs.Function("fast_func", sym_in, exprs,
+                           list_names, expr_names)
+        return func, feedback
+
+    def setup_fast_path(self):
+        """Sets up the buffers used by solve_into, with the horizon_pars
+        of the variable_horizon option, see set_horizon."""
+        if self.linear_quadratic and self.options["lq_qpsol"] == "hpipm":
+            fast_path = self.setup_staged_fast_path()
+        else:
+            fast_path = BaseController.setup_fast_path(self)
+        if self._horizon_pars is not None:
+            self.set_fast_path_horizon(fast_path)
+        return fast_path
+
+    def setup_staged_fast_path(self):
+        """Sets up the fast path of the linear_quadratic option as three
+        stages sharing their buffers: a function giving the QP, the
+        conic solver called on its own, and a function picking the
+        solution variables. Used for the hpipm lq_qpsol, which crashes
+        when called symbolically inside a function."""
+        lq_problem = self.lq_problem
+        solver = self.solver
+        sym_in, list_names, horizon_pars = self.get_fast_inputs()
+        list_pars = [sym_in[0]]
+        if horizon_pars is not None:
+            list_pars += [horizon_pars]
+        # The QP, without the matrices when they are constant
+        rows = lq_problem["rows"]
+        lbg = self.mpc_problem["num"]["lb"](*sym_in)
+        ubg = self.mpc_problem["num"]["ub"](*sym_in)
+        grad_f0, g0, f0 = lq_problem["vectors"](*list_pars)
+        qp_exprs = [grad_f0, lbg[rows] - g0, ubg[rows] - g0]
+        qp_names = ["g", "lba", "uba"]
+        if not lq_problem["constant"]:
+            qp_exprs += list(lq_problem["matrices"](*list_pars))
+            qp_names += ["h", "a"]
+        qp_func = BufferedFunction(cs.Function("fast_qp", sym_in, qp_exprs,
+                                               list_names, qp_names))
+        # The solver reads the QP from its buffers
+        qp_args = [np.zeros(solver.nnz_in(i))
+                   for i in range(solver.n_in())]
+        qp_args[solver.index_in("lbx")].fill(-np.inf)
+        qp_args[solver.index_in("ubx")].fill(np.inf)
+        for i, name in enumerate(qp_names):
+            qp_args[solver.index_in(name)] = qp_func.res[i]
+        if lq_problem["constant"]:
+            qp_args[solver.index_in("h")][:] = lq_problem["H"].nonzeros()
+            qp_args[solver.index_in("a")][:] = lq_problem["A"].nonzeros()
+        solver_func = BufferedFunction(solver, qp_args)
+        # The solution variables from the solution of the QP
+        qp_x = cs.MX.sym("qp_x", solver.sparsity_out("x"))
+        opt_var = lq_problem["opt_var"](*(list_pars + [qp_x]))
+        res_robot_vel, res_virtual_vel, res_slack = self.get_solution_vars(
+            opt_var)
+        if res_virtual_vel is None:
+            res_virtual_vel = cs.MX(0, 1)
+        if res_slack is None:
+            res_slack = cs.MX(0, 1)
+        func = cs.Function("fast_func", sym_in + [qp_x],
+                           [res_robot_vel, res_virtual_vel, res_slack],
+                           list_names + ["qp_x"],
+                           ["robot_vel_var", "virtual_vel_var", "slack_var"])
+        buffered = BufferedFunction(
+            func, qp_func.args + [solver_func.res[solver.index_out("x")]])
+        self._fast_path = self.get_fast_path_indices(buffered)
+        self._fast_path["funcs"] = [buffered]
+        self._fast_path["feedback"] = []
+        self._fast_path["stages"] = [qp_func, solver_func]
+        return self._fast_path
+
+    def eval_fast_path(self, fast_path):
+        """Evaluates the stages of setup_staged_fast_path, if any, before
+        the fast path."""
+        for stage in fast_path.get("stages", []):
+            stage()
+        return BaseController.eval_fast_path(self, fast_path)
+
+    def set_fast_path_horizon(self, fast_path):
+        """Copies the horizon_pars of set_horizon into the fast path."""
+        func = fast_path["funcs"][0]
+        np.copyto(func.args[func.index_in("horizon_pars")],
+                     self._horizon_pars.full().ravel())
@@ -1,10 +1,19 @@
 """Pseudo inverse controller, see class doc.
 """
 
+import sys
+import itertools
+import tempfile
+from collections import OrderedDict
 import casadi as cs
+from casclik.compile_cache import CompileCache
 from casclik.constraints import EqualityConstraint, SetConstraint
 from casclik.constraints import VelocityEqualityConstraint
 from casclik.controllers.base_controller import BaseController
+from casclik.buffered_function import BufferedFunction
+from casclik.math_tools import damped_svd_pinv_function
+from casclik.integration_methods import get_euler_function
+from casclik.integration_methods import get_rk4_function
 
 
 class PseudoInverseController(BaseController):
@@ -24,7 +33,85 @@ class PseudoInverseController(BaseController):
 
     """
     controller_type = "PseudoInverseController"
-    options_info = """TODO"""
+    _in_tc_funcs = None  # See get_cached_in_tangent_cone_function
+    _mode_cache = None  # See get_mode
+    mode_search_func = None  # See setup_mode_search_function
+    _mode_candidates = None  # See get_mode_candidates
+    _prefixes = None  # See get_mode_expressions
+    _activation_index = None  # See get_activation_index
+    _allowed_modes = None  # See get_allowed_modes
+    set_classification_func = None  # See setup_set_classification_function
+    shared_pool = None  # See setup_shared_pool
+    _terms = None  # See get_constraint_terms
+    _pinvs = None  # See get_pinv
+    _svd_pinvs = None  # See pinv
+    _rollout_funcs = None  # See get_rollout_function
+    tangent_cone_func = None  # See setup_tangent_cone_function
+    current_mode = -1  # Mode of the last solve, -1 for none
+    options_info = """TODO
+    compile_cache (CompileCache, str): cache of the jit compiled
+        functions, or its directory, default None.
+    background_jit (bool): start with functions without jit, and swap
+        in the jit compiled functions when they are compiled in a
+        background thread, default False. See jit_ready.
+    jit_callback (callable): called as jit_callback(controller, name)
+        when a jit compiled function is swapped in, default None.
+    lazy_modes (bool): build and compile each mode the first time solve
+        needs it instead of all 2**n_set_constraints modes during
+        setup, default False. With a compile_cache, the compiled modes
+        are loaded from the cache after a restart.
+    mode_cache_size (int): max number of modes kept compiled with
+        lazy_modes, least recently used first out, default None for no
+        limit.
+    preload_modes (list): modes set up during setup with lazy_modes,
+        default [0], see get_hot_modes.
+    mode_search (str): how solve finds the first mode with all
+        inactive sets in their tangent cones, "ordered" calls the
+        functions of the modes in order, "compiled" builds the whole
+        search as one function, see setup_mode_search_function. The
+        compiled search can not be used with lazy_modes. "warm" starts
+        with the previous mode and its neighbours in the activation
+        map and finds the same mode as the ordered search, see
+        find_mode. "batch" evaluates all the modes in one
+        function and picks the first, see get_mode_batch_expressions,
+        it can not be used with lazy_modes either. Default "ordered".
+    parallel_jit (bool, int): jit compile the functions of all the
+        modes with this many compiler processes, or one per core if
+        True, and link them into one library, see
+        setup_mode_functions_parallel. Not used with lazy_modes, the
+        compiled mode_search or background_jit. Default False.
+    projector_method (str): null-space projector of the active
+        constraints, "stacked" takes the pseudo-inverse of the stacked
+        jacobians for each constraint, "recursive" updates the
+        projector with one constraint at a time, see update_projector.
+        Default "stacked".
+    prune_modes (bool): classify the sets before the mode search, and
+        only search the modes where the sets far inside their set are
+        inactive, see setup_set_classification_function. Not used by
+        the compiled mode_search. Default False.
+    prune_margin (float): distance to its bounds within which a set is
+        near its boundary and can be active, default None, which uses
+        gain*prune_timestep of each SetConstraint.
+    prune_timestep (float): timestep of the control loop for the
+        default prune_margin, default 0.01.
+    pinv_backend (str): how the damped pinv_method inverts
+        J J^T + damping_factor I, "solve" with cs.solve, "cholesky" with
+        the LDL^T factorisation of the ldl linear solver, "qr" with the
+        qr linear solver, or "svd" by the singular value decomposition
+        of J, see damped_svd_pinv_function. Each distinct stack of
+        jacobians is only inverted once, see get_pinv. Default "solve".
+    svd_threshold (float): singular values of J above it are inverted
+        without damping by the svd pinv_backend, default None for
+        damping all of them.
+    shared_expressions (bool): build the modes on a shared pool of the
+        expressions and jacobians of the constraints, which is computed
+        once per solve instead of once per mode checked, see
+        setup_shared_pool. Default False.
+    multidim_tangent_cone (str): in_tangent_cone test of the
+        multidimensional SetConstraints with multidim_sets, "corner"
+        or "per_axis", see get_in_tangent_cone_expression_multidim.
+        Default "corner".
+    """
 
     def __init__(self, skill_spec,
                  options=None):
@@ -47,6 +134,11 @@ class PseudoInverseController(BaseController):
             opt["feedforward"] = True
         if "multidim_sets" not in opt:
             opt["multidim_sets"] = False
+        if "multidim_tangent_cone" not in opt:
+            opt["multidim_tangent_cone"] = "corner"
+        if opt["multidim_tangent_cone"] not in ["corner", "per_axis"]:
+            raise ValueError("Unknown multidim_tangent_cone: "
+                             + str(opt["multidim_tangent_cone"]))
         if "converge_final_set_to_max" not in opt:
             opt["converge_final_set_to_max"] = False
         if "pinv_method" not in opt:
@@ -54,6 +146,13 @@ class PseudoInverseController(BaseController):
             opt["pinv_method"] = "damped"
         if "damping_factor" not in opt:
             opt["damping_factor"] = 1e-7
+        if "pinv_backend" not in opt:
+            opt["pinv_backend"] = "solve"
+        if opt["pinv_backend"] not in ["solve", "cholesky", "qr", "svd"]:
+            raise ValueError("Unknown pinv_backend: "
+                             + str(opt["pinv_backend"]))
+        if "svd_threshold" not in opt:
+            opt["svd_threshold"] = None
         if "function_opts" not in opt:
             opt["function_opts"] = {}
         function_opts = opt["function_opts"]
@@ -63,6 +162,39 @@ class PseudoInverseController(BaseController):
             function_opts["print_time"] = False
         if "jit_options" not in function_opts:
             function_opts["jit_options"] = {"flags": "-O2"}
+        opt["compile_cache"] = self.get_compile_cache(
+            opt.get("compile_cache", None))
+        if "background_jit" not in opt:
+            opt["background_jit"] = False
+        if "jit_callback" not in opt:
+            opt["jit_callback"] = None
+        if "lazy_modes" not in opt:
+            opt["lazy_modes"] = False
+        if "mode_cache_size" not in opt:
+            opt["mode_cache_size"] = None
+        if "preload_modes" not in opt:
+            opt["preload_modes"] = [0]
+        if "mode_search" not in opt:
+            opt["mode_search"] = "ordered"
+        if opt["mode_search"] not in ["ordered", "compiled", "warm",
+                                      "batch"]:
+            raise ValueError("Unknown mode_search: "
+                             + str(opt["mode_search"]))
+        if "parallel_jit" not in opt:
+            opt["parallel_jit"] = False
+        if "projector_method" not in opt:
+            opt["projector_method"] = "stacked"
+        if opt["projector_method"] not in ["stacked", "recursive"]:
+            raise ValueError("Unknown projector_method: "
+                             + str(opt["projector_method"]))
+        if "prune_modes" not in opt:
+            opt["prune_modes"] = False
+        if "prune_margin" not in opt:
+            opt["prune_margin"] = None
+        if "prune_timestep" not in opt:
+            opt["prune_timestep"] = 0.01
+        if "shared_expressions" not in opt:
+            opt["shared_expressions"] = False
         self._options = opt
 
     @property
@@ -94,16 +226,55 @@ class PseudoInverseController(BaseController):
             pJ = cs.pinv(J)
         elif self.options["pinv_method"] == "damped":
             dmpng_fctr = self.options["damping_factor"]
+            backend = self.options["pinv_backend"]
+            if backend == "svd":
+                return self.get_svd_pinv_function(J.shape)(cs.densify(J))
             if J.size2() >= J.size1():
                 inner = cs.mtimes(J, J.T)
                 inner += dmpng_fctr*cs.DM.eye(J.size1())
-                pJ = cs.solve(inner, J).T
+                pJ = self.solve_inner(inner, J).T
             else:
                 inner = cs.mtimes(J.T, J)
                 inner += dmpng_fctr*cs.DM.eye(J.size2())
-                pJ = cs.solve(inner, J.T)
+                pJ = self.solve_inner(inner, J.T)
         return pJ
 
+    def solve_inner(self, inner, rhs):
+        """Returns inner^-1 rhs with the linear solver of the
+        pinv_backend option."""
+        backend = self.options["pinv_backend"]
+        if backend == "solve":
+            return cs.solve(inner, rhs)
+        linsol = {"cholesky": "ldl", "qr": "qr"}[backend]
+        return cs.solve(inner, rhs, linsol)
+
+    def get_svd_pinv_function(self, shape):
+        """Returns the damped_svd_pinv_function of the svd pinv_backend
+        for jacobians of the shape, built once per shape."""
+        if self._svd_pinvs is None:
+            self._svd_pinvs = {}
+        if shape not in self._svd_pinvs:
+            self._svd_pinvs[shape] = damped_svd_pinv_function(
+                "svd_pinv_"+str(shape[0])+"x"+str(shape[1]),
+                shape,
+                self.options["damping_factor"],
+                self.options["svd_threshold"])
+        return self._svd_pinvs[shape]
+
+    def get_pinv(self, J_list):
+        """Returns the vertical stack of the jacobians in J_list and its
+        pseudo-inverse. The pseudo-inverse of each distinct stack is
+        built once and reused by the control variables and the
+        null-space projectors of all the modes."""
+        if self._pinvs is None:
+            self._pinvs = {}
+        key = tuple(hash(J) for J in J_list)
+        if key not in self._pinvs:
+            J = cs.vertcat(*J_list)
+            # The jacobians are kept so that their hashes stay unique
+            self._pinvs[key] = (J, self.pinv(J), tuple(J_list))
+        return self._pinvs[key][:2]
+
     def create_activation_map(self):
         """Create the activation map.
 
@@ -128,6 +299,66 @@ class PseudoInverseController(BaseController):
             binmaps += [mode_bin_total]
         # Sort them according to how many are active
         self.activation_map = sorted(binmaps, key=lambda s: cs.np.sum(s))
+        self._mode_candidates = None
+        self._activation_index = None
+        self._allowed_modes = None
+
+    def get_tangent_cone_axes(self, cnstr, expr, dexpr):
+        """Returns a vector with 1 for each dimension of the SetConstraint
+        where the expression value expr is inside its bounds, or outside
+        them with the time derivative dexpr going back in, and 0
+        elsewhere. At a bound, moving along it counts as going in. This
+        is the test of a one dimensional set done on each axis with
+        branch-free logic instead of if_else."""
+        above_min = cnstr.set_min - expr < 1e-12
+        below_max = expr - cnstr.set_max < 1e-12
+        return cs.logic_or(cs.logic_and(above_min,
+                                        cs.logic_or(below_max, dexpr < 0.)),
+                           cs.logic_and(cs.logic_not(above_min), dexpr > 0.))
+
+    def get_in_tangent_cone_expression(self, cnstr, expr, dexpr):
+        """Returns the in_tangent_cone expression of the SetConstraint
+        with expression value expr and time derivative dexpr, see
+        get_tangent_cone_axes. Multidimensional SetConstraints are
+        checked with get_in_tangent_cone_expression_multidim."""
+        if expr.size1() > 1:
+            return self.get_in_tangent_cone_expression_multidim(
+                cnstr, expr, dexpr)
+        return self.get_tangent_cone_axes(cnstr, expr, dexpr)
+
+    def get_in_tangent_cone_expression_multidim(self, cnstr, expr, dexpr):
+        """Returns the in_tangent_cone expression of the multidimensional
+        SetConstraint with expression value expr and time derivative
+        dexpr. With the per_axis multidim_tangent_cone option all the
+        axes must be in their tangent cones, see get_tangent_cone_axes,
+        otherwise outside a corner of the set the derivative must point
+        inwards within 45 degrees of the corner direction. Both are
+        branch-free logic instead of if_else."""
+        if self.options["multidim_tangent_cone"] == "per_axis":
+            return cs.mmin(self.get_tangent_cone_axes(cnstr, expr, dexpr))
+        set_min = cnstr.set_min
+        set_max = cnstr.set_max
+        le = expr - set_min
+        ue = expr - set_max
+        le_good = le >= 1e-12
+        ue_good = ue <= 1e-12
+        above = cs.dot(le_good - 1, le_good - 1) == 0
+        below = cs.dot(ue_good - 1, ue_good - 1) == 0
+        inside = cs.logic_and(above, below)
+        out_dir = (cs.sign(le) + cs.sign(ue))/2.0
+        going_out = cs.dot(out_dir, dexpr)
+        same_signs = cs.sign(le) == cs.sign(ue)
+        corner = cs.dot(same_signs - 1, same_signs - 1) == 0
+        dists = (cs.norm_2(dexpr)+1e-10)*cs.norm_2(out_dir)
+        corner_handler = cs.logic_and(
+            going_out < 0.0,
+            cs.fabs(going_out)/dists < cs.np.cos(cs.np.pi/4)
+        )
+        going_in = cs.logic_or(
+            cs.logic_and(corner, corner_handler),
+            cs.logic_and(cs.logic_not(corner), going_out < 0.0)
+        )
+        return cs.logic_or(inside, going_in)
 
     def get_in_tangent_cone_function(self, cnstr):
         """Returns a casadi function for the SetConstraint instance."""
@@ -146,43 +377,19 @@ class PseudoInverseController(BaseController):
         virtual_vel_var = self.skill_spec.virtual_vel_var
         input_var = self.skill_spec.input_var
         expr = cnstr.expression
-        set_min = cnstr.set_min
-        set_max = cnstr.set_max
-        dexpr = cs.jacobian(expr, time_var)
-        dexpr += cs.jtimes(expr, robot_var, robot_vel_var)
+        dexpr = self.skill_spec.jacobian(expr, time_var)
+        dexpr += self.skill_spec.jtimes(expr, robot_var, robot_vel_var)
         if virtual_var is not None:
             list_vars += [virtual_var]
             list_names += ["virtual_var"]
             opt_var += [virtual_vel_var]
             opt_var_names += ["virtual_vel_var"]
-            dexpr += cs.jtimes(expr, virtual_var, virtual_vel_var)
+            dexpr += self.skill_spec.jtimes(expr, virtual_var,
+                                            virtual_vel_var)
         if input_var is not None:
             list_vars += [input_var]
             list_names += ["input_var"]
-        if_low_inc = cs.if_else(
-            dexpr > 0.,
-            True,
-            False,
-            True
-        )
-        if_high_dec = cs.if_else(
-            dexpr < 0.,
-            True,
-            False,
-            True
-        )
-        leq_high = cs.if_else(
-            expr-set_max < 1e-12,
-            True,
-            if_high_dec,
-            True
-        )
-        in_tc = cs.if_else(
-            set_min-expr < 1e-12,
-            leq_high,
-            if_low_inc,
-            True
-        )
+        in_tc = self.get_in_tangent_cone_expression(cnstr, expr, dexpr)
         return cs.Function("in_tc_"+cnstr.label.replace(" ", "_"),
                            list_vars+opt_var,
                            [in_tc],
@@ -206,99 +413,285 @@ class PseudoInverseController(BaseController):
         virtual_vel_var = self.skill_spec.virtual_vel_var
         input_var = self.skill_spec.input_var
         expr = cnstr.expression
-        set_min = cnstr.set_min
-        set_max = cnstr.set_max
-        dexpr = cs.jacobian(expr, time_var)
-        dexpr += cs.jtimes(expr, robot_var, robot_vel_var)
+        dexpr = self.skill_spec.jacobian(expr, time_var)
+        dexpr += self.skill_spec.jtimes(expr, robot_var, robot_vel_var)
         if virtual_var is not None:
             list_vars += [virtual_var]
             list_names += ["virtual_var"]
             opt_var += [virtual_vel_var]
             opt_var_names += ["virtual_vel_var"]
-            dexpr += cs.jtimes(expr, virtual_var, virtual_vel_var)
+            dexpr += self.skill_spec.jtimes(expr, virtual_var,
+                                            virtual_vel_var)
         if input_var is not None:
             list_vars += [input_var]
-            list_vars += ["input_var"]
-        le = expr - set_min
-        ue = expr - set_max
-        le_good = le >= 1e-12
-        ue_good = ue <= 1e-12
-        above = cs.dot(le_good - 1, le_good - 1) == 0
-        below = cs.dot(ue_good - 1, ue_good - 1) == 0
-        inside = cs.logic_and(above, below)
-        out_dir = (cs.sign(le) + cs.sign(ue))/2.0
-        # going_in = cs.dot(out_dir, dexpr) <= 0.0
-        same_signs = cs.sign(le) == cs.sign(ue)
-        corner = cs.dot(same_signs - 1, same_signs - 1) == 0
-        dists = (cs.norm_2(dexpr)+1e-10)*cs.norm_2(out_dir)
-        corner_handler = cs.if_else(
-            cs.dot(out_dir, dexpr) < 0.0,
-            cs.fabs(cs.dot(-out_dir, dexpr))/dists < cs.np.cos(cs.np.pi/4),
-            False,
-            True
-        )
-        going_in = cs.if_else(
-            corner,
-            corner_handler,
-            cs.dot(out_dir, dexpr) < 0.0,
-            True
-        )
-
-        in_tc = cs.if_else(
-            inside,  # Are we inside?
-            True,  # Then true.
-            going_in,  # If not, check if we're "going_in"
-            True
-        )
+            list_names += ["input_var"]
+        in_tc = self.get_in_tangent_cone_expression_multidim(cnstr, expr,
+                                                             dexpr)
         return cs.Function("in_tc_"+cnstr.label.replace(" ", "_"),
                            list_vars+opt_var,
                            [in_tc],
                            list_names+opt_var_names,
                            ["in_tc_"+cnstr.label])
 
+    def get_cached_in_tangent_cone_function(self, cnstr_idx):
+        """Returns the in_tangent_cone function of the SetConstraint at
+        cnstr_idx in the constraints. The functions are shared between
+        the modes."""
+        if self._in_tc_funcs is None:
+            self._in_tc_funcs = {}
+        if cnstr_idx not in self._in_tc_funcs:
+            cnstr = self.skill_spec.constraints[cnstr_idx]
+            if cnstr.expression.size()[0] == 1:
+                in_TC = self.get_in_tangent_cone_function(cnstr)
+            else:
+                in_TC = self.get_in_tangent_cone_function_multidim(cnstr)
+            self._in_tc_funcs[cnstr_idx] = in_TC
+        return self._in_tc_funcs[cnstr_idx]
+
     def get_problem_expressions(self):
-        """Initialize the desired control variables."""
+        """Initialize the desired control variables. With the lazy_modes
+        option the modes are not built here, but by get_mode when they
+        are first needed, and self.modes is None."""
+        self._in_tc_funcs = {}
+        self._prefixes = {}
+        self._terms = {}
+        self._pinvs = {}
+        self.shared_pool = None
+        if self.options["shared_expressions"]:
+            self.setup_shared_pool()
+        if self.options["lazy_modes"]:
+            self.modes = None
+            return self.modes
+        modes = [self.get_mode_expressions(mode_idx)
+                 for mode_idx in range(self.n_modes)]
+        self.modes = modes
+        return modes
+
+    def get_constraint_terms(self, cnstr_idx):
+        """Returns the expression of the constraint, its jacobian with
+        respect to time_var, and its jacobian with respect to robot_var
+        and virtual_var. With the shared_expressions option they are
+        taken from the symbol of the shared pool."""
+        if self.shared_pool is not None:
+            return self.shared_pool["terms"][cnstr_idx]
+        if self._terms is None:
+            self._terms = {}
+        if cnstr_idx not in self._terms:
+            spec = self.skill_spec
+            expr = spec.constraints[cnstr_idx].expression
+            Jt = spec.jacobian(expr, spec.time_var)
+            Ji = spec.jacobian(expr, spec.robot_var)
+            if spec.virtual_var is not None:
+                Ji = cs.horzcat(Ji, spec.jacobian(expr, spec.virtual_var))
+            self._terms[cnstr_idx] = (expr, Jt, Ji)
+        return self._terms[cnstr_idx]
+
+    def setup_shared_pool(self):
+        """Sets up the shared pool of the shared_expressions option. The
+        modes are built on a vector symbol holding the nonzeros of the
+        constraint terms, see get_constraint_terms, and the shared_pool
+        function computes the vector once per solve. The forward
+        kinematics and jacobians are then not repeated in the function
+        of each mode. Terms that do not depend on the variables, such as
+        the jacobians of joint limits, stay constant. Returns the
+        shared_pool dict with the "sym" and "expr" of the vector, the
+        "terms" of each constraint, and the "func" set up later."""
+        self.shared_pool = None
+        list_vars = self.get_mode_inputs()[0]
+        all_vars = cs.vertcat(*[cs.vec(var) for var in list_vars])
+        terms = [self.get_constraint_terms(cnstr_idx)
+                 for cnstr_idx in range(len(self.skill_spec.constraints))]
+        pool_exprs = []
+        for cnstr_terms in terms:
+            pool_exprs += [cs.vec(term.nz[:]) for term in cnstr_terms
+                           if cs.depends_on(term, all_vars)]
+        pool_expr = cs.vertcat(*pool_exprs)
+        pool_sym = cs.MX.sym("shared_pool", pool_expr.numel())
+        pool_terms = {}
+        offset = 0
+        for cnstr_idx, cnstr_terms in enumerate(terms):
+            term_syms = []
+            for term in cnstr_terms:
+                if not cs.depends_on(term, all_vars):
+                    term_syms += [term]
+                    continue
+                nnz = term.nnz()
+                term_syms += [cs.MX(term.sparsity(),
+                                    pool_sym[offset:offset+nnz])]
+                offset += nnz
+            pool_terms[cnstr_idx] = tuple(term_syms)
+        self.shared_pool = {"sym": pool_sym,
+                            "expr": pool_expr,
+                            "terms": pool_terms,
+                            "func": None}
+        return self.shared_pool
+
+    def share_pool(self, exprs):
+        """Returns the expressions on the shared pool symbol with the
+        symbol replaced by the terms it stands for, so that they only
+        depend on the variables."""
+        if self.shared_pool is None:
+            return exprs
+        return cs.substitute(exprs, [self.shared_pool["sym"]],
+                             [self.shared_pool["expr"]])
+
+    def get_projector(self, J_active_list, rJ_active_list, projector):
+        """Returns the null-space projector of the active constraints.
+        With the stacked projector_method it is computed from the
+        stacked jacobians, with the recursive one it is the projector
+        kept up to date by update_projector."""
+        if self.options["projector_method"] == "recursive":
+            return projector
+        J0toi, pJ0toi = self.get_pinv(J_active_list)
+        rJ0toi = cs.vertcat(*rJ_active_list)
+        return cs.MX.eye(self.n_state_var) - cs.mtimes(pJ0toi, rJ0toi)
+
+    def update_projector(self, projector, rJi):
+        """Returns the projector with the jacobian rJi of a newly active
+        constraint added, N_i = N_{i-1} - pinv(rJi N_{i-1}) rJi N_{i-1},
+        for the recursive projector_method."""
+        if projector is None:
+            return None
+        rJN = cs.mtimes(rJi, projector)
+        return projector - cs.mtimes(self.pinv(rJN), rJN)
+
+    def get_mode_expressions(self, mode_idx):
+        """Returns a dict with the control variable expression, the
+        in_tangent_cone functions of the inactive sets and the names of
+        the active sets of the mode."""
         time_var = self.skill_spec.time_var
-        state_var = self.state_var
         n_state_var = self.n_state_var
-        n_modes = self.n_modes
-        modes = [{} for i in range(n_modes)]
-        # Figure out how to do modes here
-        for mode_idx, mode in enumerate(modes):
-            set_idx = 0
-            cntrl_var_expr = cs.MX.zeros(n_state_var)
-            J_active_list = []
-            rJ_active_list = []
-            in_tc_list = []
-            active_set_names = []
-            for cnstr_idx, cnstr in enumerate(self.skill_spec.constraints):
-                # Identifiers
-                is_first = len(J_active_list) == 0
-                is_last = cnstr == self.skill_spec.constraints[-1]
-                is_set = isinstance(cnstr, SetConstraint)
-                is_eq = isinstance(cnstr, EqualityConstraint)
-                is_veleq = isinstance(cnstr, VelocityEqualityConstraint)
-                conv_last = self.options["converge_final_set_to_max"]
-                use_multidim = self.options["multidim_sets"]
-
-                # General jacobians
-                Jt = cnstr.jacobian(time_var)
-                Ji = cnstr.jacobian(state_var)
-
-                # Activation matrix for multidim set constraints
-                if use_multidim and is_set:
-                    # The jacobian is only active in set active
-                    # directions
-                    above = cnstr.expression - cnstr.set_max > 0.0
-                    below = cnstr.expression - cnstr.set_min < 0.0
-                    active = cs.logic_or(
-                        above,
-                        below
-                        )
-                    S = cs.diag(active)
-                if not use_multidim and is_set:
+        mode = {}
+        spec = self.skill_spec  # Caches the derivatives
+        if self._prefixes is None:
+            self._prefixes = {}
+        if self.n_set_constraints > 0:
+            activation = self.activation_map[mode_idx]
+        else:
+            activation = []
+        set_idx = 0
+        cntrl_var_expr = cs.MX.zeros(n_state_var)
+        J_active_list = []
+        rJ_active_list = []
+        projector = None
+        if self.options["projector_method"] == "recursive":
+            projector = cs.MX.eye(n_state_var)
+        in_tc_list = []
+        inactive_sets = []
+        active_set_names = []
+        for cnstr_idx, cnstr in enumerate(self.skill_spec.constraints):
+            # Modes with the same activation of the sets so far share
+            # the expressions so far
+            n_sets_so_far = set_idx
+            if isinstance(cnstr, SetConstraint):
+                n_sets_so_far += 1
+            prefix = (cnstr_idx, tuple(activation[:n_sets_so_far]))
+            if prefix in self._prefixes:
+                (cntrl_var_expr, J_active_list, rJ_active_list, projector,
+                 in_tc_list, inactive_sets,
+                 active_set_names) = self._prefixes[prefix]
+                J_active_list = list(J_active_list)
+                rJ_active_list = list(rJ_active_list)
+                in_tc_list = list(in_tc_list)
+                inactive_sets = list(inactive_sets)
+                active_set_names = list(active_set_names)
+                set_idx = n_sets_so_far
+                continue
+            # Identifiers
+            is_first = len(J_active_list) == 0
+            is_last = cnstr == self.skill_spec.constraints[-1]
+            is_set = isinstance(cnstr, SetConstraint)
+            is_eq = isinstance(cnstr, EqualityConstraint)
+            is_veleq = isinstance(cnstr, VelocityEqualityConstraint)
+            conv_last = self.options["converge_final_set_to_max"]
+            use_multidim = self.options["multidim_sets"]
+
+            # General jacobians
+            expr, Jt, Ji = self.get_constraint_terms(cnstr_idx)
+
+            # Activation matrix for multidim set constraints
+            if use_multidim and is_set:
+                # The jacobian is only active in set active
+                # directions
+                above = expr - cnstr.set_max > 0.0
+                below = expr - cnstr.set_min < 0.0
+                active = cs.logic_or(
+                    above,
+                    below
+                    )
+                S = cs.diag(active)
+            if not use_multidim and is_set:
+                expr_dim = cnstr.expression.size()[0]
+                if expr_dim > 1:
+                    raise NotImplementedError("PseudoInverseController"
+                                              + " does not yet have gu"
+                                              + "aranteed stable suppo"
+                                              + "rt for multidimension"
+                                              + "al SetConstraints. Si"
+                                              + "ze("+cnstr.label+")="
+                                              + str(expr_dim) + ". Set"
+                                              + " the multidim_sets fi"
+                                              + "eld in options to Tru"
+                                              + "e for experimental su"
+                                              + "pport.")
+            ########################################
+            # Case-by-case for the constraint types:
+            ########################################
+            # First has no null-space effect
+            if is_first and is_eq:
+                cnstr_des = -cs.mtimes(cnstr.gain, expr)
+                if self.options["feedforward"]:
+                    cnstr_des += -Jt
+                cntrl_var_expr += cs.mtimes(
+                    self.get_pinv([Ji])[1], cnstr_des
+                )
+                J_active_list += [Ji]
+                rJ_active_list += [Ji]
+                projector = self.update_projector(projector,
+                                                  rJ_active_list[-1])
+            if is_first and is_veleq:
+                cnstr_des = cnstr.target
+                if self.options["feedforward"]:
+                    cnstr_des += -Jt
+                cntrl_var_expr += cs.mtimes(
+                    self.get_pinv([Ji])[1], cnstr_des
+                )
+                J_active_list += [Ji]
+                rJ_active_list += [Ji]
+                projector = self.update_projector(projector,
+                                                  rJ_active_list[-1])
+            # Allow convergence of last set
+            elif is_set and is_last and conv_last:
+                if self.activation_map[mode_idx][set_idx]:
+                    cnstr_des = cs.mtimes(cnstr.gain,
+                                          cnstr.set_max - expr)
+                    if self.options["feedforward"]:
+                        cnstr_des += -Jt
+                    N0toi = self.get_projector(J_active_list, rJ_active_list,
+                                               projector)
+                    NJ = cs.mtimes(N0toi, self.get_pinv([Ji])[1])
+                    cntrl_var_expr += cs.mtimes(NJ, cnstr_des)
+                    J_active_list += [Ji]
+                    if use_multidim:
+                        rJ_active_list += [cs.mtimes(S, Ji)]
+                    else:
+                        rJ_active_list += [Ji]
+                    projector = self.update_projector(projector,
+                                                      rJ_active_list[-1])
+                    active_set_names += [cnstr.label]
+                else:
                     expr_dim = cnstr.expression.size()[0]
-                    if expr_dim > 1:
+                    if expr_dim == 1:
+                        in_TC = self.get_cached_in_tangent_cone_function(
+                            cnstr_idx)
+                        in_tc_list += [in_TC]
+                        inactive_sets += [cnstr_idx]
+                    elif use_multidim:
+                        in_TC = self.get_cached_in_tangent_cone_function(
+                            cnstr_idx)
+                        in_tc_list += [in_TC]
+                        inactive_sets += [cnstr_idx]
+                    else:
                         raise NotImplementedError("PseudoInverseController"
                                                   + " does not yet have gu"
                                                   + "aranteed stable suppo"
@@ -310,157 +703,239 @@ class PseudoInverseController(BaseController):
                                                   + "eld in options to Tru"
                                                   + "e for experimental su"
                                                   + "pport.")
-                ########################################
-                # Case-by-case for the constraint types:
-                ########################################
-                # First has no null-space effect
-                if is_first and is_eq:
-                    cnstr_des = -cs.mtimes(cnstr.gain,
-                                           cnstr.expression)
-                    if self.options["feedforward"]:
-                        cnstr_des += -Jt
-                    cntrl_var_expr += cs.mtimes(
-                        self.pinv(Ji), cnstr_des
-                    )
-                    J_active_list += [Ji]
-                    rJ_active_list += [Ji]
-                if is_first and is_veleq:
-                    cnstr_des = cnstr.target
-                    if self.options["feedforward"]:
-                        cnstr_des += -Jt
-                    cntrl_var_expr += cs.mtimes(
-                        self.pinv(Ji), cnstr_des
-                    )
+                set_idx += 1
+
+            # Others
+            elif is_eq:
+                cnstr_des = -cs.mtimes(cnstr.gain, expr)
+                if self.options["feedforward"]:
+                    cnstr_des += -Jt
+                N0toi = self.get_projector(J_active_list, rJ_active_list,
+                                           projector)
+                NJ = cs.mtimes(N0toi, self.get_pinv([Ji])[1])
+                cntrl_var_expr += cs.mtimes(NJ, cnstr_des)
+                J_active_list += [Ji]
+                rJ_active_list += [Ji]
+                projector = self.update_projector(projector,
+                                                  rJ_active_list[-1])
+
+            elif is_set:
+                if self.activation_map[mode_idx][set_idx]:
                     J_active_list += [Ji]
-                    rJ_active_list += [Ji]
-                # Allow convergence of last set
-                elif is_set and is_last and conv_last:
-                    if self.activation_map[mode_idx][set_idx]:
-                        cnstr_des = cs.mtimes(cnstr.gain,
-                                              cnstr.set_max - cnstr.expression)
-                        if self.options["feedforward"]:
-                            cnstr_des += -Jt
-                        J0toi = cs.vertcat(*J_active_list)
-                        rJ0toi = cs.vertcat(*rJ_active_list)
-                        N0toi = cs.MX.eye(n_state_var) - cs.mtimes(
-                            self.pinv(J0toi),
-                            rJ0toi
-                        )
-                        NJ = cs.mtimes(N0toi, self.pinv(Ji))
-                        cntrl_var_expr += cs.mtimes(NJ, cnstr_des)
-                        J_active_list += [Ji]
-                        if use_multidim:
-                            rJ_active_list += [cs.mtimes(S, Ji)]
-                        else:
-                            rJ_active_list += [Ji]
-                        active_set_names += [cnstr.label]
+                    if use_multidim:
+                        rJ_active_list += [cs.mtimes(S, Ji)]
                     else:
-                        expr_dim = cnstr.expression.size()[0]
-                        if expr_dim == 1:
-                            in_TC = self.get_in_tangent_cone_function(cnstr)
-                            in_tc_list += [in_TC]
-                        elif use_multidim:
-                            in_TC = self.get_in_tangent_cone_function_multidim(
-                                cnstr
-                            )
-                            in_tc_list += [in_TC]
-                        else:
-                            raise NotImplementedError("PseudoInverseController"
-                                                      + " does not yet have gu"
-                                                      + "aranteed stable suppo"
-                                                      + "rt for multidimension"
-                                                      + "al SetConstraints. Si"
-                                                      + "ze("+cnstr.label+")="
-                                                      + str(expr_dim) + ". Set"
-                                                      + " the multidim_sets fi"
-                                                      + "eld in options to Tru"
-                                                      + "e for experimental su"
-                                                      + "pport.")
-                    set_idx += 1
-
-                # Others
-                elif is_eq:
-                    cnstr_des = -cs.mtimes(cnstr.gain,
-                                           cnstr.expression)
-                    if self.options["feedforward"]:
-                        cnstr_des += -Jt
-                    J0toi = cs.vertcat(*J_active_list)
-                    rJ0toi = cs.vertcat(*rJ_active_list)
-                    N0toi = cs.MX.eye(n_state_var) - cs.mtimes(
-                        self.pinv(J0toi),
-                        rJ0toi
-                    )
-                    NJ = cs.mtimes(N0toi, self.pinv(Ji))
-                    cntrl_var_expr += cs.mtimes(NJ, cnstr_des)
-                    J_active_list += [Ji]
-                    rJ_active_list += [Ji]
-
-                elif is_set:
-                    if self.activation_map[mode_idx][set_idx]:
-                        J_active_list += [Ji]
-                        if use_multidim:
-                            rJ_active_list += [cs.mtimes(S, Ji)]
-                        else:
-                            rJ_active_list += [Ji]
-                        active_set_names += [cnstr.label]
+                        rJ_active_list += [Ji]
+                    projector = self.update_projector(projector,
+                                                      rJ_active_list[-1])
+                    active_set_names += [cnstr.label]
+                else:
+                    expr_dim = cnstr.expression.size()[0]
+                    if expr_dim == 1:
+                        in_TC = self.get_cached_in_tangent_cone_function(
+                            cnstr_idx)
+                        in_tc_list += [in_TC]
+                        inactive_sets += [cnstr_idx]
+                    elif use_multidim:
+                        in_TC = self.get_cached_in_tangent_cone_function(
+                            cnstr_idx)
+                        in_tc_list += [in_TC]
+                        inactive_sets += [cnstr_idx]
                     else:
-                        expr_dim = cnstr.expression.size()[0]
-                        if expr_dim == 1:
-                            in_TC = self.get_in_tangent_cone_function(cnstr)
-                            in_tc_list += [in_TC]
-                        elif use_multidim:
-                            in_TC = self.get_in_tangent_cone_function_multidim(
-                                cnstr
-                            )
-                            in_tc_list += [in_TC]
-                        else:
-                            raise NotImplementedError("PseudoInverseController"
-                                                      + " does not yet have gu"
-                                                      + "aranteed stable suppo"
-                                                      + "rt for multidimension"
-                                                      + "al SetConstraints. Si"
-                                                      + "ze("+cnstr.label+")="
-                                                      + str(expr_dim) + ". Set"
-                                                      + " the multidim_sets fi"
-                                                      + "eld in options to Tru"
-                                                      + "e for experimental su"
-                                                      + "pport.")
-                    set_idx += 1
-
-                elif is_veleq:
-                    cnstr_des = cnstr.target
-                    if self.options["feedforward"]:
-                        cnstr_des += -Jt
-                    J0toi = cs.vertcat(*J_active_list)
-                    rJ0toi = cs.vertcat(*rJ_active_list)
-                    N0toi = cs.MX.eye(n_state_var) - cs.mtimes(
-                        self.pinv(J0toi),
-                        rJ0toi
-                    )
-                    NJ = cs.mtimes(N0toi, self.pinv(Ji))
-                    cntrl_var_expr += cs.mtimes(NJ, cnstr_des)
-                    J_active_list += [Ji]
-                    rJ_active_list += [Ji]
+                        raise NotImplementedError("PseudoInverseController"
+                                                  + " does not yet have gu"
+                                                  + "aranteed stable suppo"
+                                                  + "rt for multidimension"
+                                                  + "al SetConstraints. Si"
+                                                  + "ze("+cnstr.label+")="
+                                                  + str(expr_dim) + ". Set"
+                                                  + " the multidim_sets fi"
+                                                  + "eld in options to Tru"
+                                                  + "e for experimental su"
+                                                  + "pport.")
+                set_idx += 1
 
-            # End of constraints for loop
-            mode["cntrl_var_expr"] = cntrl_var_expr
-            mode["in_tangent_cone_func_list"] = in_tc_list
-            mode["active_set_names"] = active_set_names
-        # End of modes loop
-        self.modes = modes
-        return modes
+            elif is_veleq:
+                cnstr_des = cnstr.target
+                if self.options["feedforward"]:
+                    cnstr_des += -Jt
+                N0toi = self.get_projector(J_active_list, rJ_active_list,
+                                           projector)
+                NJ = cs.mtimes(N0toi, self.get_pinv([Ji])[1])
+                cntrl_var_expr += cs.mtimes(NJ, cnstr_des)
+                J_active_list += [Ji]
+                rJ_active_list += [Ji]
+                projector = self.update_projector(projector,
+                                                  rJ_active_list[-1])
+            self._prefixes[prefix] = (cntrl_var_expr,
+                                      tuple(J_active_list),
+                                      tuple(rJ_active_list),
+                                      projector,
+                                      tuple(in_tc_list),
+                                      tuple(inactive_sets),
+                                      tuple(active_set_names))
 
-    def setup_problem_functions(self):
-        """Setup problem functions. Separate from get_problem_expressions for
-        future compilation of functions for speed-up and to generate
-        all the modes.
-        """
-        self.get_problem_expressions()
-        func_opts = self.options["function_opts"]
-        # All variables
-        time_var = self.skill_spec.time_var
-        robot_var = self.skill_spec.robot_var
-        list_vars = [time_var, robot_var]
+        mode["cntrl_var_expr"] = cntrl_var_expr
+        mode["in_tangent_cone_func_list"] = in_tc_list
+        mode["inactive_sets"] = inactive_sets
+        mode["inactive_mask"] = self.get_set_mask(inactive_sets)
+        mode["active_set_names"] = active_set_names
+        return mode
+
+    def get_set_indices(self):
+        """Returns the indices of the SetConstraints among the
+        constraints."""
+        return [cnstr_idx for cnstr_idx, cnstr
+                in enumerate(self.skill_spec.constraints)
+                if isinstance(cnstr, SetConstraint)]
+
+    def get_set_mask(self, set_cnstr_indices):
+        """Returns the integer with the bits of the SetConstraints with
+        the constraint indices set_cnstr_indices set, in the order of
+        the bitmask of the tangent_cone_func."""
+        set_indices = self.get_set_indices()
+        mask = 0
+        for cnstr_idx in set_cnstr_indices:
+            mask |= 1 << set_indices.index(cnstr_idx)
+        return mask
+
+    def get_tangent_cone_function_definition(self):
+        """Returns the name, the inputs and outputs, and their names, of
+        the tangent_cone_func, see setup_tangent_cone_function."""
+        list_vars, list_names = self.get_mode_inputs()
+        spec = self.skill_spec
+        vel_vars = [spec.robot_vel_var]
+        vel_names = ["robot_vel_var"]
+        if spec.virtual_var is not None:
+            vel_vars += [spec.virtual_vel_var]
+            vel_names += ["virtual_vel_var"]
+        cntrl_var = cs.vertcat(*vel_vars)
+        in_tcs = []
+        axes = []
+        bitmask = 0.
+        for set_idx, cnstr_idx in enumerate(self.get_set_indices()):
+            cnstr = spec.constraints[cnstr_idx]
+            expr, Jt, Ji = self.get_constraint_terms(cnstr_idx)
+            dexpr = Jt + cs.mtimes(Ji, cntrl_var)
+            axes += [self.get_tangent_cone_axes(cnstr, expr, dexpr)]
+            in_tcs += [self.get_in_tangent_cone_expression(cnstr, expr,
+                                                           dexpr)]
+            bitmask += 2.**set_idx*in_tcs[-1]
+        return ("tangent_cone",
+                list_vars + vel_vars,
+                [cs.vertcat(*in_tcs), cs.vertcat(*axes), bitmask],
+                list_names + vel_names,
+                ["in_tangent_cone", "in_tangent_cone_axes", "bitmask"])
+
+    def setup_tangent_cone_function(self):
+        """Creates the tangent_cone_func, which checks all the
+        SetConstraints for the suggested velocities in one call. Its
+        outputs are "in_tangent_cone" with an element per
+        SetConstraint, "in_tangent_cone_axes" with an element per
+        dimension of them, see get_tangent_cone_axes, and "bitmask",
+        with bit k set when SetConstraint k is in its tangent cone. A
+        mode is feasible when the bits of its inactive_mask are set."""
+        (name, list_vars, exprs, list_names,
+         expr_names) = self.get_tangent_cone_function_definition()
+        self.tangent_cone_func = self.create_function(
+            name,
+            list_vars,
+            exprs,
+            list_names,
+            expr_names,
+            self.options["function_opts"]
+        )
+        return self.tangent_cone_func
+
+    def get_mode_outputs(self, mode):
+        """Returns the control variable expression of the mode and the
+        expression of whether all its inactive sets are in their tangent
+        cones, built on the constraint terms, see get_constraint_terms."""
+        cntrl_var = mode["cntrl_var_expr"]
+        in_tc = cs.MX(1)
+        for cnstr_idx in mode["inactive_sets"]:
+            cnstr = self.skill_spec.constraints[cnstr_idx]
+            expr, Jt, Ji = self.get_constraint_terms(cnstr_idx)
+            dexpr = Jt + cs.mtimes(Ji, cntrl_var)
+            in_tc = cs.logic_and(in_tc, self.get_in_tangent_cone_expression(
+                cnstr, expr, dexpr))
+        return cntrl_var, in_tc
+
+    def get_all_mode_expressions(self):
+        """Returns the expressions of all the modes, also with the
+        lazy_modes option."""
+        if self.modes is not None:
+            return self.modes
+        return [self.get_mode_expressions(mode_idx)
+                for mode_idx in range(self.n_modes)]
+
+    def get_mode_batch_expressions(self):
+        """Returns the control variables of all the modes as the columns
+        of a matrix, and a vector of whether the inactive sets of each
+        mode are in their tangent cones. As one graph, the expressions
+        the modes share are only computed once, see
+        get_mode_batch_function."""
+        cntrl_vars = []
+        in_tcs = []
+        for mode in self.get_all_mode_expressions():
+            cntrl_var, in_tc = self.get_mode_outputs(mode)
+            cntrl_vars += [cntrl_var]
+            in_tcs += [in_tc]
+        return self.share_pool([cs.horzcat(*cntrl_vars),
+                                cs.vertcat(*in_tcs)])
+
+    def get_mode_batch_function(self):
+        """Returns a function evaluating all the modes at once, with the
+        outputs of get_mode_batch_expressions."""
+        list_vars, list_names = self.get_mode_inputs()
+        return self.create_function(
+            "mode_batch",
+            list_vars,
+            self.get_mode_batch_expressions(),
+            list_names,
+            ["cntrl_var", "in_tangent_cone"],
+            self.options["function_opts"]
+        )
+
+    def get_node_counts(self):
+        """Returns the number of nodes of the expression graphs of the
+        modes as a dict. "separate" is the sum over the functions of the
+        modes with nothing shared, "shared" is the shared pool plus the
+        functions of the modes on it, and "batch" is the function of all
+        the modes at once, see get_mode_batch_function."""
+        list_vars, list_names = self.get_mode_inputs()
+        modes = self.get_all_mode_expressions()
+        outputs = [self.get_mode_outputs(mode) for mode in modes]
+        counts = {"separate": 0}
+        for cntrl_var, in_tc in outputs:
+            func = cs.Function("mode", list_vars,
+                               self.share_pool([cntrl_var, in_tc]))
+            counts["separate"] += func.n_nodes()
+        if self.shared_pool is not None:
+            pool = self.shared_pool
+            pool_vars = list_vars + [pool["sym"]]
+            counts["shared"] = cs.Function("shared_pool", list_vars,
+                                           [pool["expr"]]).n_nodes()
+            for cntrl_var, in_tc in outputs:
+                func = cs.Function("mode", pool_vars, [cntrl_var, in_tc])
+                counts["shared"] += func.n_nodes()
+        counts["batch"] = cs.Function(
+            "mode_batch", list_vars,
+            self.get_mode_batch_expressions()).n_nodes()
+        return counts
+
+    def print_node_counts(self):
+        """Prints the node counts of get_node_counts."""
+        counts = self.get_node_counts()
+        sys.stdout.write("Nodes of the "+str(self.n_modes)+" modes:\n")
+        for key in ["separate", "shared", "batch"]:
+            if key in counts:
+                sys.stdout.write("  "+key.ljust(10)+str(counts[key])+"\n")
+
+    def get_mode_inputs(self):
+        """Returns the input variables of the mode functions and their
+        names."""
+        list_vars = [self.skill_spec.time_var, self.skill_spec.robot_var]
         list_names = ["time_var", "robot_var"]
         virtual_var = self.skill_spec.virtual_var
         if virtual_var is not None:
@@ -470,17 +945,260 @@ class PseudoInverseController(BaseController):
         if input_var is not None:
             list_vars += [input_var]
             list_names += ["input_var"]
+        return list_vars, list_names
+
+    def get_mode_function_definition(self, mode_idx, mode):
+        """Returns the name, the inputs and outputs, and their names, of
+        the function of the mode. With the shared_expressions option
+        this is the shared_func of the mode, which takes the output of
+        the shared_pool function after the variables, and also returns
+        whether the inactive sets are in their tangent cones."""
+        list_vars, list_names = self.get_mode_inputs()
+        if self.shared_pool is None:
+            return ("cntrl_var_"+str(mode_idx), list_vars,
+                    [mode["cntrl_var_expr"]], list_names, ["cntrl_var"])
+        return ("cntrl_var_shared_"+str(mode_idx),
+                list_vars + [self.shared_pool["sym"]],
+                list(self.get_mode_outputs(mode)),
+                list_names + ["shared_pool"],
+                ["cntrl_var", "in_tangent_cone"])
 
-        for mode_idx, mode in enumerate(self.modes):
-            cntrl_var_expr = mode["cntrl_var_expr"]
-            mode["cntrl_var_func"] = cs.Function(
-                "cntrl_var_"+str(mode_idx),
-                list_vars,
-                [cntrl_var_expr],
-                list_names,
-                ["cntrl_var"],
-                func_opts
-            )
+    def get_mode_function_key(self):
+        """Returns the key of the function of the modes in their dicts."""
+        if self.shared_pool is None:
+            return "cntrl_var_func"
+        return "shared_func"
+
+    def setup_mode_function(self, mode_idx, mode):
+        """Creates the cntrl_var_func of the mode, or its shared_func with
+        the shared_expressions option."""
+        (name, list_vars, exprs, list_names,
+         expr_names) = self.get_mode_function_definition(mode_idx, mode)
+        mode[self.get_mode_function_key()] = self.create_function(
+            name,
+            list_vars,
+            exprs,
+            list_names,
+            expr_names,
+            self.options["function_opts"]
+        )
+        return mode
+
+    def setup_shared_pool_function(self):
+        """Creates the function of the shared pool, see
+        setup_shared_pool."""
+        list_vars, list_names = self.get_mode_inputs()
+        pool = self.shared_pool
+        pool["func"] = self.create_function(
+            "shared_pool",
+            list_vars,
+            [pool["expr"]],
+            list_names,
+            ["shared_pool"],
+            self.options["function_opts"]
+        )
+        return pool["func"]
+
+    def setup_problem_functions(self):
+        """Setup problem functions. Separate from get_problem_expressions for
+        future compilation of functions for speed-up and to generate
+        all the modes. With the lazy_modes option only the modes in
+        the preload_modes option are set up here, see get_mode.
+        """
+        mode_search = self.options["mode_search"]
+        compiled = mode_search in ["compiled", "batch"]
+        if compiled and self.options["lazy_modes"]:
+            raise ValueError("The "+mode_search+" mode_search needs all the"
+                             + " modes, it can not be used with"
+                             + " lazy_modes.")
+        if compiled and self.options["prune_modes"]:
+            raise ValueError("The "+mode_search+" mode_search does not"
+                             + " prune the modes, it can not be used with"
+                             + " prune_modes.")
+        self.get_problem_expressions()
+        self._fast_path = None  # Set up again by solve_into
+        self.mode_search_func = None
+        self._rollout_funcs = None
+        self.current_mode = -1
+        self.mode_search_stats = {"previous": 0, "neighbour": 0, "scan": 0}
+        self.set_classification_func = None
+        self.set_classification = None
+        if self.options["prune_modes"] and self.n_set_constraints > 0:
+            self.setup_set_classification_function()
+        self.tangent_cone_func = None
+        if compiled:
+            self._mode_cache = None
+            self.setup_mode_search_function()
+            return
+        if self.modes is not None:
+            self._mode_cache = None
+            if self.options["parallel_jit"] and self.uses_jit():
+                self.setup_mode_functions_parallel()
+                return
+            if self.shared_pool is not None:
+                self.setup_shared_pool_function()
+            elif self.n_set_constraints > 0:
+                self.setup_tangent_cone_function()
+            for mode_idx, mode in enumerate(self.modes):
+                self.setup_mode_function(mode_idx, mode)
+            return
+        if self.shared_pool is not None:
+            self.setup_shared_pool_function()
+        elif self.n_set_constraints > 0:
+            self.setup_tangent_cone_function()
+        self._mode_cache = OrderedDict()
+        self.n_mode_compilations = 0
+        self.n_mode_evictions = 0
+        for mode_idx in self.options["preload_modes"]:
+            if mode_idx < 0 or mode_idx >= self.n_modes:
+                raise ValueError("Mode "+str(mode_idx)+" in preload_modes"
+                                 + " is not in 0.."+str(self.n_modes-1)
+                                 + ".")
+            self.get_mode(mode_idx)
+
+    def uses_jit(self):
+        """Returns True if the functions are jit compiled during setup."""
+        return (self.options["function_opts"].get("jit", False)
+                and not self.options["background_jit"])
+
+    def setup_mode_functions_parallel(self):
+        """Creates the cntrl_var_func of all the modes, and jit compiles
+        them together with the tangent_cone_func. The C code is
+        split in one file per compiler process, compiled in parallel,
+        and linked into one library in the compile cache, see
+        CompileCache.load_many. With the shared_expressions option the
+        shared_func of the modes are compiled with the shared_pool
+        function instead."""
+        func_opts = dict(self.options["function_opts"])
+        func_opts["jit"] = False
+        jit_options = func_opts.pop("jit_options", None)
+        func_opts.pop("compiler", None)
+        n_jobs = self.options["parallel_jit"]
+        if n_jobs is True:
+            n_jobs = None  # All the cores
+        funcs = [cs.Function(*(self.get_mode_function_definition(mode_idx,
+                                                                 mode)
+                               + (func_opts,)))
+                 for mode_idx, mode in enumerate(self.modes)]
+        pool = self.shared_pool
+        if pool is not None:
+            list_vars, list_names = self.get_mode_inputs()
+            funcs += [cs.Function("shared_pool", list_vars, [pool["expr"]],
+                                  list_names, ["shared_pool"], func_opts)]
+        elif self.n_set_constraints > 0:
+            funcs += [cs.Function(
+                *(self.get_tangent_cone_function_definition()
+                  + (func_opts,)))]
+        cache = self.options["compile_cache"]
+        if cache is None:
+            cache = CompileCache(tempfile.mkdtemp(prefix="casclik_jit_"))
+        compiled = cache.load_many(funcs, "casclik_modes", jit_options,
+                                   n_jobs)
+        key = self.get_mode_function_key()
+        for mode, func in zip(self.modes, compiled):
+            mode[key] = func
+        if pool is not None:
+            pool["func"] = compiled[self.n_modes]
+        elif self.n_set_constraints > 0:
+            self.tangent_cone_func = compiled[self.n_modes]
+
+    def get_mode(self, mode_idx):
+        """Returns the mode dict with its cntrl_var_func. With the
+        lazy_modes option, the mode is built and compiled the first time
+        it is needed, and kept in a least recently used cache of
+        mode_cache_size modes."""
+        cache = self._mode_cache
+        if cache is None:
+            return self.modes[mode_idx]
+        mode = cache.pop(mode_idx, None)
+        if mode is None:
+            mode = self.get_mode_expressions(mode_idx)
+            self.setup_mode_function(mode_idx, mode)
+            self.n_mode_compilations += 1
+        cache[mode_idx] = mode  # Most recently used last
+        max_size = self.options["mode_cache_size"]
+        while max_size is not None and len(cache) > max_size:
+            evicted_idx, evicted = cache.popitem(last=False)
+            self.n_mode_evictions += 1
+            fast_path = getattr(self, "_fast_path", None)
+            if fast_path is not None:
+                fast_func = fast_path["modes"].pop(evicted_idx, None)
+                if fast_func is not None:
+                    fast_path["funcs"].remove(fast_func)
+        return mode
+
+    def get_hot_modes(self):
+        """Returns the indices of the modes in the cache of the
+        lazy_modes option, most recently used first. They can be given
+        as preload_modes after a restart."""
+        if self._mode_cache is None:
+            return list(range(self.n_modes))
+        return list(self._mode_cache.keys())[::-1]
+
+    def get_mode_search_expressions(self, batch=False):
+        """Returns the expressions of the index of the first mode with all
+        inactive sets in their tangent cones and of its control
+        variables, or -1 and zeros if there is none.
+
+        The search is a chain of short-circuiting if_else, one per mode,
+        where the else branch continues with the next mode. Only the
+        modes up to the chosen one are evaluated. With the
+        shared_expressions option, the shared pool is computed once
+        before the chain. With batch, all the modes are evaluated in one
+        graph instead, see get_mode_batch_expressions."""
+        list_vars, list_names = self.get_mode_inputs()
+        modes = self.get_all_mode_expressions()
+        if batch:
+            cntrl_vars, in_tcs = self.get_mode_batch_expressions()
+            mode_num = cs.MX(-1.)
+            for mode_idx in reversed(range(self.n_modes)):
+                mode_num = cs.if_else(in_tcs[mode_idx], mode_idx, mode_num)
+            chosen = cs.vertcat(*[mode_num == mode_idx
+                                  for mode_idx in range(self.n_modes)])
+            return mode_num, cs.mtimes(cntrl_vars, chosen)
+        pool_syms = []
+        pool_exprs = []
+        if self.shared_pool is not None:
+            pool_syms = [self.shared_pool["sym"]]
+            pool_exprs = [self.shared_pool["expr"]]
+        chain_vars = list_vars + pool_syms
+        cntrl_var = cs.MX.sym("cntrl_var", self.n_state_var)
+        switch_vars = [cntrl_var] + chain_vars
+        next_func = cs.Function("mode_search_none", chain_vars,
+                                [cs.vertcat(-1., cs.MX.zeros(
+                                    self.n_state_var))])
+        for mode_idx in reversed(range(self.n_modes)):
+            cntrl_var_expr, in_tc = self.get_mode_outputs(modes[mode_idx])
+            found = cs.Function("mode_"+str(mode_idx)+"_found",
+                                switch_vars,
+                                [cs.vertcat(mode_idx, cntrl_var)])
+            not_found = cs.Function("mode_"+str(mode_idx)+"_next",
+                                    switch_vars,
+                                    [next_func(*chain_vars)])
+            switch = cs.Function.if_else("mode_"+str(mode_idx)+"_switch",
+                                         found, not_found)
+            next_func = cs.Function("mode_search_"+str(mode_idx),
+                                    chain_vars,
+                                    [switch(in_tc, cntrl_var_expr,
+                                            *chain_vars)])
+        search = next_func(*(list_vars + pool_exprs))
+        return search[0], search[1:]
+
+    def setup_mode_search_function(self):
+        """Creates the mode_search_func with the outputs of
+        get_mode_search_expressions, batch with the batch mode_search."""
+        list_vars, list_names = self.get_mode_inputs()
+        batch = self.options["mode_search"] == "batch"
+        mode_num, cntrl_var = self.get_mode_search_expressions(batch)
+        self.mode_search_func = self.create_function(
+            "mode_search",
+            list_vars,
+            [mode_num, cntrl_var],
+            list_names,
+            ["mode", "cntrl_var"],
+            self.options["function_opts"]
+        )
+        return self.mode_search_func
 
     def setup_initial_problem_solver(self):
         """Setup the initial problem solver. This does not do anything yet.
@@ -509,6 +1227,234 @@ class PseudoInverseController(BaseController):
         self.get_problem_expressions()
         self.setup_problem_functions()
 
+    def get_activation_index(self):
+        """Returns a dict from the tuples of the activation map to the
+        index of their mode."""
+        if self._activation_index is None:
+            self._activation_index = dict(
+                (tuple(active), mode_idx)
+                for mode_idx, active in enumerate(self.activation_map))
+        return self._activation_index
+
+    def setup_set_classification_function(self):
+        """Creates the set_classification_func, which returns for each
+        SetConstraint 0 when it is more than its margin inside its set,
+        1 when it is near its boundary, and 2 when it is outside its
+        set. Sets with 0 can not be active, see get_allowed_modes."""
+        list_vars, list_names = self.get_mode_inputs()
+        classes = []
+        for cnstr in self.skill_spec.constraints:
+            if not isinstance(cnstr, SetConstraint):
+                continue
+            margin = self.options["prune_margin"]
+            if margin is None:
+                margin = cnstr.gain*self.options["prune_timestep"]
+            expr = cnstr.expression
+            dist = cs.mmin(cs.fmin(expr - cnstr.set_min,
+                                   cnstr.set_max - expr))
+            classes += [cs.if_else(dist < -1e-12, 2.,
+                                   cs.if_else(dist < margin, 1., 0.))]
+        self.set_classification_func = self.create_function(
+            "set_classification",
+            list_vars,
+            [cs.vertcat(*classes)],
+            list_names,
+            ["set_classification"],
+            self.options["function_opts"]
+        )
+        return self.set_classification_func
+
+    def get_allowed_modes(self, set_classification):
+        """Returns the sorted list of modes where the sets classified as
+        0 by the set_classification_func are inactive, and a set of
+        them."""
+        free_sets = tuple(set_idx for set_idx, set_class
+                          in enumerate(set_classification) if set_class)
+        if self._allowed_modes is None:
+            self._allowed_modes = {}
+        if free_sets not in self._allowed_modes:
+            if len(self._allowed_modes) > 1024:
+                self._allowed_modes.clear()
+            index = self.get_activation_index()
+            allowed = []
+            for bits in itertools.product([0, 1], repeat=len(free_sets)):
+                active = [0]*self.n_set_constraints
+                for set_idx, bit in zip(free_sets, bits):
+                    active[set_idx] = bit
+                allowed += [index[tuple(active)]]
+            allowed = sorted(allowed)
+            self._allowed_modes[free_sets] = (allowed, frozenset(allowed))
+        return self._allowed_modes[free_sets]
+
+    def get_mode_candidates(self, mode_idx):
+        """Returns mode_idx and the modes with one set activated or
+        deactivated compared to it, sorted like the activation map."""
+        if self._mode_candidates is None:
+            self._mode_candidates = {}
+        if mode_idx not in self._mode_candidates:
+            candidates = [mode_idx]
+            if self.n_set_constraints > 0:
+                index = self.get_activation_index()
+                active = self.activation_map[mode_idx]
+                for set_idx in range(self.n_set_constraints):
+                    flipped = list(active)
+                    flipped[set_idx] = 1 - flipped[set_idx]
+                    candidates += [index[tuple(flipped)]]
+            self._mode_candidates[mode_idx] = sorted(candidates)
+        return self._mode_candidates[mode_idx]
+
+    def find_mode(self, check, allowed=None):
+        """Returns the first mode of the activation map for which
+        check(mode_idx) is true, or -1 if there is none, the number of
+        modes checked and the candidates of the warm mode search.
+
+        The ordered search checks the modes in the order of the
+        activation map. The warm search first checks the previous mode
+        and its neighbours in the activation map, see
+        get_mode_candidates, in the order of the activation map. It then
+        checks the other modes in order up to the accepted candidate, or
+        all of them if no candidate was accepted, so that it finds the
+        same mode as the ordered search. If allowed from
+        get_allowed_modes is given, only those modes are checked."""
+        previous = self.current_mode
+        if allowed is None:
+            modes = range(self.n_modes)
+        else:
+            modes, allowed_set = allowed
+        candidates = []
+        if self.options["mode_search"] == "warm" and previous >= 0:
+            candidates = self.get_mode_candidates(previous)
+            if allowed is not None:
+                candidates = [mode_idx for mode_idx in candidates
+                              if mode_idx in allowed_set]
+        found = -1
+        n_modes_checked = 0
+        for mode_idx in candidates:
+            n_modes_checked += 1
+            if check(mode_idx):
+                found = mode_idx
+                break
+        for mode_idx in modes:
+            if found != -1 and mode_idx > found:
+                break
+            if mode_idx in candidates:
+                continue
+            n_modes_checked += 1
+            if check(mode_idx):
+                found = mode_idx
+                break
+        return found, n_modes_checked, candidates
+
+    def count_mode_search(self, previous, candidates):
+        """Counts whether the warm mode search found the mode among the
+        candidates of the previous mode."""
+        if not candidates:
+            return
+        if self.current_mode == previous:
+            self.mode_search_stats["previous"] += 1
+        elif self.current_mode in candidates:
+            self.mode_search_stats["neighbour"] += 1
+        else:
+            self.mode_search_stats["scan"] += 1
+
+    def get_mode_search_hit_rate(self):
+        """Returns the fraction of warm mode searches that found the mode
+        among the candidates, or None before any warm search."""
+        stats = self.mode_search_stats
+        n_searches = stats["previous"] + stats["neighbour"] + stats["scan"]
+        if n_searches == 0:
+            return None
+        return float(stats["previous"] + stats["neighbour"])/n_searches
+
+    def get_n_modes_searched(self):
+        """Returns the number of modes the mode_search_func evaluated to
+        find the current_mode."""
+        batch = self.options["mode_search"] == "batch"
+        if self.current_mode == -1 or batch:
+            return self.n_modes
+        return self.current_mode + 1
+
+    def check_tangent_cones(self, mode, suggested):
+        """Returns True if the inactive sets of the mode are in their
+        tangent cones with the suggested velocities, suggested being
+        currvals followed by the suggested control variables."""
+        if self.tangent_cone_func is None:
+            for in_TC_func in mode["in_tangent_cone_func_list"]:
+                if not in_TC_func(*suggested):
+                    return False
+            return True
+        mask = mode["inactive_mask"]
+        if mask == 0:
+            return True
+        bitmask = int(self.tangent_cone_func(*suggested)[2])
+        return (bitmask & mask) == mask
+
+    def get_mode_in_tangent_cone(self, mode, suggested):
+        """Returns the expression that is true if the inactive sets of
+        the mode are in their tangent cones, see check_tangent_cones."""
+        in_tc = cs.MX(1)
+        if self.tangent_cone_func is None:
+            for in_TC_func in mode["in_tangent_cone_func_list"]:
+                in_tc = cs.logic_and(in_tc, in_TC_func(*suggested))
+            return in_tc
+        if mode["inactive_mask"] == 0:
+            return in_tc
+        in_tcs = self.tangent_cone_func(*suggested)[0]
+        set_indices = self.get_set_indices()
+        for cnstr_idx in mode["inactive_sets"]:
+            in_tc = cs.logic_and(in_tc,
+                                 in_tcs[set_indices.index(cnstr_idx)])
+        return in_tc
+
+    def search_modes(self, currvals, nrob, nvirt):
+        """Calls the functions of the modes with find_mode until all
+        the inactive sets are in their tangent cones. Sets current_mode
+        and returns the control variables and the number of modes
+        checked. With the shared_expressions option, the shared pool is
+        evaluated first, and each shared_func checks the tangent cones
+        of its mode. Otherwise the tangent_cone_func
+        checks all the SetConstraints in one call, and the mode is
+        accepted if the bits of its inactive_mask are set."""
+        previous = self.current_mode
+        if self.shared_pool is not None:
+            shared_args = currvals + [self.shared_pool["func"](*currvals)]
+        allowed = None
+        if self.set_classification_func is not None:
+            self.set_classification = self.set_classification_func(
+                *currvals).full().ravel()
+            allowed = self.get_allowed_modes(self.set_classification)
+        results = {}
+
+        def check(mode_idx):
+            mode = self.get_mode(mode_idx)
+            if self.shared_pool is not None:
+                cntrl_var, ALLOKAY = mode["shared_func"](*shared_args)
+            else:
+                cntrl_var = mode["cntrl_var_func"](*currvals)
+            cntrl_rob = cntrl_var[:nrob]
+            suggested = currvals + [cntrl_rob]
+            if nvirt > 0:
+                cntrl_virt = cntrl_var[nrob:]
+                suggested += [cntrl_virt]
+            else:
+                cntrl_virt = None
+            if self.shared_pool is None:
+                ALLOKAY = self.check_tangent_cones(mode, suggested)
+            results[mode_idx] = (cntrl_rob, cntrl_virt)
+            return bool(ALLOKAY)
+
+        self.current_mode, n_modes_checked, candidates = self.find_mode(
+            check, allowed)
+        if self.current_mode == -1:
+            cntrl_rob = cs.DM.zeros(nrob)
+            cntrl_virt = None
+            if nvirt > 0:
+                cntrl_virt = cs.DM.zeros(nvirt)
+        else:
+            cntrl_rob, cntrl_virt = results[self.current_mode]
+        self.count_mode_search(previous, candidates)
+        return cntrl_rob, cntrl_virt, n_modes_checked
+
     def solve(self, time_var,
               robot_var,
               virtual_var=None,
@@ -516,6 +1462,9 @@ class PseudoInverseController(BaseController):
               warmstart_robot_vel_var=None,
               warmstart_virtual_vel_var=None,
               warmstart_slack_var=None):
+        instr = self.instrumentation
+        if instr is not None:
+            t_start = instr.clock()
         currvals = [time_var, robot_var]
         nrob = self.skill_spec.n_robot_var
         if virtual_var is not None and self.skill_spec._has_virtual:
@@ -526,31 +1475,274 @@ class PseudoInverseController(BaseController):
         if input_var is not None and self.skill_spec._has_input:
             currvals += [input_var]
         # Check all modes
-        NONEOKAY = True
-        for mode_idx, mode in enumerate(self.modes):
-            cntrl_var = mode["cntrl_var_func"](*currvals)
+        if instr is not None:
+            t_eval = instr.clock()
+        if self.mode_search_func is not None:
+            mode_num, cntrl_var = self.mode_search_func(*currvals)
+            self.current_mode = int(mode_num)
+            n_modes_checked = self.get_n_modes_searched()
             cntrl_rob = cntrl_var[:nrob]
-            suggested = currvals + [cntrl_rob]
             if nvirt > 0:
                 cntrl_virt = cntrl_var[nrob:]
-                suggested += [cntrl_virt]
             else:
                 cntrl_virt = None
-            ALLOKAY = True
-            intcstr = ""
-            for in_TC_func in mode["in_tangent_cone_func_list"]:
-                in_TC = in_TC_func(*suggested)
-                intcstr += str(int(in_TC))
-                if not in_TC:
-                    ALLOKAY = False
-                    break
-            if ALLOKAY:
-                NONEOKAY = False
-                self.current_mode = mode_idx
-                break
-        if NONEOKAY:
-            self.current_mode = -1
-            cntrl_rob = cs.DM.zeros(nrob)
-            if nvirt > 0:
-                cntrl_virt = cs.DM.zeros(nvirt)
+        else:
+            cntrl_rob, cntrl_virt, n_modes_checked = self.search_modes(
+                currvals, nrob, nvirt)
+        if instr is not None:
+            eval_time = instr.clock() - t_eval
+            instr.record("n_modes_checked", n_modes_checked)
+            instr.count("mode", self.current_mode)
+            self.record_tick(instr, t_start, eval_time)
         return cntrl_rob, cntrl_virt, None
+
+    def get_rollout_function(self, n_steps, dt, method="rk4"):
+        """Returns a function simulating the closed loop of the controller
+        for n_steps of dt, see rollout. The integrated state is
+        time_var, robot_var, virtual_var and input_var, with input_var
+        held constant. Each step is get_rk4_function or
+        get_euler_function on the control variables of
+        get_mode_search_expressions, and the steps are repeated with
+        mapaccum. The functions are kept for each n_steps, dt and
+        method, and can be mapped over initial values for sweeps."""
+        if method not in ["rk4", "euler"]:
+            raise ValueError("Unknown rollout method: "+str(method))
+        key = (n_steps, float(dt), method)
+        if self._rollout_funcs is None:
+            self._rollout_funcs = {}
+        if key in self._rollout_funcs:
+            return self._rollout_funcs[key]
+        spec = self.skill_spec
+        nrob = spec.n_robot_var
+        list_vars, list_names = self.get_mode_inputs()
+        batch = self.options["mode_search"] == "batch"
+        closed_loop = cs.Function("closed_loop", list_vars,
+                                  self.get_mode_search_expressions(batch),
+                                  list_names, ["mode", "cntrl_var"])
+        sizes = [var.numel() for var in list_vars]
+        offsets = [0]
+        for size in sizes:
+            offsets += [offsets[-1] + size]
+        x = cs.MX.sym("x", offsets[-1])
+
+        def dx_function(x):
+            mode_num, cntrl_var = closed_loop(*cs.vertsplit(x, offsets))
+            n_fixed = offsets[-1] - 1 - self.n_state_var
+            return cs.vertcat(1., cntrl_var, cs.MX.zeros(n_fixed))
+
+        if method == "rk4":
+            step = get_rk4_function(x, dx_function, dt)
+        else:
+            step = get_euler_function(x, dx_function, dt)
+        mode_num, cntrl_var = closed_loop(*cs.vertsplit(x, offsets))
+        step_func = cs.Function("rollout_step", [x],
+                                [step(x), cs.vertcat(mode_num, cntrl_var)])
+        steps = step_func.mapaccum("rollout_steps", n_steps)
+        var0 = [cs.MX.sym(var_name+"0", var.sparsity())
+                for var, var_name in zip(list_vars, list_names)]
+        states, cntrls = steps(cs.vertcat(*[cs.vec(var) for var in var0]))
+        exprs = [cs.horzcat(var0[0], states[0, :]),
+                 cs.horzcat(var0[1], states[1:1+nrob, :])]
+        expr_names = ["time_var", "robot_var"]
+        if spec.virtual_var is not None:
+            exprs += [cs.horzcat(var0[2], states[1+nrob:offsets[3], :])]
+            expr_names += ["virtual_var"]
+        exprs += [cntrls[1:1+nrob, :]]
+        expr_names += ["robot_vel_var"]
+        if spec.virtual_var is not None:
+            exprs += [cntrls[1+nrob:, :]]
+            expr_names += ["virtual_vel_var"]
+        exprs += [cntrls[0, :]]
+        expr_names += ["mode"]
+        self._rollout_funcs[key] = self.create_function(
+            "rollout",
+            var0,
+            exprs,
+            [var_name+"0" for var_name in list_names],
+            expr_names,
+            self.options["function_opts"]
+        )
+        return self._rollout_funcs[key]
+
+    def rollout(self, time_var0, robot_var0, n_steps, dt,
+                virtual_var0=None, input_var=None, method="rk4"):
+        """Simulates the closed loop of the controller in one compiled
+        function, see get_rollout_function. The input_var is held
+        constant, and virtual_var0 and input_var default to zeros.
+
+        Args:
+            time_var0 (float): initial time
+            robot_var0 (array): initial robot_var
+            n_steps (int): number of steps
+            dt (float): timestep
+            virtual_var0 (array): initial virtual_var
+            input_var (array): input_var during the rollout
+            method (str): "rk4" or "euler"
+
+        Return:
+            dict: numpy arrays with a row per step, "time_var" and
+                "robot_var" (and "virtual_var") with n_steps + 1 rows
+                including the initial values, "robot_vel_var" (and
+                "virtual_vel_var") with the control variables at the
+                start of each step, and "mode" with the mode of each
+                step, -1 when none was found.
+        """
+        spec = self.skill_spec
+        func = self.get_rollout_function(n_steps, dt, method)
+        args = [time_var0, robot_var0]
+        if spec.virtual_var is not None:
+            if virtual_var0 is None:
+                virtual_var0 = cs.np.zeros(spec.n_virtual_var)
+            args += [virtual_var0]
+        if spec.input_var is not None:
+            if input_var is None:
+                input_var = cs.np.zeros(spec.input_var.numel())
+            args += [input_var]
+        res = func.call([cs.DM(arg) for arg in args])
+        trajectory = {}
+        for name, val in zip(func.name_out(), res):
+            trajectory[name] = val.full().T
+        trajectory["time_var"] = trajectory["time_var"].ravel()
+        trajectory["mode"] = trajectory["mode"].ravel().astype(int)
+        return trajectory
+
+    def setup_fast_path(self):
+        """Sets up the buffers used by solve_into. Each mode gets a
+        function returning its control variables and whether they are in
+        the tangent cones, and the modes share their input and output
+        arrays with funcs[0], a function returning zeros. With the
+        lazy_modes option, the mode functions are set up when first
+        needed. With the compiled mode_search, the mode_search_func is
+        the only function. With the shared_expressions option, the
+        outputs of the shared pool are inputs of the modes."""
+        list_vars, list_names = self.get_mode_inputs()
+        sym_in = [cs.MX.sym(var_name, var.sparsity())
+                  for var, var_name in zip(list_vars, list_names)]
+        if self.mode_search_func is not None:
+            nrob = self.skill_spec.n_robot_var
+            mode_num, cntrl_var = self.mode_search_func(*sym_in)
+            cntrl_var = cs.densify(cntrl_var)
+            if self.skill_spec._has_virtual:
+                cntrl_virt = cntrl_var[nrob:]
+            else:
+                cntrl_virt = cs.MX(0, 1)
+            func = cs.Function("fast_mode_search", sym_in,
+                               [cntrl_var[:nrob], cntrl_virt, mode_num],
+                               list_names,
+                               ["robot_vel_var", "virtual_vel_var",
+                                "mode"])
+            buffered = BufferedFunction(func)
+            self._fast_path = self.get_fast_path_indices(buffered)
+            self._fast_path["funcs"] = [buffered]
+            self._fast_path["feedback"] = []
+            self._fast_path["mode"] = buffered.index_out("mode")
+            return self._fast_path
+        if self.skill_spec._has_virtual:
+            virt_zeros = cs.MX.zeros(self.skill_spec.n_virtual_var)
+        else:
+            virt_zeros = cs.MX(0, 1)
+        zeros_func = cs.Function("fast_mode_none", sym_in,
+                                 [cs.MX.zeros(self.skill_spec.n_robot_var),
+                                  virt_zeros, cs.MX.zeros(1)],
+                                 list_names,
+                                 ["robot_vel_var", "virtual_vel_var",
+                                  "in_tangent_cone"])
+        zeros_buffered = BufferedFunction(zeros_func)
+        self._fast_path = self.get_fast_path_indices(zeros_buffered)
+        self._fast_path["funcs"] = [zeros_buffered]
+        self._fast_path["feedback"] = []
+        self._fast_path["modes"] = {}
+        self._fast_path["mode"] = None
+        self._fast_path["set_classification"] = None
+        if self.set_classification_func is not None:
+            self._fast_path["set_classification"] = BufferedFunction(
+                self.set_classification_func, zeros_buffered.args)
+        self._fast_path["shared_pool"] = None
+        if self.shared_pool is not None:
+            self._fast_path["shared_pool"] = BufferedFunction(
+                self.shared_pool["func"], zeros_buffered.args)
+        if self._mode_cache is None:
+            for mode_idx in range(self.n_modes):
+                self.setup_fast_mode(self._fast_path, mode_idx)
+        return self._fast_path
+
+    def setup_fast_mode(self, fast_path, mode_idx):
+        """Sets up the function of the mode in the fast path."""
+        nrob = self.skill_spec.n_robot_var
+        mode = self.get_mode(mode_idx)
+        cntrl_var_func = mode[self.get_mode_function_key()]
+        zeros_buffered = fast_path["funcs"][0]
+        args = zeros_buffered.args
+        sym_in = [cs.MX.sym(cntrl_var_func.name_in(i),
+                            cntrl_var_func.sparsity_in(i))
+                  for i in range(cntrl_var_func.n_in())]
+        if self.shared_pool is not None:
+            cntrl_var, in_tc = cntrl_var_func(*sym_in)
+            args = args + fast_path["shared_pool"].res
+        else:
+            cntrl_var = cntrl_var_func(*sym_in)
+        cntrl_var = cs.densify(cntrl_var)
+        cntrl_rob = cntrl_var[:nrob]
+        suggested = sym_in + [cntrl_rob]
+        if self.skill_spec.virtual_var is not None:
+            suggested += [cntrl_var[nrob:]]
+        if self.skill_spec._has_virtual:
+            cntrl_virt = cntrl_var[nrob:]
+        else:
+            cntrl_virt = cs.MX(0, 1)
+        if self.shared_pool is None:
+            in_tc = self.get_mode_in_tangent_cone(mode, suggested)
+        func = cs.Function("fast_mode_"+str(mode_idx), sym_in,
+                           [cntrl_rob, cntrl_virt, cs.densify(in_tc)],
+                           cntrl_var_func.name_in(),
+                           ["robot_vel_var", "virtual_vel_var",
+                            "in_tangent_cone"])
+        buffered = BufferedFunction(func, args)
+        for i in range(2):
+            buffered.set_res(i, zeros_buffered.res[i])
+        fast_path["funcs"] += [buffered]
+        fast_path["modes"][mode_idx] = buffered
+        return buffered
+
+    def eval_fast_path(self, fast_path):
+        """Checks the modes in order, as in solve. Returns the number of
+        modes checked."""
+        if fast_path["mode"] is not None:
+            func = fast_path["funcs"][0]
+            func()
+            self.current_mode = int(func.res[fast_path["mode"]][0])
+            return self.get_n_modes_searched()
+        mode_funcs = fast_path["modes"]
+        lazy = self._mode_cache is not None
+        previous = self.current_mode
+        allowed = None
+        if fast_path["shared_pool"] is not None:
+            fast_path["shared_pool"]()
+        classification_func = fast_path["set_classification"]
+        if classification_func is not None:
+            classification_func()
+            self.set_classification = classification_func.res[0]
+            allowed = self.get_allowed_modes(self.set_classification)
+        evaluated = [-1]
+
+        def check(mode_idx):
+            if lazy:
+                self.get_mode(mode_idx)  # Marks it as recently used
+            func = mode_funcs.get(mode_idx, None)
+            if func is None:
+                func = self.setup_fast_mode(fast_path, mode_idx)
+            func()
+            evaluated[0] = mode_idx
+            return bool(func.res[2][0])
+
+        self.current_mode, n_modes_checked, candidates = self.find_mode(
+            check, allowed)
+        self.count_mode_search(previous, candidates)
+        if self.current_mode == -1:
+            funcs = fast_path["funcs"]
+            funcs[0].res[0].fill(0.)
+            funcs[0].res[1].fill(0.)
+        elif evaluated[0] != self.current_mode:
+            # The modes share the output buffers
+            check(self.current_mode)
+        return n_modes_checked
@@ -32,7 +32,17 @@ class ReactiveNLPController(BaseController):
     options_info = """TODO
     solver_name (str): type of solver, default ipopt.
     solver_opts (dict): solver options, see casadi.
-    function_opts (dict): problem function options. See below."""
+    function_opts (dict): problem function options. See below.
+    compile_cache (CompileCache, str): cache of the jit compiled
+        functions, or its directory, default None.
+    background_jit (bool): start with functions without jit, and swap
+        in the jit compiled functions and solver when they are compiled
+        in a background thread, default False. See jit_ready.
+    jit_callback (callable): called as jit_callback(controller, name)
+        when a jit compiled function is swapped in, default None.
+    hoist_constants (bool): evaluate the constant nonzeros of the
+        constraint bounds once during setup, default True. See
+        print_constant_structure."""
     weight_shifter = 0.001
 
     def __init__(self, skill_spec,
@@ -188,6 +198,14 @@ class ReactiveNLPController(BaseController):
             function_opts["print_time"] = False
         if "jit_options" not in function_opts:
             function_opts["jit_options"] = {"flags": "-O2"}
+        opt["compile_cache"] = self.get_compile_cache(
+            opt.get("compile_cache", None))
+        if "background_jit" not in opt:
+            opt["background_jit"] = False
+        if "jit_callback" not in opt:
+            opt["jit_callback"] = None
+        if "hoist_constants" not in opt:
+            opt["hoist_constants"] = True
         self._options = opt
 
     def get_regularised_cost_expr(self):
@@ -211,17 +229,18 @@ class ReactiveNLPController(BaseController):
         slack_var = self.skill_spec.slack_var
         n_slack = self.skill_spec.n_slack_var
         slack_ind = 0
+        spec = self.skill_spec  # Caches the derivatives
         for cnstr in self.skill_spec.constraints:
             expr_size = cnstr.expression.size()
             # What's the partials?
-            cnstr_expr = cnstr.jtimes(robot_var,
-                                      robot_vel_var)
+            cnstr_expr = spec.jtimes(cnstr.expression,
+                                     robot_var, robot_vel_var)
             if virtual_var is not None:
-                cnstr_expr += cnstr.jtimes(virtual_var,
-                                           virtual_vel_var)
+                cnstr_expr += spec.jtimes(cnstr.expression,
+                                          virtual_var, virtual_vel_var)
             # Everyone wants a feedforward in numerics
-            lb_cnstr_expr = -cnstr.jacobian(time_var)
-            ub_cnstr_expr = -cnstr.jacobian(time_var)
+            lb_cnstr_expr = -spec.jacobian(cnstr.expression, time_var)
+            ub_cnstr_expr = -spec.jacobian(cnstr.expression, time_var)
             # Setup bounds based on type
             if isinstance(cnstr, EqualityConstraint):
                 lb_cnstr_expr += -cs.mtimes(cnstr.gain, cnstr.expression)
@@ -252,6 +271,7 @@ class ReactiveNLPController(BaseController):
         return cnstr_expr_full, lb_cnstr_expr_full, ub_cnstr_expr_full
 
     def setup_solver(self):
+        self._fast_path = None  # Set up again by solve_into
         full_cost_expr = self.get_regularised_cost_expr()
         cnstr_expr, lb_cnstr_expr, ub_cnstr_expr = self.get_constraints_expr()
         # Define externals
@@ -271,12 +291,13 @@ class ReactiveNLPController(BaseController):
                     "p": cs.vertcat(*list_par),
                     "f": full_cost_expr,
                     "g": cnstr_expr}
-        self.solver = cs.nlpsol("solver",
-                                self.options["solver_name"],
-                                nlp_dict,
-                                self.options["solver_opts"])
+        self.solver = self.create_nlpsol("solver",
+                                         self.options["solver_name"],
+                                         nlp_dict,
+                                         self.options["solver_opts"])
 
     def setup_problem_functions(self):
+        self._fast_path = None  # Set up again by solve_into
         full_cost_expr = self.get_regularised_cost_expr()
         cnstr_expr, lb_cnstr_expr, ub_cnstr_expr = self.get_constraints_expr()
         # Define external inputs
@@ -293,19 +314,43 @@ class ReactiveNLPController(BaseController):
             list_vars += [input_var]
             list_names += ["input_var"]
         # Cost and cnstr have opt_var in them
-        cost_func = cs.Function("cost", list_vars+[self._opt_var],
-                                [full_cost_expr], list_names+["opt_var"],
-                                ["cost"], self.options["function_opts"])
-        cnstr_func = cs.Function("cnstr", list_vars+[self._opt_var],
-                                 [cnstr_expr], list_names+["opt_var"],
-                                 ["cnstr"], self.options["function_opts"])
+        func_opts = self.options["function_opts"]
+        cost_func = self.create_function("cost", list_vars+[self._opt_var],
+                                         [full_cost_expr],
+                                         list_names+["opt_var"],
+                                         ["cost"], func_opts)
+        cnstr_func = self.create_function("cnstr", list_vars+[self._opt_var],
+                                          [cnstr_expr],
+                                          list_names+["opt_var"],
+                                          ["cnstr"], func_opts)
         # lb and ub are for numerics
-        lb_cnstr_func = cs.Function("lb_cnstr", list_vars, [lb_cnstr_expr],
-                                    list_names, ["lb_cnstr"],
-                                    self.options["function_opts"])
-        ub_cnstr_func = cs.Function("ub_cnstr", list_vars, [ub_cnstr_expr],
-                                    list_names, ["ub_cnstr"],
-                                    self.options["function_opts"])
+        self.constant_structure = {}
+        if self.options["hoist_constants"]:
+            # Constant bounds are evaluated once, varying ones together
+            bounds = self.hoist_constant_structure("cnstr_bounds",
+                                                   list_vars, list_names,
+                                                   [lb_cnstr_expr,
+                                                    ub_cnstr_expr],
+                                                   ["lb_cnstr", "ub_cnstr"],
+                                                   func_opts)
+            self.constant_structure["bounds"] = bounds
+            bounds_func = bounds["full_func"]
+            sym_vars = [cs.MX.sym(list_names[i], bounds_func.sparsity_in(i))
+                        for i in range(bounds_func.n_in())]
+            lb_expr, ub_expr = bounds_func(*sym_vars)
+            lb_cnstr_func = cs.Function("lb_cnstr", sym_vars, [lb_expr],
+                                        list_names, ["lb_cnstr"])
+            ub_cnstr_func = cs.Function("ub_cnstr", sym_vars, [ub_expr],
+                                        list_names, ["ub_cnstr"])
+        else:
+            lb_cnstr_func = self.create_function("lb_cnstr", list_vars,
+                                                 [lb_cnstr_expr],
+                                                 list_names, ["lb_cnstr"],
+                                                 func_opts)
+            ub_cnstr_func = self.create_function("ub_cnstr", list_vars,
+                                                 [ub_cnstr_expr],
+                                                 list_names, ["ub_cnstr"],
+                                                 func_opts)
         self.cost_func = cost_func
         self.cnstr_func = cnstr_func
         self.lb_cnstr_func = lb_cnstr_func
@@ -356,6 +401,7 @@ class ReactiveNLPController(BaseController):
         ub_cnstr_expr_list = []
         slack_ind = 0
         virt_ind = 0
+        spec = self.skill_spec  # Caches the derivatives
         for cnstr in self.skill_spec.constraints:
             cnstr_expr = 0.0
             found_virt = False
@@ -363,15 +409,18 @@ class ReactiveNLPController(BaseController):
             expr_size = cnstr.expression.size()
             # Look for virtual variables in expr
             if nvirt > 0:
-                J_virt = cnstr.jtimes(virtual_var, virtual_vel_var)
+                J_virt = spec.jtimes(cnstr.expression,
+                                     virtual_var, virtual_vel_var)
                 if J_virt.nnz() > 0:
                     cnstr_expr += J_virt
                     found_virt = True
                     virt_ind += 1
             # Setup bounds/functions for numerics
-            rob_der = cnstr.jtimes(robot_var, robot_vel_var)
-            lb_cnstr_expr = -cnstr.jacobian(time_var) - rob_der
-            ub_cnstr_expr = -cnstr.jacobian(time_var) - rob_der
+            rob_der = spec.jtimes(cnstr.expression,
+                                  robot_var, robot_vel_var)
+            time_der = spec.jacobian(cnstr.expression, time_var)
+            lb_cnstr_expr = -time_der - rob_der
+            ub_cnstr_expr = -time_der - rob_der
             if isinstance(cnstr, EqualityConstraint):
                 lb_cnstr_expr += -cs.mtimes(cnstr.gain, cnstr.expression)
                 ub_cnstr_expr += -cs.mtimes(cnstr.gain, cnstr.expression)
@@ -403,14 +452,14 @@ class ReactiveNLPController(BaseController):
         cnstr_expr_full = cs.vertcat(*cnstr_expr_list)
         lb_cnstr_expr_full = cs.vertcat(*lb_cnstr_expr_list)
         ub_cnstr_expr_full = cs.vertcat(*ub_cnstr_expr_list)
-        lb_cnstr_func = cs.Function("lb_cnstr", list_par,
-                                    [lb_cnstr_expr_full],
-                                    list_names, ["lb_cnstr"],
-                                    self.options["function_opts"])
-        ub_cnstr_func = cs.Function("ub_cnstr", list_par,
-                                    [ub_cnstr_expr_full],
-                                    list_names, ["ub_cnstr"],
-                                    self.options["function_opts"])
+        lb_cnstr_func = self.create_function("lb_cnstr", list_par,
+                                             [lb_cnstr_expr_full],
+                                             list_names, ["lb_cnstr"],
+                                             self.options["function_opts"])
+        ub_cnstr_func = self.create_function("ub_cnstr", list_par,
+                                             [ub_cnstr_expr_full],
+                                             list_names, ["ub_cnstr"],
+                                             self.options["function_opts"])
         self._initial_problem = {
             "nlp": {
                 "x": cs.vertcat(*opt_var),
@@ -423,10 +472,12 @@ class ReactiveNLPController(BaseController):
                 "ub": ub_cnstr_func
             }
         }
-        self.initial_solver = cs.nlpsol("solver",
-                                        self.options["solver_name"],
-                                        self._initial_problem["nlp"],
-                                        self.options["initial_solver_opts"])
+        self.initial_solver = self.create_nlpsol(
+            "solver",
+            self.options["solver_name"],
+            self._initial_problem["nlp"],
+            self.options["initial_solver_opts"]
+        )
         self._has_initial = True
 
     def solve_initial_problem(self,  time_var0, robot_var0,
@@ -473,6 +524,9 @@ class ReactiveNLPController(BaseController):
               warmstart_virtual_vel_var=None,
               warmstart_slack_var=None):
         """Solve the skill specification."""
+        instr = self.instrumentation
+        if instr is not None:
+            t_start = instr.clock()
         # Useful sizes
         nrob = self.skill_spec.n_robot_var
         nvirt = self.skill_spec.n_virtual_var
@@ -486,15 +540,27 @@ class ReactiveNLPController(BaseController):
         if input_var is not None and has_input:
             currvals += [input_var]
         # Get numerics
-        lb_num = self.lb_cnstr_func(*currvals)
-        ub_num = self.ub_cnstr_func(*currvals)
+        if instr is not None:
+            t_eval = instr.clock()
+        if "bounds" in self.constant_structure:
+            bounds = self.constant_structure["bounds"]
+            lb_num, ub_num = self.eval_constant_structure(bounds, currvals)
+        else:
+            lb_num = self.lb_cnstr_func(*currvals)
+            ub_num = self.ub_cnstr_func(*currvals)
+        if instr is not None:
+            eval_time = instr.clock() - t_eval
         # Do we have warmstart?
         ws_rob = warmstart_robot_vel_var is not None
         ws_virt = warmstart_virtual_vel_var is not None and has_virtual
         ws_slack = warmstart_slack_var is not None and nslack > 0
         if not (ws_rob or ws_virt or ws_slack):
             # If no warmstart, then jsut calculate results
+            if instr is not None:
+                t_solver = instr.clock()
             self.res = self.solver(ubg=ub_num, lbg=lb_num, p=cs.vertcat(*currvals))
+            if instr is not None:
+                solver_time = instr.clock() - t_solver
         else:
             # Pack warmstart vector
             warmstart = []
@@ -514,10 +580,13 @@ class ReactiveNLPController(BaseController):
                 if nslack > 0:
                     warmstart += [cs.DM.zeros(nslack)]
             # Calculate results
-
+            if instr is not None:
+                t_solver = instr.clock()
             self.res = self.solver(x0=cs.vertcat(*warmstart),
                                    ubg=ub_num, lbg=lb_num,
                                    p=cs.vertcat(*currvals))
+            if instr is not None:
+                solver_time = instr.clock() - t_solver
         res_robot_vel = self.res["x"][:nrob]
         if nvirt > 0 and has_virtual:
             res_virtual_vel = self.res["x"][nrob:nrob+nvirt]
@@ -531,4 +600,35 @@ class ReactiveNLPController(BaseController):
             res_slack = self.res["x"][nrob+nvirt: nrob+nvirt+nslack]
         else:
             res_slack = None
+        if instr is not None:
+            self.record_tick(instr, t_start, eval_time, solver_time)
         return res_robot_vel, res_virtual_vel, res_slack
+
+    def get_fast_function(self):
+        """Returns the bound functions and the solver combined into one
+        function for solve_into."""
+        nrob = self.skill_spec.n_robot_var
+        nvirt = self.skill_spec.n_virtual_var
+        nslack = self.skill_spec.n_slack_var
+        has_virtual = self.skill_spec._has_virtual
+        lb_cnstr_func = self.lb_cnstr_func
+        sym_in = [cs.MX.sym(lb_cnstr_func.name_in(i),
+                            lb_cnstr_func.sparsity_in(i))
+                  for i in range(lb_cnstr_func.n_in())]
+        res = self.solver(lbg=self.lb_cnstr_func(*sym_in),
+                          ubg=self.ub_cnstr_func(*sym_in),
+                          p=cs.vertcat(*sym_in))
+        res_x = res["x"]
+        if not has_virtual:
+            # Same indexing as solve
+            nvirt_slack = 0
+            res_virtual_vel = cs.MX(0, 1)
+        else:
+            nvirt_slack = nvirt
+            res_virtual_vel = res_x[nrob:nrob+nvirt]
+        func = cs.Function("fast_func", sym_in,
+                           [res_x[:nrob], res_virtual_vel,
+                            res_x[nrob+nvirt_slack:nrob+nvirt_slack+nslack]],
+                           lb_cnstr_func.name_in(),
+                           ["robot_vel_var", "virtual_vel_var", "slack_var"])
+        return func, []
@@ -27,7 +27,8 @@ class ReactiveQPController(BaseController):
     have a "weight_shifter", or regularization constant in the
     cost. It is to shift the weight between v and the slack
     variables. If you want a more complex cost, you can overload the
-    H_func with ANY function that relies on the current values.
+    H_func with ANY function that relies on the current values, given
+    that fused_qp_data is set to False in the options.
 
     Args:
         skill_spec (SkillSpecification): skill specification
@@ -40,7 +41,21 @@ class ReactiveQPController(BaseController):
     controller_type = "ReactiveQPController"
     options_info = """TODO
     solver_opts (dict): solver options, see casadi.
-    function_opts (dict): problem function options. See below."""
+    function_opts (dict): problem function options. See below.
+    fused_qp_data (bool): evaluate H, A, Blb and Bub with a single
+        function call per solve, default True.
+    compile_cache (CompileCache, str): cache of the jit compiled
+        functions, or its directory, default None.
+    background_jit (bool): start with functions without jit, and swap
+        in the jit compiled functions when they are compiled in a
+        background thread, default False. See jit_ready.
+    jit_callback (callable): called as jit_callback(controller, name)
+        when a jit compiled function is swapped in, default None.
+    hoist_constants (bool): evaluate the constant nonzeros of the fused
+        QP data once during setup, default True. See
+        print_constant_structure.
+    persistent_warmstart (bool): warmstart each solve with the previous
+        x, lam_x and lam_a, default False. See reset_warmstart."""
     weight_shifter = 0.001  # See eTaSL paper, corresponds to mu symbol
 
     def __init__(self, skill_spec,
@@ -54,6 +69,12 @@ class ReactiveQPController(BaseController):
         self.virtual_var_weights = virtual_var_weights
         self.slack_var_weights = slack_var_weights
         self.options = options
+        # Persistent warmstart, see reset_warmstart
+        self._warmstart = None
+        self.warmstart_stats = {"n_warm": 0,
+                                "n_cold": 0,
+                                "n_reduced": 0,
+                                "cold_iter_count": None}
 
     @property
     def robot_var_weights(self):
@@ -170,6 +191,18 @@ class ReactiveQPController(BaseController):
             function_opts["print_time"] = False
         if "jit_options" not in function_opts:
             function_opts["jit_options"] = {"flags": "-O2"}
+        if "fused_qp_data" not in opt:
+            opt["fused_qp_data"] = True
+        opt["compile_cache"] = self.get_compile_cache(
+            opt.get("compile_cache", None))
+        if "background_jit" not in opt:
+            opt["background_jit"] = False
+        if "jit_callback" not in opt:
+            opt["jit_callback"] = None
+        if "hoist_constants" not in opt:
+            opt["hoist_constants"] = True
+        if "persistent_warmstart" not in opt:
+            opt["persistent_warmstart"] = False
         self._options = opt
 
     def get_cost_expr(self):
@@ -204,16 +237,18 @@ class ReactiveQPController(BaseController):
         virtual_var = self.skill_spec.virtual_var
         n_slack = self.skill_spec.n_slack_var
         slack_ind = 0
+        spec = self.skill_spec  # Caches the derivatives
         for cnstr in self.skill_spec.constraints:
             expr_size = cnstr.expression.size()
             # What's A*opt_var?
-            cnstr_expr = cnstr.jacobian(robot_var)
+            cnstr_expr = spec.jacobian(cnstr.expression, robot_var)
             if virtual_var is not None:
                 cnstr_expr = cs.horzcat(cnstr_expr,
-                                        cnstr.jacobian(virtual_var))
+                                        spec.jacobian(cnstr.expression,
+                                                      virtual_var))
             # Everyone wants a feedforward
-            lb_cnstr_expr = -cnstr.jacobian(time_var)
-            ub_cnstr_expr = -cnstr.jacobian(time_var)
+            lb_cnstr_expr = -spec.jacobian(cnstr.expression, time_var)
+            ub_cnstr_expr = -spec.jacobian(cnstr.expression, time_var)
             # Setup bounds
             if isinstance(cnstr, EqualityConstraint):
                 lb_cnstr_expr += -cs.mtimes(cnstr.gain, cnstr.expression)
@@ -251,6 +286,7 @@ class ReactiveQPController(BaseController):
         This uses the casadi low-level interface for QP problems. It
         uses the sparsity of the H, A, B_lb and B_ub matrices.
         """
+        self._fast_path = None  # Set up again by solve_into
         H_expr = self.get_cost_expr()
         A_expr, Blb_expr, Bub_expr = self.get_constraints_expr()
         self.solver = cs.conic("solver",
@@ -265,7 +301,14 @@ class ReactiveQPController(BaseController):
         With opt_var = v, optimization problem is of the form:
            min_v   v^T*H*v
            s.t.: B_lb <= A*v <= B_ub
-        In this function we define the functions that form A, B_lb and B_ub."""
+        In this function we define the functions that form A, B_lb and
+        B_ub. With the fused_qp_data option, H, A, B_lb and B_ub are
+        outputs of the single qp_data_func so that the forward
+        kinematics and jacobians shared between them are only evaluated
+        once per solve. With the hoist_constants option, the nonzeros
+        that do not depend on the variables (typically H and the slack
+        columns of A) are evaluated here and not per solve."""
+        self._fast_path = None  # Set up again by solve_into
         H_expr = self.get_cost_expr()
         A_expr, Blb_expr, Bub_expr = self.get_constraints_expr()
         time_var = self.skill_spec.time_var
@@ -280,22 +323,38 @@ class ReactiveQPController(BaseController):
         if input_var is not None and self.skill_spec._has_input:
             list_vars += [input_var]
             list_names += ["input_var"]
-        H_func = cs.Function("H_func", list_vars, [H_expr],
-                             list_names, ["H"],
-                             self.options["function_opts"])
-        A_func = cs.Function("A_func", list_vars, [A_expr],
-                             list_names, ["A"],
-                             self.options["function_opts"])
-        Blb_func = cs.Function("Blb_expr", list_vars, [Blb_expr],
-                               list_names, ["Blb"],
-                               self.options["function_opts"])
-        Bub_func = cs.Function("Bub_expr", list_vars, [Bub_expr],
-                               list_names, ["Bub"],
-                               self.options["function_opts"])
-        self.H_func = H_func
-        self.A_func = A_func
-        self.Blb_func = Blb_func
-        self.Bub_func = Bub_func
+        func_opts = self.options["function_opts"]
+        self.constant_structure = {}
+        if self.options["fused_qp_data"] and self.options["hoist_constants"]:
+            qp_data = self.hoist_constant_structure("qp_data_func",
+                                                    list_vars, list_names,
+                                                    [H_expr, A_expr,
+                                                     Blb_expr, Bub_expr],
+                                                    ["H", "A", "Blb", "Bub"],
+                                                    func_opts)
+            self.constant_structure["qp_data"] = qp_data
+            self.qp_data_func = qp_data["full_func"]
+        elif self.options["fused_qp_data"]:
+            self.qp_data_func = self.create_function("qp_data_func",
+                                                     list_vars,
+                                                     [H_expr, A_expr,
+                                                      Blb_expr, Bub_expr],
+                                                     list_names,
+                                                     ["H", "A", "Blb", "Bub"],
+                                                     func_opts)
+        else:
+            self.H_func = self.create_function("H_func", list_vars,
+                                               [H_expr], list_names,
+                                               ["H"], func_opts)
+            self.A_func = self.create_function("A_func", list_vars,
+                                               [A_expr], list_names,
+                                               ["A"], func_opts)
+            self.Blb_func = self.create_function("Blb_expr", list_vars,
+                                                 [Blb_expr], list_names,
+                                                 ["Blb"], func_opts)
+            self.Bub_func = self.create_function("Bub_expr", list_vars,
+                                                 [Bub_expr], list_names,
+                                                 ["Bub"], func_opts)
 
     def setup_initial_problem_solver(self):
         """Sets up the initial problem solver, for finding slack and virtual
@@ -337,13 +396,14 @@ class ReactiveQPController(BaseController):
         ub_cnstr_expr_list = []
         slack_ind = 0
         virt_ind = 0
+        spec = self.skill_spec  # Caches the derivatives
         for cnstr in self.skill_spec.constraints:
             found_virt = False
             found_slack = False
             expr_size = cnstr.expression.size()
             # Look for virtual variables
             if nvirt > 0:
-                J_virt = cs.jacobian(cnstr.expression, virtual_var)
+                J_virt = spec.jacobian(cnstr.expression, virtual_var)
                 if J_virt.nnz() > 0:  # if it has non-zero elements
                     cnstr_expr = J_virt
                     found_virt = True
@@ -351,9 +411,11 @@ class ReactiveQPController(BaseController):
                 else:
                     cnstr_expr = cs.DM.zeros((expr_size[0], nvirt))
             # Setup bounds/functions for numerics
-            rob_der = cnstr.jtimes(robot_var, robot_vel_var)
-            lb_cnstr_expr = -cnstr.jacobian(time_var) - rob_der
-            ub_cnstr_expr = -cnstr.jacobian(time_var) - rob_der
+            rob_der = spec.jtimes(cnstr.expression,
+                                  robot_var, robot_vel_var)
+            time_der = spec.jacobian(cnstr.expression, time_var)
+            lb_cnstr_expr = -time_der - rob_der
+            ub_cnstr_expr = -time_der - rob_der
             if isinstance(cnstr, EqualityConstraint):
                 lb_cnstr_expr += -cs.mtimes(cnstr.gain, cnstr.expression)
                 ub_cnstr_expr += -cs.mtimes(cnstr.gain, cnstr.expression)
@@ -400,22 +462,27 @@ class ReactiveQPController(BaseController):
             currval_vars += [input_var]
             currval_names += ["input_var"]
         func_opts = self.options["function_opts"]
-        self._initial_problem = {"H": cs.Function("H_initial", currval_vars,
-                                                  [H_expr], currval_names,
-                                                  ["H"], func_opts),
-                                 "A": cs.Function("A_initial", currval_vars,
-                                                  [A_expr], currval_names,
-                                                  ["A"], func_opts),
-                                 "Blb": cs.Function("Blb_initial",
-                                                    currval_vars,
-                                                    [Blb_expr],
-                                                    currval_names,
-                                                    ["Blb"], func_opts),
-                                 "Bub": cs.Function("Bub_initial",
-                                                    currval_vars,
-                                                    [Bub_expr],
-                                                    currval_names,
-                                                    ["Bub"], func_opts)}
+        create_function = self.create_function
+        self._initial_problem = {"H": create_function("H_initial",
+                                                      currval_vars,
+                                                      [H_expr],
+                                                      currval_names,
+                                                      ["H"], func_opts),
+                                 "A": create_function("A_initial",
+                                                      currval_vars,
+                                                      [A_expr],
+                                                      currval_names,
+                                                      ["A"], func_opts),
+                                 "Blb": create_function("Blb_initial",
+                                                        currval_vars,
+                                                        [Blb_expr],
+                                                        currval_names,
+                                                        ["Blb"], func_opts),
+                                 "Bub": create_function("Bub_initial",
+                                                        currval_vars,
+                                                        [Bub_expr],
+                                                        currval_names,
+                                                        ["Bub"], func_opts)}
         self.initial_solver = cs.conic("solver",
                                        self.options["solver_name"],
                                        {"h": H_expr.sparsity(),
@@ -458,6 +525,173 @@ class ReactiveQPController(BaseController):
             res_slack = res["x"][nvirt:nvirt+nslack]
         return res_virt, res_slack
 
+    def get_qp_data_function(self):
+        """Returns a function with H, A, Blb and Bub as outputs. Without
+        the fused_qp_data option, the separate functions are combined
+        into one."""
+        if self.options["fused_qp_data"]:
+            return self.qp_data_func
+        sym_in = [cs.MX.sym(self.H_func.name_in(i),
+                            self.H_func.sparsity_in(i))
+                  for i in range(self.H_func.n_in())]
+        return cs.Function("qp_data_func", sym_in,
+                           [self.H_func(*sym_in),
+                            self.A_func(*sym_in),
+                            self.Blb_func(*sym_in),
+                            self.Bub_func(*sym_in)],
+                           self.H_func.name_in(),
+                           ["H", "A", "Blb", "Bub"])
+
+    def get_batch_functions(self, n_samples, parallelization="serial"):
+        """Returns the QP data function and the solver mapped over
+        n_samples. The mapped functions are cached, so repeated calls
+        with the same arguments are cheap.
+
+        Args:
+            n_samples (int): number of samples solved in one call
+            parallelization (str): "serial", "unroll", "openmp" or "thread"
+        Return:
+            tuple: (qp_data_map, solver_map) casadi functions
+        """
+        if not hasattr(self, "_batch_functions"):
+            self._batch_functions = {}
+        key = (n_samples, parallelization)
+        if key in self._batch_functions:
+            return self._batch_functions[key]
+        qp_data_func = self.get_qp_data_function()
+        qp_data_map = qp_data_func.map(n_samples, parallelization)
+        solver_map = self.solver.map(n_samples, parallelization)
+        self._batch_functions[key] = (qp_data_map, solver_map)
+        return qp_data_map, solver_map
+
+    def solve_batch(self, time_var,
+                    robot_var,
+                    virtual_var=None,
+                    input_var=None,
+                    parallelization="serial"):
+        """Solve the skill specification for a batch of samples.
+
+        The samples are stacked along the first axis, i.e. time_var has
+        shape (n_samples,) and robot_var has shape (n_samples,
+        n_robot_var). The QP data and the QPs are evaluated with mapped
+        functions, see get_batch_functions. Warmstarts are not used, and
+        the result of the solver is kept in batch_res so that res and the
+        persistent_warmstart stay those of the last solve.
+
+        Return:
+            tuple: (robot_vel, virtual_vel, slack) as numpy arrays with
+            n_samples rows, virtual_vel and slack can be None.
+        """
+        # Useful sizes
+        nrob = self.skill_spec.n_robot_var
+        nvirt = self.skill_spec.n_virtual_var
+        nslack = self.skill_spec.n_slack_var
+        has_virtual = self.skill_spec._has_virtual
+        has_input = self.skill_spec._has_input
+        time_var = cs.np.atleast_1d(cs.np.asarray(time_var, dtype=float))
+        n_samples = time_var.shape[0]
+        # Pack current values, one column per sample
+        currvals = [time_var.reshape((1, n_samples))]
+        robot_var = cs.np.asarray(robot_var, dtype=float)
+        currvals += [robot_var.reshape((n_samples, nrob)).T]
+        if virtual_var is not None and has_virtual:
+            virtual_var = cs.np.asarray(virtual_var, dtype=float)
+            currvals += [virtual_var.reshape((n_samples, nvirt)).T]
+        if input_var is not None and has_input:
+            ninput = self.skill_spec.n_input_var
+            input_var = cs.np.asarray(input_var, dtype=float)
+            currvals += [input_var.reshape((n_samples, ninput)).T]
+        qp_data_map, solver_map = self.get_batch_functions(n_samples,
+                                                           parallelization)
+        H, A, Blb, Bub = qp_data_map(*currvals)
+        self.batch_res = solver_map(h=H, a=A, lba=Blb, uba=Bub)
+        res_x = self.batch_res["x"].full().T
+        res_robot_vel = res_x[:, :nrob]
+        if nvirt > 0 and has_virtual:
+            res_virtual_vel = res_x[:, nrob:nrob+nvirt]
+        else:
+            res_virtual_vel = None
+        if nslack > 0:
+            if not has_virtual:
+                # handles user error when user adds virtual_var
+                # but it's not actually in the expressions
+                nvirt = 0
+            res_slack = res_x[:, nrob+nvirt:nrob+nvirt+nslack]
+        else:
+            res_slack = None
+        return res_robot_vel, res_virtual_vel, res_slack
+
+    def get_fast_function(self):
+        """Returns the QP data function and the solver combined into one
+        function for solve_into. With the persistent_warmstart option,
+        the primal-dual solution is fed back between calls."""
+        nrob = self.skill_spec.n_robot_var
+        nvirt = self.skill_spec.n_virtual_var
+        nslack = self.skill_spec.n_slack_var
+        has_virtual = self.skill_spec._has_virtual
+        qp_data_func = self.get_qp_data_function()
+        sym_in = [cs.MX.sym(qp_data_func.name_in(i),
+                            qp_data_func.sparsity_in(i))
+                  for i in range(qp_data_func.n_in())]
+        list_names = qp_data_func.name_in()
+        H, A, Blb, Bub = qp_data_func(*sym_in)
+        solver_args = {"h": H, "a": A, "lba": Blb, "uba": Bub}
+        feedback = []
+        if self.options["persistent_warmstart"]:
+            for name in ["x", "lam_x", "lam_a"]:
+                warm = cs.MX.sym(name+"0", self.solver.sparsity_in(name+"0"))
+                solver_args[name+"0"] = warm
+                sym_in += [warm]
+                list_names += [name+"0"]
+                feedback += [(name+"0", name)]
+        res = self.solver(**solver_args)
+        res_x = res["x"]
+        if not has_virtual:
+            # Same indexing as solve
+            nvirt_slack = 0
+            res_virtual_vel = cs.MX(0, 1)
+        else:
+            nvirt_slack = nvirt
+            res_virtual_vel = res_x[nrob:nrob+nvirt]
+        exprs = [res_x[:nrob], res_virtual_vel,
+                 res_x[nrob+nvirt_slack:nrob+nvirt_slack+nslack]]
+        expr_names = ["robot_vel_var", "virtual_vel_var", "slack_var"]
+        for name_in, name_out in feedback:
+            exprs += [res[name_out]]
+            expr_names += [name_out]
+        func = cs.Function("fast_func", sym_in, exprs,
+                           list_names, expr_names)
+        return func, feedback
+
+    def reset_warmstart(self):
+        """Forget the stored primal-dual solution used by the
+        persistent_warmstart option. Call this when switching skills or
+        when the robot has moved far since the last solve."""
+        self._warmstart = None
+        fast_path = getattr(self, "_fast_path", None)
+        if fast_path is not None:
+            for idx_in, idx_out in fast_path["feedback"]:
+                fast_path["funcs"][0].args[idx_in].fill(0.)
+
+    def _update_warmstart(self, warm):
+        """Stores the latest solution for the next solve and counts how
+        often the warmstart reduced the solver iterations compared to
+        the last cold start."""
+        stats = self.warmstart_stats
+        iter_count = self.solver.stats().get("iter_count", None)
+        if warm:
+            stats["n_warm"] += 1
+            cold_iter_count = stats["cold_iter_count"]
+            if iter_count is not None and cold_iter_count is not None:
+                if iter_count < cold_iter_count:
+                    stats["n_reduced"] += 1
+        else:
+            stats["n_cold"] += 1
+            stats["cold_iter_count"] = iter_count
+        self._warmstart = {"x": self.res["x"],
+                           "lam_x": self.res["lam_x"],
+                           "lam_a": self.res["lam_a"]}
+
     def solve(self, time_var,
               robot_var,
               virtual_var=None,
@@ -466,7 +700,14 @@ class ReactiveQPController(BaseController):
               warmstart_virtual_vel_var=None,
               warmstart_slack_var=None):
         """Solve the skill specification.
+
+        With the persistent_warmstart option the previous primal and
+        dual solution is passed to the solver. The warmstart_* arguments
+        take precedence over the stored primal solution.
         """
+        instr = self.instrumentation
+        if instr is not None:
+            t_start = instr.clock()
         # Useful sizes
         nrob = self.skill_spec.n_robot_var
         nvirt = self.skill_spec.n_virtual_var
@@ -480,18 +721,26 @@ class ReactiveQPController(BaseController):
         if input_var is not None and has_input:
             currvals += [input_var]
         # Get numerics
-        H = self.H_func(*currvals)
-        A = self.A_func(*currvals)
-        Blb = self.Blb_func(*currvals)
-        Bub = self.Bub_func(*currvals)
+        if instr is not None:
+            t_eval = instr.clock()
+        if "qp_data" in self.constant_structure:
+            qp_data = self.constant_structure["qp_data"]
+            H, A, Blb, Bub = self.eval_constant_structure(qp_data, currvals)
+        elif self.options["fused_qp_data"]:
+            H, A, Blb, Bub = self.qp_data_func(*currvals)
+        else:
+            H = self.H_func(*currvals)
+            A = self.A_func(*currvals)
+            Blb = self.Blb_func(*currvals)
+            Bub = self.Bub_func(*currvals)
+        if instr is not None:
+            eval_time = instr.clock() - t_eval
+        solver_args = {"h": H, "a": A, "lba": Blb, "uba": Bub}
         # Do we have warmstart?
         ws_rob = warmstart_robot_vel_var is not None
         ws_virt = warmstart_virtual_vel_var is not None and has_virtual
         ws_slack = warmstart_slack_var is not None and nslack > 0
-        if not (ws_rob or ws_virt or ws_slack):
-            # If no warmstart, then just calculate results
-            self.res = self.solver(h=H, a=A, lba=Blb, uba=Bub)
-        else:
+        if ws_rob or ws_virt or ws_slack:
             # Pack warmstart vector
             warmstart = []
             if ws_rob:
@@ -508,9 +757,23 @@ class ReactiveQPController(BaseController):
             else:
                 if nslack > 0:
                     warmstart += [cs.DM.zeros(nslack)]
-            # Calculate results
-            self.res = self.solver(x0=cs.vertcat(*warmstart),
-                                   h=H, a=A, lba=Blb, uba=Bub)
+            solver_args["x0"] = cs.vertcat(*warmstart)
+        persistent = self.options["persistent_warmstart"]
+        warm = persistent and self._warmstart is not None
+        if warm:
+            # Previous primal-dual solution, explicit warmstart wins
+            if "x0" not in solver_args:
+                solver_args["x0"] = self._warmstart["x"]
+            solver_args["lam_x0"] = self._warmstart["lam_x"]
+            solver_args["lam_a0"] = self._warmstart["lam_a"]
+        # Calculate results
+        if instr is not None:
+            t_solver = instr.clock()
+        self.res = self.solver(**solver_args)
+        if instr is not None:
+            solver_time = instr.clock() - t_solver
+        if persistent:
+            self._update_warmstart(warm)
         res_robot_vel = self.res["x"][:nrob]
         if nvirt > 0 and has_virtual:
             res_virtual_vel = self.res["x"][nrob: nrob+nvirt]
@@ -524,5 +787,6 @@ class ReactiveQPController(BaseController):
             res_slack = self.res["x"][nrob+nvirt: nrob+nvirt+nslack]
         else:
             res_slack = None
-
+        if instr is not None:
+            self.record_tick(instr, t_start, eval_time, solver_time)
         return res_robot_vel, res_virtual_vel, res_slack
@@ -0,0 +1,119 @@
+"""Instrumentation
+
+This module contains the Instrumentation class used by the controllers
+to record where the time of a solve goes. Each recorded quantity is
+stored in a fixed-size ring buffer, so that a controller can run with
+instrumentation for as long as it wants without growing in memory, and
+the summaries cover the latest ticks. Controllers only record when
+their instrumentation attribute is set, see
+BaseController.enable_instrumentation.
+
+The recorded quantities of the controllers are:
+    eval: numeric evaluation of the problem functions in seconds
+    solver: the call to the solver in seconds
+    pack: the rest of solve, packing of inputs and results, in seconds
+    total: the whole solve in seconds
+    iter_count: iterations of the solver
+    n_modes_checked: modes checked by the PseudoInverseController
+and the counted values are the return_status of the solver and the
+mode chosen by the PseudoInverseController.
+"""
+import sys
+import time
+import casadi as cs
+
+try:
+    clock = time.perf_counter
+except AttributeError:  # Python 2
+    clock = time.time
+
+
+class RingBuffer(object):
+    """Fixed-size buffer of floats keeping the latest values.
+
+    Args:
+        size (int): number of values kept
+    """
+
+    def __init__(self, size):
+        self.data = cs.np.zeros(size)
+        self.size = size
+        self.n_recorded = 0
+
+    def append(self, value):
+        self.data[self.n_recorded % self.size] = value
+        self.n_recorded += 1
+
+    def values(self):
+        """Returns the kept values, oldest first."""
+        if self.n_recorded <= self.size:
+            return self.data[:self.n_recorded].copy()
+        idx = self.n_recorded % self.size
+        return cs.np.concatenate((self.data[idx:], self.data[:idx]))
+
+
+class Instrumentation(object):
+    """Ring buffers of per tick quantities and counters of values.
+
+    Args:
+        size (int): number of ticks kept per quantity, default 1000
+    """
+    clock = staticmethod(clock)
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        """Forgets everything recorded."""
+        self.buffers = {}
+        self.counts = {}
+
+    def record(self, name, value):
+        """Records value in the ring buffer of name."""
+        if value is None:
+            return
+        if name not in self.buffers:
+            self.buffers[name] = RingBuffer(self.size)
+        self.buffers[name].append(value)
+
+    def count(self, name, value):
+        """Counts an occurrence of value under name."""
+        counter = self.counts.setdefault(name, {})
+        counter[value] = counter.get(value, 0) + 1
+
+    def summary(self):
+        """Returns a dict with "n", "p50", "p99" and "max" of the kept
+        values of each quantity, and the counters under "counts"."""
+        summary = {}
+        for name, buf in self.buffers.items():
+            values = buf.values()
+            summary[name] = {"n": buf.n_recorded,
+                             "p50": cs.np.percentile(values, 50),
+                             "p99": cs.np.percentile(values, 99),
+                             "max": cs.np.max(values)}
+        summary["counts"] = dict((name, dict(counter))
+                                 for name, counter in self.counts.items())
+        return summary
+
+    def print_summary(self):
+        """Prints the summary, times in microseconds."""
+        summary = self.summary()
+        counts = summary.pop("counts")
+        sys.stdout.write("Instrumentation, last "+str(self.size)
+                         + " ticks:\n")
+        for name in sorted(summary.keys()):
+            info = summary[name]
+            scale = 1.0
+            unit = ""
+            if name in ["eval", "solver", "pack", "total"]:
+                scale = 1e6
+                unit = " us"
+            sys.stdout.write("\t"+name+": p50="
+                             + "%.1f" % (scale*info["p50"])
+                             + " p99=" + "%.1f" % (scale*info["p99"])
+                             + " max=" + "%.1f" % (scale*info["max"])
+                             + unit + " (n=" + str(info["n"]) + ")\n")
+        for name in sorted(counts.keys()):
+            sys.stdout.write("\t"+name+": "+str(counts[name])+"\n")
+        sys.stdout.flush()
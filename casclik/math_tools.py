@@ -68,3 +68,66 @@ def manipulability_measure(J, version="yoshikawa"):
         return cs.np.linalg.det(J)
     elif version.lower() == "smallest":
         return J.min()
+
+
+def damped_svd_pinv_function(name, shape, damping_factor, threshold=None,
+                             n_sweeps=None):
+    """Returns a casadi function of the damped pseudo-inverse of matrices
+    J of the shape by their singular value decomposition.
+
+    The singular values s of J below threshold are damped to
+    s/(s**2 + damping_factor), the others are inverted to 1/s. With
+    threshold None all are damped, as in the damped pseudo-inverse
+    J^T (J J^T + damping_factor I)^-1. The squared singular values are
+    the eigenvalues of J J^T, or J^T J when J is tall, found with
+    n_sweeps sweeps of the cyclic Jacobi eigenvalue algorithm. It is
+    built from casadi operations, so the function can be code
+    generated and jit compiled.
+
+    Args:
+        name (str): name of the function
+        shape (tuple): shape of J
+        damping_factor (float): damping of the small singular values
+        threshold (float): singular values below it are damped
+        n_sweeps (int): sweeps of the Jacobi eigenvalue algorithm,
+            default 1 for 2x2 eigenvalue problems, which it solves
+            exactly, and 8 for larger ones
+    """
+    J = cs.SX.sym("J", shape[0], shape[1])
+    wide = shape[0] <= shape[1]
+    if wide:
+        K = cs.mtimes(J, J.T)
+    else:
+        K = cs.mtimes(J.T, J)
+    n = K.size1()
+    if n_sweeps is None:
+        n_sweeps = 1 if n <= 2 else 8
+    A = [[K[i, j] for j in range(n)] for i in range(n)]
+    W = [[cs.SX(float(i == j)) for j in range(n)] for i in range(n)]
+    for sweep in range(n_sweeps):
+        for p in range(n - 1):
+            for q in range(p + 1, n):
+                # Rotation in the p, q plane zeroing A[p][q]
+                theta = 0.5*cs.atan2(2*A[p][q], A[q][q] - A[p][p])
+                c = cs.cos(theta)
+                s = cs.sin(theta)
+                for M in [A, W]:
+                    for row in M:
+                        row[p], row[q] = (c*row[p] - s*row[q],
+                                          s*row[p] + c*row[q])
+                A[p], A[q] = ([c*a_p - s*a_q for a_p, a_q in zip(A[p], A[q])],
+                              [s*a_p + c*a_q for a_p, a_q in zip(A[p], A[q])])
+    # With eigenvalues s**2, the pseudo-inverse is J^T W diag(s_inv/s) W^T
+    eigvals = cs.vertcat(*[A[i][i] for i in range(n)])
+    inv_eigvals = 1.0/(eigvals + damping_factor)
+    if threshold is not None:
+        inv_eigvals = cs.if_else(eigvals >= max(threshold**2, 1e-300),
+                                 1.0/cs.fmax(eigvals, 1e-300),
+                                 inv_eigvals, False)
+    W = cs.blockcat(W)
+    inner_inv = cs.mtimes([W, cs.diag(inv_eigvals), W.T])
+    if wide:
+        pJ = cs.mtimes(J.T, inner_inv)
+    else:
+        pJ = cs.mtimes(inner_inv, J.T)
+    return cs.Function(name, [J], [pJ], ["J"], ["pinv"])
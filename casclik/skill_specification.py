@@ -33,6 +33,7 @@ class SkillSpecification(object):
     _constraints = []
     _virtual_var = None
     _input_var = None
+    _derivative_cache = None
 
     def __init__(self, label, time_var,
                  robot_var,
@@ -140,6 +141,7 @@ class SkillSpecification(object):
     def constraints(self, cnstr_list):
         self._constraints = sorted(cnstr_list,
                                    key=lambda cnstr: cnstr.priority)
+        self.clear_derivative_cache()
         n_slack_var = 0
         for cnstr in self._constraints:
             if cnstr.constraint_type == "soft":
@@ -151,6 +153,39 @@ class SkillSpecification(object):
             self.slack_var = None
         self._check_var_existence()
 
+    def jacobian(self, expr, var):
+        """Returns the jacobian of expr with respect to var. The result is
+        cached on the skill specification, so controllers built on the
+        same skill share the derivative expressions.
+
+        Return:
+            cs.MX: expression of partial derivative
+        """
+        key = ("jacobian", hash(expr), hash(var))
+        if key not in self._derivative_cache:
+            # The arguments are kept so that their hashes stay unique
+            self._derivative_cache[key] = (cs.jacobian(expr, var),
+                                           (expr, var))
+        return self._derivative_cache[key][0]
+
+    def jtimes(self, expr, var, tangent):
+        """Returns the jacobian of expr with respect to var, times
+        tangent. The result is cached, see jacobian.
+
+        Return:
+            cs.MX: expression of partial derivative times tangent
+        """
+        key = ("jtimes", hash(expr), hash(var), hash(tangent))
+        if key not in self._derivative_cache:
+            self._derivative_cache[key] = (cs.jtimes(expr, var, tangent),
+                                           (expr, var, tangent))
+        return self._derivative_cache[key][0]
+
+    def clear_derivative_cache(self):
+        """Forgets the derivatives cached by jacobian and jtimes. This is
+        done automatically when the constraints are set."""
+        self._derivative_cache = {}
+
     def _check_var_existence(self):
         """Internal function to set _has_virtual, and _has_input.
         Loops over constraints to see if the derivatives are non-zero."""
@@ -158,45 +193,45 @@ class SkillSpecification(object):
         if self.virtual_var is not None:
             virtual_var = self.virtual_var
             for cnstr in self.constraints:
-                if cs.jacobian(cnstr.expression, virtual_var).nnz() > 0:
+                if self.jacobian(cnstr.expression, virtual_var).nnz() > 0:
                     self._has_virtual = True
                 if hasattr(cnstr, "target"):
                     if isinstance(cnstr.target, cs.MX):
-                        if cs.jacobian(cnstr.target, virtual_var).nnz() > 0:
+                        if self.jacobian(cnstr.target, virtual_var).nnz() > 0:
                             self._has_virtual = True
                 if hasattr(cnstr, "set_min"):
                     if isinstance(cnstr.set_min, cs.MX):
-                        if cs.jacobian(cnstr.set_min, virtual_var).nnz() > 0:
+                        if self.jacobian(cnstr.set_min, virtual_var).nnz() > 0:
                             self._has_virtual = True
                 if hasattr(cnstr, "set_max"):
                     if isinstance(cnstr.set_max, cs.MX):
-                        if cs.jacobian(cnstr.set_max, virtual_var).nnz() > 0:
+                        if self.jacobian(cnstr.set_max, virtual_var).nnz() > 0:
                             self._has_virtual = True
                 if hasattr(cnstr, "gain"):
                     if isinstance(cnstr.gain, cs.MX):
-                        if cs.jacobian(cnstr.gain, virtual_var).nnz() > 0:
+                        if self.jacobian(cnstr.gain, virtual_var).nnz() > 0:
                             self._has_virtual = True
         self._has_input = False
         if self.input_var is not None:
             input_var = self.input_var
             for cnstr in self.constraints:
-                if cs.jacobian(cnstr.expression, input_var).nnz() > 0:
+                if self.jacobian(cnstr.expression, input_var).nnz() > 0:
                     self._has_input = True
                 if hasattr(cnstr, "target"):
                     if isinstance(cnstr.target, cs.MX):
-                        if cs.jacobian(cnstr.target, input_var).nnz() > 0:
+                        if self.jacobian(cnstr.target, input_var).nnz() > 0:
                             self._has_input = True
                 if hasattr(cnstr, "set_min"):
                     if isinstance(cnstr.set_min, cs.MX):
-                        if cs.jacobian(cnstr.set_min, input_var).nnz() > 0:
+                        if self.jacobian(cnstr.set_min, input_var).nnz() > 0:
                             self._has_input = True
                 if hasattr(cnstr, "set_max"):
                     if isinstance(cnstr.set_max, cs.MX):
-                        if cs.jacobian(cnstr.set_max, input_var).nnz() > 0:
+                        if self.jacobian(cnstr.set_max, input_var).nnz() > 0:
                             self._has_input = True
                 if hasattr(cnstr, "gain"):
                     if isinstance(cnstr.gain, cs.MX):
-                        if cs.jacobian(cnstr.gain, input_var).nnz() > 0:
+                        if self.jacobian(cnstr.gain, input_var).nnz() > 0:
                             self._has_input = True
 
     def print_constraints(self):
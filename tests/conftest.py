@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(autouse=True)
+def in_tmpdir(tmpdir, monkeypatch):
+    """Runs each test in its own directory, so that the files casadi
+    writes when it jit compiles end up there and not in the tree."""
+    monkeypatch.chdir(str(tmpdir))
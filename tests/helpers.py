@@ -0,0 +1,130 @@
+"""Scenarios and closed-loop simulation shared by the tests
+
+The scenarios are the cart on track and double pendulum of the
+benchmarks. The controllers are built without jit so that the tests
+do not depend on a compiler, and simulate gives the robot_vel_var of
+each tick. The reference trajectories in data/ were written with
+
+    python tests/helpers.py tests/data/baseline_trajectories.json
+
+on the tree before the speedups of the controllers, and should only be
+rewritten when the behaviour of a controller is meant to change.
+"""
+import os
+import sys
+import json
+import casadi as cs
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, ".."))
+sys.path.insert(0, os.path.join(TEST_DIR, "..", "benchmarks"))
+
+import casclik as cc  # noqa: E402
+from scenarios import cart_on_track, double_pendulum  # noqa: E402
+
+SCENARIOS = {"cart_on_track": cart_on_track,
+             "double_pendulum": double_pendulum}
+CONTROLLERS = ["reactive_qp", "reactive_nlp", "pseudo_inverse",
+               "model_predictive"]
+BASELINE_FILE = os.path.join(TEST_DIR, "data", "baseline_trajectories.json")
+N_TICKS = 40
+
+
+def get_options(controller, options=None):
+    """Returns the options of the controller without jit, updated with
+    options."""
+    opt = {"function_opts": {"jit": False}}
+    if controller != "pseudo_inverse":
+        opt["solver_opts"] = {"jit": False}
+    if options is not None:
+        opt.update(options)
+    return opt
+
+
+def make_controller(controller, scenario, options=None, horizon_length=5):
+    """Returns the controller of the scenario, set up."""
+    opt = get_options(controller, options)
+    if controller == "reactive_qp":
+        cntrllr = cc.ReactiveQPController(skill_spec=scenario["skill"],
+                                          options=opt)
+    elif controller == "reactive_nlp":
+        cntrllr = cc.ReactiveNLPController(skill_spec=scenario["skill"],
+                                           cost_expr=scenario["cost_expr"],
+                                           options=opt)
+    elif controller == "pseudo_inverse":
+        cntrllr = cc.PseudoInverseController(
+            skill_spec=scenario["skill_pinv"],
+            options=opt)
+    elif controller == "model_predictive":
+        cntrllr = cc.ModelPredictiveController(
+            skill_spec=scenario["skill"],
+            cost_expr=scenario["cost_expr"],
+            horizon_length=horizon_length,
+            timestep=scenario["timestep"],
+            options=opt)
+    else:
+        raise ValueError("Unknown controller: "+str(controller))
+    cntrllr.setup_problem_functions()
+    cntrllr.setup_solver()
+    return cntrllr
+
+
+def simulate(cntrllr, scenario, n_ticks=N_TICKS, fast=False):
+    """Simulates the controller on the scenario with Euler steps and
+    returns the robot_vel_var of each tick as a list of lists. With
+    fast, solve_into is used instead of solve."""
+    skill = cntrllr.skill_spec
+    dt = scenario["timestep"]
+    max_speed = scenario["max_speed"]
+    robot_var = cs.np.array(scenario["robot_var0"], dtype=float)
+    virtual_var = None
+    if skill.virtual_var is not None:
+        virtual_var = cs.np.zeros(skill.n_virtual_var)
+    robot_vels = []
+    for i in range(n_ticks):
+        if fast:
+            res = cntrllr.solve_into(i*dt, robot_var, virtual_var)
+        else:
+            res = cntrllr.solve(i*dt, robot_var, virtual_var)
+        robot_vel = cs.np.array(res[0], dtype=float).reshape(-1)
+        robot_vels += [robot_vel.tolist()]
+        if isinstance(cntrllr, cc.PseudoInverseController):
+            robot_vel = cs.np.clip(robot_vel, -max_speed, max_speed)
+        robot_var = robot_var + dt*robot_vel
+        if virtual_var is not None and res[1] is not None:
+            virtual_var = virtual_var + dt*cs.np.array(
+                res[1], dtype=float).reshape(-1)
+    return robot_vels
+
+
+def load_baseline():
+    """Returns the reference trajectories keyed by scenario/controller."""
+    with open(BASELINE_FILE) as baseline_file:
+        return json.load(baseline_file)
+
+
+def assert_trajectories_close(actual, expected, atol=1e-6):
+    """Asserts that two lists of robot_vel_var are equal within atol."""
+    actual = cs.np.array(actual)
+    expected = cs.np.array(expected)
+    assert actual.shape == expected.shape
+    err = cs.np.max(cs.np.abs(actual - expected))
+    assert err <= atol, "max difference "+str(err)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    results = {}
+    for scenario_name in sorted(SCENARIOS):
+        for controller in CONTROLLERS:
+            scenario = SCENARIOS[scenario_name]()
+            cntrllr = make_controller(controller, scenario)
+            results[scenario_name+"/"+controller] = simulate(cntrllr,
+                                                             scenario)
+    with open(argv[0], "w") as output_file:
+        json.dump(results, output_file, indent=1, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,50 @@
+"""Swapping in and failing background jit builds."""
+import warnings
+
+import helpers
+from helpers import cs
+from casclik.background_jit import BackgroundJit
+
+
+def get_function():
+    x = cs.MX.sym("x")
+    return cs.Function("f", [x], [2*x])
+
+
+def test_swap():
+    labels = []
+    worker = BackgroundJit(callback=lambda hot_swap: labels.append(
+        hot_swap.label))
+    func = get_function()
+    hot_swap = worker.add_solver(func, lambda: func)
+    assert worker.wait(60)
+    assert hot_swap.is_swapped
+    assert labels == ["f"]
+
+
+def test_failed_build():
+    def fail():
+        raise RuntimeError("no compiler")
+    worker = BackgroundJit()
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        hot_swap = worker.add_solver(get_function(), fail)
+        assert not worker.wait(60)
+    assert not worker.is_ready
+    assert not hot_swap.is_swapped
+    assert float(hot_swap(1.0)) == 2.0
+    assert len(worker.errors) == 1
+    assert any("no compiler" in str(w.message) for w in caught)
+
+
+def test_reactive_nlp():
+    scenario = helpers.SCENARIOS["cart_on_track"]()
+    cntrllr = helpers.make_controller(
+        "reactive_nlp", scenario,
+        {"background_jit": True,
+         "solver_opts": {"jit": True, "print_time": False,
+                         "ipopt.print_level": 0}})
+    assert cntrllr.wait_for_jit(600)
+    expected = helpers.load_baseline()["cart_on_track/reactive_nlp"]
+    actual = helpers.simulate(cntrllr, scenario, n_ticks=5)
+    helpers.assert_trajectories_close(actual, expected[:5])
@@ -0,0 +1,49 @@
+"""Functions set up by the BaseController for the controllers."""
+import pytest
+
+import helpers
+from helpers import cc
+
+
+@pytest.mark.parametrize("controller", ["reactive_qp", "reactive_nlp"])
+def test_hoisted_functions_compiled(tmpdir, controller):
+    scenario = helpers.SCENARIOS["double_pendulum"]()
+    cntrllr = helpers.make_controller(
+        controller, scenario,
+        {"compile_cache": cc.CompileCache(str(tmpdir)),
+         "function_opts": {"jit": True}})
+    hoisted = list(cntrllr.constant_structure.values())[0]
+    assert hoisted["func"].class_name() == "External"
+    assert hoisted["full_func"].class_name() == "External"
+    expected = helpers.load_baseline()["double_pendulum/"+controller]
+    for fast in [False, True]:
+        actual = helpers.simulate(cntrllr, scenario, n_ticks=5, fast=fast)
+        helpers.assert_trajectories_close(actual, expected[:5])
+
+
+class _Solver(object):
+    def __init__(self, stats):
+        self._stats = stats
+
+    def stats(self):
+        return self._stats
+
+
+@pytest.mark.parametrize("stats", [{}, {"return_status": "ok"},
+                                   {"iter_count": 3, "return_status": "ok"}])
+def test_record_tick_solver_stats(stats):
+    scenario = helpers.SCENARIOS["double_pendulum"]()
+    cntrllr = helpers.make_controller("reactive_qp", scenario)
+    cntrllr.solver = _Solver(stats)
+    instr = cntrllr.enable_instrumentation()
+    cntrllr.record_tick(instr, instr.clock(), 0.0, 0.0)
+    summary = instr.summary()
+    if "iter_count" in stats:
+        assert summary["iter_count"]["n"] == 1
+        assert summary["iter_count"]["max"] == stats["iter_count"]
+    else:
+        assert "iter_count" not in summary
+    if "return_status" in stats:
+        assert summary["counts"]["return_status"] == {"ok": 1}
+    else:
+        assert "return_status" not in summary["counts"]
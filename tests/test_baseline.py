@@ -0,0 +1,15 @@
+"""Closed-loop trajectories of the controllers against the references
+in data/, written before the speedups of the controllers."""
+import pytest
+
+import helpers
+
+
+@pytest.mark.parametrize("scenario_name", sorted(helpers.SCENARIOS))
+@pytest.mark.parametrize("controller", helpers.CONTROLLERS)
+def test_baseline(scenario_name, controller):
+    scenario = helpers.SCENARIOS[scenario_name]()
+    cntrllr = helpers.make_controller(controller, scenario)
+    actual = helpers.simulate(cntrllr, scenario)
+    expected = helpers.load_baseline()[scenario_name+"/"+controller]
+    helpers.assert_trajectories_close(actual, expected)
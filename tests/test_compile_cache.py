@@ -0,0 +1,56 @@
+"""Loading and evicting the libraries of the CompileCache."""
+import os
+
+import helpers
+from helpers import cc, cs
+
+
+def get_function():
+    x = cs.MX.sym("x", 2)
+    return cs.Function("f", [x], [cs.sin(x)*x[0]])
+
+
+def test_load(tmpdir):
+    cache = cc.CompileCache(str(tmpdir))
+    func = get_function()
+    for i in range(2):
+        compiled = cache.load(func)
+        assert float(compiled([1.0, 2.0])[1]) == float(func([1.0, 2.0])[1])
+    assert (cache.n_hits, cache.n_misses) == (1, 1)
+
+
+def test_reload_broken_library(tmpdir):
+    cache = cc.CompileCache(str(tmpdir))
+    func = get_function()
+    cache.load(func)
+    path = cache.entries()[0][2]
+    # As if another process removed it after it was found
+    with open(path, "w") as lib_file:
+        lib_file.write("not a library")
+    compiled = cache.load(func)
+    assert float(compiled([1.0, 2.0])[0]) == float(func([1.0, 2.0])[0])
+    assert cache.n_misses == 2
+
+
+def test_library_larger_than_max_size(tmpdir):
+    cache = cc.CompileCache(str(tmpdir), max_size=1)
+    compiled = cache.load(get_function())
+    assert len(cache.entries()) == 1
+    assert compiled.numel_out() == 2
+    assert cache.evict() == 1
+
+
+def test_nlpsol(tmpdir):
+    scenario = helpers.SCENARIOS["double_pendulum"]()
+    expected = helpers.load_baseline()["double_pendulum/reactive_nlp"]
+    for i in range(2):
+        cache = cc.CompileCache(str(tmpdir))
+        cntrllr = helpers.make_controller(
+            "reactive_nlp", scenario,
+            {"compile_cache": cache,
+             "solver_opts": {"jit": True, "print_time": False,
+                             "ipopt.print_level": 0}})
+        actual = helpers.simulate(cntrllr, scenario, n_ticks=5)
+        helpers.assert_trajectories_close(actual, expected[:5])
+    assert (cache.n_hits, cache.n_misses) == (1, 0)
+    assert len(os.listdir(str(tmpdir))) == 1
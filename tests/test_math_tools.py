@@ -0,0 +1,28 @@
+"""Math tools against their numpy counterparts."""
+import pytest
+
+from helpers import cs
+from casclik.math_tools import damped_svd_pinv_function
+
+
+def get_svd_pinv(J, damping_factor, threshold):
+    U, S, Vt = cs.np.linalg.svd(J, full_matrices=False)
+    S_inv = S/(S*S + damping_factor)
+    if threshold is not None:
+        large = S >= threshold
+        S_inv[large] = 1.0/S[large]
+    return cs.np.dot(Vt.T*S_inv, U.T)
+
+
+@pytest.mark.parametrize("shape", [(1, 3), (2, 2), (2, 7), (6, 7), (7, 3)])
+@pytest.mark.parametrize("threshold", [None, 0.1])
+def test_damped_svd_pinv_function(shape, threshold):
+    pinv_func = damped_svd_pinv_function("pinv", shape, 1e-3, threshold)
+    rng = cs.np.random.RandomState(0)
+    for i in range(10):
+        J = rng.randn(*shape)
+        if i % 2 == 0 and min(shape) > 1:
+            J[0] = J[1]  # Rank deficient
+        expected = get_svd_pinv(J, 1e-3, threshold)
+        assert cs.np.allclose(pinv_func(J).full(), expected,
+                              rtol=1e-9, atol=1e-9)
@@ -0,0 +1,81 @@
+"""Solvers and options of the ModelPredictiveController."""
+import pytest
+
+import helpers
+from helpers import cs
+
+
+def test_hpipm_solve_into():
+    scenario = helpers.SCENARIOS["cart_on_track"]()
+    cntrllr = helpers.make_controller("model_predictive", scenario,
+                                      {"linear_quadratic": True,
+                                       "lq_qpsol": "hpipm"})
+    assert cntrllr.linear_quadratic
+    expected = helpers.load_baseline()["cart_on_track/model_predictive"]
+    for fast in [False, True]:
+        actual = helpers.simulate(cntrllr, scenario, fast=fast)
+        helpers.assert_trajectories_close(actual, expected, atol=1e-5)
+
+
+def test_linear_quadratic_opt_in():
+    scenario = helpers.SCENARIOS["cart_on_track"]()
+    cntrllr = helpers.make_controller("model_predictive", scenario)
+    assert not cntrllr.linear_quadratic
+    assert cntrllr.solver.is_a("Nlpsol")
+    cntrllr = helpers.make_controller("model_predictive", scenario,
+                                      {"linear_quadratic": True})
+    assert cntrllr.linear_quadratic
+    expected = helpers.load_baseline()["cart_on_track/model_predictive"]
+    actual = helpers.simulate(cntrllr, scenario)
+    helpers.assert_trajectories_close(actual, expected, atol=1e-5)
+    with pytest.raises(ValueError):
+        helpers.make_controller("model_predictive",
+                                helpers.SCENARIOS["double_pendulum"](),
+                                {"linear_quadratic": True})
+
+
+@pytest.mark.parametrize("option", ["rti", "shifted_warmstart"])
+def test_linear_quadratic_conflicts(option):
+    scenario = helpers.SCENARIOS["cart_on_track"]()
+    with pytest.raises(ValueError):
+        helpers.make_controller("model_predictive", scenario,
+                                {option: True, "linear_quadratic": True})
+
+
+def test_rti_hessian():
+    scenario = helpers.SCENARIOS["cart_on_track"]()
+    skill = scenario["skill"]
+    # Nonconvex in the position of the cart
+    scenario["cost_expr"] += -10.0*skill.robot_var**2
+    cntrllr = helpers.make_controller("model_predictive", scenario,
+                                      {"rti": True})
+    qp_data = cntrllr.rti_problem["qp_data"]
+    opt_var = cs.np.linspace(-1.0, 1.0, qp_data.numel_in(0))
+    H = qp_data(opt_var)[0].full()
+    assert cs.np.min(cs.np.linalg.eigvalsh(H)) >= -1e-12
+    actual = helpers.simulate(cntrllr, scenario, n_ticks=5)
+    assert cs.np.all(cs.np.isfinite(actual))
+
+
+@pytest.mark.parametrize("option", ["rti", "shifted_warmstart"])
+def test_variable_horizon_warmstart(option):
+    scenario = helpers.SCENARIOS["cart_on_track"]()
+    timesteps = [0.02, 0.02, 0.03, 0.03, 0.04]
+    cntrllrs = []
+    for i in range(2):
+        cntrllr = helpers.make_controller("model_predictive", scenario,
+                                          {option: True,
+                                           "variable_horizon": True})
+        cntrllr.set_horizon(4, timesteps)
+        cntrllrs += [cntrllr]
+    cntrllrs[0].solve(0.0, scenario["robot_var0"])
+    x, lam_x, lam_g = cntrllrs[0]._warmstart
+    x0 = cntrllrs[0].get_shifted_warmstart(x, lam_x, lam_g,
+                                           cntrllrs[0]._horizon_pars)[0]
+    assert abs(float(x0[0] - x[0]) - timesteps[0]) < 1e-12
+    # The fast path shifts the warm start in the same way
+    cntrllrs[0].reset_warmstart()
+    helpers.assert_trajectories_close(
+        helpers.simulate(cntrllrs[0], scenario, n_ticks=10),
+        helpers.simulate(cntrllrs[1], scenario, n_ticks=10, fast=True),
+        atol=1e-8)
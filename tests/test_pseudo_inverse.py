@@ -0,0 +1,113 @@
+"""Options of the PseudoInverseController compared to its default
+search and build of the modes."""
+import casadi as cs
+import pytest
+
+import helpers
+from helpers import cc
+
+
+@pytest.mark.parametrize("scenario_name", sorted(helpers.SCENARIOS))
+def test_shared_expressions(scenario_name):
+    scenario = helpers.SCENARIOS[scenario_name]()
+    shared = helpers.make_controller("pseudo_inverse", scenario,
+                                     {"shared_expressions": True})
+    per_mode = helpers.make_controller("pseudo_inverse", scenario)
+    helpers.assert_trajectories_close(helpers.simulate(shared, scenario),
+                                      helpers.simulate(per_mode, scenario),
+                                      atol=1e-9)
+
+
+def two_limit_skill():
+    """Skill with two SetConstraints and an EqualityConstraint that
+    moves both joints past their upper limits."""
+    t = cs.MX.sym("t")
+    q = cs.MX.sym("q", 2)
+    dq = cs.MX.sym("dq", 2)
+    constraints = [
+        cc.SetConstraint(label="q0_limit", expression=q[0], gain=1.0,
+                         set_min=0.0, set_max=1.0),
+        cc.SetConstraint(label="q1_limit", expression=q[1], gain=1.0,
+                         set_min=0.0, set_max=1.0),
+        cc.EqualityConstraint(label="q_des",
+                              expression=cs.vertcat(1.5, 1.5) - q,
+                              gain=1.0)]
+    return cc.SkillSpecification(label="two_limit_skill", time_var=t,
+                                 robot_var=q, robot_vel_var=dq,
+                                 constraints=constraints)
+
+
+def get_mode_choice(mode_search, previous, robot_var, fast):
+    cntrllr = cc.PseudoInverseController(
+        skill_spec=two_limit_skill(),
+        options=helpers.get_options("pseudo_inverse",
+                                    {"mode_search": mode_search}))
+    cntrllr.setup_problem_functions()
+    cntrllr.setup_solver()
+    cntrllr.current_mode = previous
+    if fast:
+        robot_vel = cntrllr.solve_into(0.0, robot_var)[0]
+    else:
+        robot_vel = cntrllr.solve(0.0, robot_var)[0]
+    robot_vel = cs.np.array(robot_vel, dtype=float).ravel()
+    return cntrllr.current_mode, robot_vel
+
+
+@pytest.mark.parametrize("fast", [False, True])
+@pytest.mark.parametrize("robot_var", [[0.5, 0.5], [1.2, 0.5],
+                                       [0.5, 1.2], [1.2, 1.2]])
+@pytest.mark.parametrize("previous", [-1, 0, 1, 2, 3])
+def test_warm_mode_search(previous, robot_var, fast):
+    robot_var = cs.np.array(robot_var)
+    ordered_mode, ordered_vel = get_mode_choice("ordered", previous,
+                                                robot_var, fast)
+    warm_mode, warm_vel = get_mode_choice("warm", previous, robot_var,
+                                          fast)
+    assert warm_mode == ordered_mode
+    assert cs.np.allclose(warm_vel, ordered_vel)
+
+
+def test_corner_tangent_cone_branch_free():
+    t = cs.MX.sym("t")
+    q = cs.MX.sym("q", 2)
+    dq = cs.MX.sym("dq", 2)
+    box = cc.SetConstraint(label="box", expression=q, gain=1.0,
+                           set_min=cs.DM([0.0, 0.0]),
+                           set_max=cs.DM([1.0, 1.0]))
+    skill = cc.SkillSpecification(label="box_skill", time_var=t,
+                                  robot_var=q, robot_vel_var=dq,
+                                  constraints=[box])
+    cntrllr = cc.PseudoInverseController(
+        skill_spec=skill,
+        options=helpers.get_options("pseudo_inverse",
+                                    {"multidim_sets": True}))
+    in_tc = cntrllr.get_in_tangent_cone_function_multidim(box)
+    ops = [in_tc.instruction_id(k) for k in range(in_tc.n_instructions())]
+    assert cs.OP_IF_ELSE_ZERO not in ops
+    assert cs.OP_CALL not in ops
+    assert float(in_tc(0.0, [0.5, 0.5], [1.0, 1.0])) == 1.0
+    assert float(in_tc(0.0, [1.5, 0.5], [-1.0, 0.3])) == 1.0
+    assert float(in_tc(0.0, [1.5, 0.5], [1.0, 0.0])) == 0.0
+    assert float(in_tc(0.0, [1.5, 1.5], [-1.0, -1.0])) == 0.0
+
+
+def test_svd_backend_compiled(tmpdir):
+    scenario = helpers.SCENARIOS["double_pendulum"]()
+    svd = helpers.make_controller(
+        "pseudo_inverse", scenario,
+        {"pinv_backend": "svd",
+         "compile_cache": cc.CompileCache(str(tmpdir)),
+         "function_opts": {"jit": True}})
+    expected = helpers.load_baseline()["double_pendulum/pseudo_inverse"]
+    helpers.assert_trajectories_close(helpers.simulate(svd, scenario),
+                                      expected)
+
+
+@pytest.mark.parametrize("scenario_name", sorted(helpers.SCENARIOS))
+def test_recursive_projector(scenario_name):
+    scenario = helpers.SCENARIOS[scenario_name]()
+    cntrllr = helpers.make_controller("pseudo_inverse", scenario,
+                                      {"projector_method": "recursive"})
+    expected = helpers.load_baseline()[scenario_name+"/pseudo_inverse"]
+    helpers.assert_trajectories_close(helpers.simulate(cntrllr, scenario),
+                                      expected)
@@ -0,0 +1,17 @@
+"""Batch solves and warm starts of the ReactiveQPController."""
+import helpers
+from helpers import cs
+
+
+def test_solve_batch_keeps_res():
+    scenario = helpers.SCENARIOS["double_pendulum"]()
+    cntrllr = helpers.make_controller("reactive_qp", scenario,
+                                      {"persistent_warmstart": True})
+    robot_var0 = scenario["robot_var0"]
+    cntrllr.solve(0.0, robot_var0)
+    res = cntrllr.res
+    robot_vel = cntrllr.solve_batch([0.0, 0.1], [robot_var0, robot_var0])[0]
+    assert cntrllr.res is res
+    assert robot_vel.shape == (2, 2)
+    expected = helpers.load_baseline()["double_pendulum/reactive_qp"][0]
+    assert cs.np.allclose(robot_vel[0], expected, atol=1e-6)